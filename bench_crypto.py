@@ -0,0 +1,110 @@
+
+# Micro-benchmarks for the crypto primitives: gcd and modular inverses,
+# field arithmetic, curve points, ECDSA, and keccak. Inputs are fixed so
+# that runs are comparable across commits (with the same ethsha3.BACKEND):
+#
+#     python bench_crypto.py --output before.json
+#     (change code)
+#     python bench_crypto.py --baseline before.json
+
+import argparse
+import math
+import random
+import common
+import ecc
+import ecdsa
+import ethsha3
+import keccak
+import benchmark
+
+# Message sizes for hashing, in bytes. 136 is the keccak-256 block size.
+HASH_SIZES = [32, 64, 136, 1024, 4096]
+
+# Operand sizes for the gcd and inverse benchmarks, in bits.
+GCD_BITS = [256, 1024, 4096]
+
+# Returns a list of (name, function) pairs to benchmark.
+def _make_benchmarks():
+    rng = random.Random(0)
+    ec = ecc.EllipticCurve.secp256k1()
+    f = ec.f
+
+    a = rng.randrange(1, f.size)
+    b = rng.randrange(1, f.size)
+    k = rng.randrange(1, ec.n)
+    pr = rng.randrange(1, ec.n)
+    pu = ec.G*pr
+    p = ec.G*rng.randrange(1, ec.n)
+    q = ec.G*rng.randrange(1, ec.n)
+    e = rng.randrange(1, ec.n)
+    v, r, s = ecdsa.sign_message(ec, pr, e, rng)
+
+    benchmarks = [
+        ("Field.multiply", lambda: f.multiply(a, b)),
+        ("Field.invert", lambda: f.invert(a)),
+        ("point add", lambda: p + q),
+        ("point double", lambda: p + p),
+        ("G*k", lambda: ec.G*k),
+        ("P*k", lambda: p*k),
+        ("sign_message", lambda: ecdsa.sign_message(ec, pr, e, rng)),
+        ("verify_signature", lambda: ecdsa.verify_signature(ec, pu, e, v, r, s)),
+        ("recover_public_key", lambda: ecdsa.recover_public_key(ec, e, v, r, s)),
+    ]
+
+    for bits in GCD_BITS:
+        n = rng.getrandbits(bits) | (1 << (bits - 1)) | 1
+        d = rng.randrange(1, n)
+        while math.gcd(d, n) != 1:
+            d = rng.randrange(1, n)
+        benchmarks += [
+            ("find_inverse %d bits" % bits, lambda d=d, n=n: common.find_inverse(d, n)),
+            ("fastxgcd %d bits" % bits, lambda d=d, n=n: common.fastxgcd(d, n)),
+            ("lehmer_xgcd %d bits" % bits, lambda d=d, n=n: common.lehmer_xgcd(n, d)),
+            ("xgcd %d bits" % bits, lambda d=d, n=n: common.xgcd(d, n)),
+        ]
+    sieve_product = math.prod(range(3, 100000, 2))
+    candidates = [rng.getrandbits(64) | 1 for i in range(1000)]
+    benchmarks += [
+        ("gcd x1000", lambda: [math.gcd(sieve_product, n) for n in candidates]),
+        ("gcd_many x1000", lambda: common.gcd_many(sieve_product, candidates)),
+    ]
+
+    for size in HASH_SIZES:
+        message = rng.randbytes(size)
+        benchmarks.append(("ethsha3.hash %d bytes" % size,
+            lambda message=message: ethsha3.hash(message)))
+    messages = [rng.randbytes(32) for i in range(100)]
+    benchmarks += [
+        ("ethsha3.hash 32 bytes x100", lambda: [ethsha3.hash(m) for m in messages]),
+        ("ethsha3.hash_many 32 bytes x100", lambda: ethsha3.hash_many(messages)),
+        ("keccak.keccak_256 32 bytes", lambda: keccak.keccak_256(messages[0])),
+    ]
+
+    return benchmarks
+
+def run(name_filter=None, repeat=7):
+    results = []
+    for name, fn in _make_benchmarks():
+        if name_filter is None or name_filter in name:
+            result = benchmark.measure(name, fn, repeat=repeat)
+            print(result)
+            results.append(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the crypto primitives.")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=7, help="samples per benchmark")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against results written by --output")
+    args = parser.parse_args()
+
+    print("ethsha3 backend: %s" % ethsha3.BACKEND)
+    results = run(args.filter, args.repeat)
+    if args.output:
+        benchmark.save_results(args.output, results)
+    if args.baseline:
+        benchmark.compare(results, args.baseline)
+
+if __name__ == "__main__":
+    main()
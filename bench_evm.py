@@ -0,0 +1,99 @@
+
+# Benchmarks for the EVM interpreter: loops that exercise one class of
+# opcodes each, decoding, and the interpreter's own test vectors. Prints
+# the instructions executed per second for the loops. Inputs are fixed so
+# that runs are comparable across commits:
+#
+#     python bench_evm.py --output before.json
+#     (change code)
+#     python bench_evm.py --baseline before.json
+
+import argparse
+import benchmark
+import ethsha3
+import evm
+import mpt
+
+# Iterations of each loop.
+ITERATIONS = 1000
+
+# Loop bodies, which must leave the stack (the loop counter) as they found it.
+LOOP_BODIES = [
+        ("empty", ""),
+        ("arithmetic", "DUP1 DUP1 ADD DUP1 MUL PUSH1 3 SWAP1 SUB PUSH1 7 DIV POP"),
+        ("bitwise", "DUP1 PUSH1 0xFF AND DUP2 LT ISZERO DUP2 XOR NOT POP"),
+        ("stack", "DUP1 DUP1 SWAP1 DUP2 SWAP2 POP POP POP"),
+        ("push32", "PUSH32 0x" + "ab"*32 + " POP"),
+        ("exp", "DUP1 PUSH1 3 EXP POP"),
+        ("memory", "DUP1 PUSH1 0 MSTORE PUSH1 0 MLOAD POP"),
+        ("sha3", "PUSH1 32 PUSH1 0 SHA3 POP"),
+        ("storage", "DUP1 DUP1 SSTORE PUSH1 5 SLOAD POP"),
+]
+
+# Returns the code of a loop that runs "body" "iterations" times.
+def make_loop(body, iterations):
+    return evm.assemble("PUSH2 %d loop: %s PUSH1 1 SWAP1 SUB DUP1 PUSH2 @loop JUMPI STOP" % (
+        iterations, body))
+
+# Number of instructions a loop from make_loop() executes.
+def _loop_instructions(body, iterations):
+    body_instructions = len(evm.DecodedCode(evm.assemble(body)).instructions) - 1
+    return 2 + iterations*(body_instructions + 7)
+
+# Returns a list of (name, function, instructions per call) tuples.
+def _make_benchmarks():
+    benchmarks = []
+    for name, body in LOOP_BODIES:
+        code = evm.DecodedCode(make_loop(body, ITERATIONS))
+        def run(code=code):
+            host = evm.MemoryHost({b"\x01"*20: evm.MemoryAccount()})
+            message = evm.Message(bytes(20), b"\x01"*20, b"\x01"*20, 0, b"", 10**9, 0)
+            result = evm.execute(message, code, host)
+            assert result.success
+        benchmarks.append(("loop %s" % name, run, _loop_instructions(body, ITERATIONS)))
+
+    # About 24 KB of code, the size limit for contracts since Spurious Dragon.
+    code = make_loop(" ".join([LOOP_BODIES[1][1]]*1850), 1)
+    code_store = evm.CodeStore(mpt.HashTable())
+    code_hash = code_store.put(code)
+    benchmarks += [
+        ("decode %d bytes" % len(code), lambda: evm.DecodedCode(code), None),
+        ("decode %d bytes, cached" % len(code), lambda: code_store.get_decoded(code_hash), None),
+    ]
+
+    vectors = [evm.assemble(source) for source, expected, gas_used in evm._TEST_VECTORS]
+    def run_vectors():
+        for code in vectors:
+            evm.MemoryHost().run(code, b"\x01\x02\x03")
+    benchmarks.append(("test vectors x%d" % len(vectors), run_vectors, None))
+
+    return benchmarks
+
+def run(name_filter=None, repeat=7):
+    results = []
+    for name, fn, instructions in _make_benchmarks():
+        if name_filter is None or name_filter in name:
+            result = benchmark.measure(name, fn, repeat=repeat)
+            print(result)
+            if instructions is not None:
+                print("    %.2f M instructions/sec" % (instructions*result.ops_per_sec()/1e6))
+            results.append(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the EVM interpreter.")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=7, help="samples per benchmark")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against results written by --output")
+    args = parser.parse_args()
+
+    print("ethsha3 backend: %s" % ethsha3.BACKEND)
+    results = run(args.filter, args.repeat)
+    if args.output:
+        benchmark.save_results(args.output, results)
+    if args.baseline:
+        benchmark.compare(results, args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+
+# Benchmarks for factor.factorize(): semiprimes with factors of increasing
+# size, which mostly measure Pollard's rho, and a few small numbers compared
+# with the trial division that common.prime_factors() used to do. Inputs
+# are fixed so that runs are comparable across commits:
+#
+#     python bench_factor.py --output before.json
+#     (change code)
+#     python bench_factor.py --baseline before.json
+
+import argparse
+import random
+import factor
+import prime
+import benchmark
+
+# Bits of each of the two prime factors of the semiprimes. The factors are
+# safe primes, so that p-1 can't find them and rho does the work.
+FACTOR_BITS = [16, 20, 24, 28, 32, 36, 40]
+
+# Small numbers for the comparison with trial division, which takes time
+# proportional to the number itself.
+SMALL_NUMBERS = [2**16 - 1, 999983*2, 1000000]
+
+# Returns a list of (name, function) pairs to benchmark.
+def _make_benchmarks(workers):
+    rng = random.Random(0)
+    benchmarks = []
+
+    for n in SMALL_NUMBERS:
+        benchmarks.append(("trial division %d" % n, lambda n=n: _trial_division(n)))
+        benchmarks.append(("factorize %d" % n, lambda n=n: factor.factorize(n)))
+
+    for bits in FACTOR_BITS:
+        n = prime.random_prime_bits(bits, True, rng)*prime.random_prime_bits(bits, True, rng)
+        benchmarks.append(("factorize %d-bit factors" % bits,
+            lambda n=n: factor.factorize(n)))
+        if workers > 1:
+            benchmarks.append(("factorize %d-bit factors, %d workers" % (bits, workers),
+                lambda n=n: factor.factorize(n, workers)))
+
+    return benchmarks
+
+# The factorization common.prime_factors() used to do.
+def _trial_division(a):
+    factors = []
+    while a > 1:
+        for i in range(2, a + 1):
+            if a % i == 0:
+                factors.append(i)
+                a //= i
+    return factors
+
+def run(name_filter=None, repeat=7, workers=1):
+    results = []
+    for name, fn in _make_benchmarks(workers):
+        if name_filter is None or name_filter in name:
+            result = benchmark.measure(name, fn, repeat=repeat)
+            print(result)
+            results.append(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark integer factorization.")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=7, help="samples per benchmark")
+    parser.add_argument("--workers", type=int, default=1,
+            help="also benchmark Pollard's rho on this many processes")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against results written by --output")
+    args = parser.parse_args()
+
+    results = run(args.filter, args.repeat, args.workers)
+    if args.output:
+        benchmark.save_results(args.output, results)
+    if args.baseline:
+        benchmark.compare(results, args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+
+# Block import benchmark over deterministic synthetic chains. Prints the
+# results as JSON so they can be compared between versions.
+#
+#     python bench_import.py --blocks 50 --accounts 200 --transactions 20 --output result.json
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+import benchmark
+import eth
+import metrics
+import mpt
+import synthetic
+
+# Import the chain into a fresh EthereumVirtualMachine. Runs in its own
+# process so that peak RSS covers only the import. Puts the results in "q".
+def _import_chain(q, genesis_alloc, binary, pipeline, workers, with_metrics):
+    if with_metrics:
+        metrics.enable()
+    evm = eth.EthereumVirtualMachine(genesis_alloc)
+    nodes_before = len(evm.hash_table)
+    transactions = 0
+
+    begin = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if pipeline:
+            p = eth.ImportPipeline(evm, workers=workers)
+            p.run(binary)
+            blocks = p.execute_stage.blocks
+            transactions = p.execute_stage.transactions
+            stages = p.as_dict()
+        else:
+            blocks = 0
+            for b in eth.Block.decode_multiple(binary):
+                evm.process_block(b)
+                blocks += 1
+                transactions += len(b.transactions)
+            stages = None
+    elapsed = time.perf_counter() - begin
+
+    q.put({
+        "seconds": elapsed,
+        "blocks": blocks,
+        "transactions": transactions,
+        "blocks_per_second": blocks/elapsed,
+        "transactions_per_second": transactions/elapsed,
+        "trie_nodes_written": len(evm.hash_table) - nodes_before,
+        "peak_rss_bytes": _peak_rss(),
+        "state_root": evm.state.root.hex(),
+        "stages": stages,
+        "secured_key_cache": mpt.secured_key_cache.as_dict(),
+        "storage_cache": evm.storage.accounts.as_dict(),
+        "metrics": metrics.summary() if with_metrics else None,
+    })
+
+# Peak resident set size of this process, in bytes.
+def _peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return rss if sys.platform == "darwin" else rss*1024
+
+def run(block_count, account_count, transactions_per_block, seed, pipeline, workers,
+        with_metrics=False):
+    begin = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        chain = synthetic.make_chain(block_count, account_count, transactions_per_block, seed)
+    binary = chain.encode()
+    generate_time = time.perf_counter() - begin
+
+    q = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_import_chain,
+            args=(q, chain.genesis_alloc, binary, pipeline, workers, with_metrics))
+    process.start()
+    result = q.get()
+    process.join()
+    assert result["state_root"] == chain.blocks[-1].header.stateRoot.hex()
+
+    return {
+        "version": benchmark.git_version(),
+        "python": platform.python_version(),
+        "parameters": {
+            "blocks": block_count,
+            "accounts": account_count,
+            "transactions_per_block": transactions_per_block,
+            "seed": seed,
+            "pipeline": pipeline,
+            "workers": workers,
+        },
+        "generate_seconds": generate_time,
+        "chain_bytes": len(binary),
+        "import": result,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark block import on a synthetic chain.")
+    parser.add_argument("--blocks", type=int, default=20, help="blocks, including genesis")
+    parser.add_argument("--accounts", type=int, default=100, help="funded accounts")
+    parser.add_argument("--transactions", type=int, default=10, help="transactions per block")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pipeline", action="store_true", help="import with ImportPipeline")
+    parser.add_argument("--workers", type=int, default=None,
+            help="sender recovery processes for --pipeline")
+    parser.add_argument("--metrics", action="store_true",
+            help="include counters and timings from the metrics module")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    results = run(args.blocks, args.accounts, args.transactions, args.seed,
+            args.pipeline, args.workers, args.metrics)
+    s = json.dumps(results, indent=4)
+    print(s)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(s + "\n")
+
+if __name__ == "__main__":
+    main()
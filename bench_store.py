@@ -0,0 +1,54 @@
+
+# Compare memory use and lookup throughput of the trie node stores.
+
+import random
+import sys
+import tracemalloc
+import mpt
+import benchmark
+
+# Values roughly the size of RLP-encoded trie nodes.
+MIN_VALUE_LENGTH = 40
+MAX_VALUE_LENGTH = 532
+
+def _make_items(count, seed):
+    r = random.Random(seed)
+    items = []
+    for i in range(count):
+        # Bytearrays so that _fill() makes fresh copies.
+        k = bytearray(r.randbytes(32))
+        v = bytearray(r.randbytes(r.randint(MIN_VALUE_LENGTH, MAX_VALUE_LENGTH)))
+        items.append((k, v))
+    return items
+
+# Return (store, bytes allocated by filling it).
+def _fill(make_store, items):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = make_store()
+    for k, v in items:
+        # The store owns its objects, like when reading from disk.
+        store.set(bytes(k), bytes(v))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return store, after - before
+
+def run(count):
+    items = _make_items(count, 1)
+    payload = sum(len(k) + len(v) for k, v in items)
+    print("%d entries, %.1f MB of keys and values" % (count, payload/1e6))
+
+    r = random.Random(2)
+    lookups = [bytes(r.choice(items)[0]) for i in range(1000)]
+
+    for name, make_store in [("HashTable", mpt.HashTable), ("ArenaHashTable", mpt.ArenaHashTable)]:
+        store, memory = _fill(make_store, items)
+        def lookup():
+            for k in lookups:
+                store.get(k)
+        result = benchmark.measure(name + ".get x 1000", lookup)
+        print("    %-16s %8.1f MB (%.2fx payload), %10.0f gets/sec" % (name,
+            memory/1e6, memory/payload, result.ops_per_sec()*len(lookups)))
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
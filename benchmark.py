@@ -0,0 +1,123 @@
+
+# Utilities for timing code. Each measurement runs the function a few times
+# to warm up, then repeats it and reports the median and percentiles so that
+# numbers are comparable between runs.
+
+import json
+import platform
+import statistics
+import subprocess
+import os
+import time
+
+class Result:
+    def __init__(self, name, number, times):
+        self.name = name
+        # Calls per sample.
+        self.number = number
+        # Seconds per call, one entry per sample, sorted.
+        self.times = sorted(times)
+
+    def median(self):
+        return statistics.median(self.times)
+
+    # Seconds per call at percentile p (0 to 100).
+    def percentile(self, p):
+        index = round((len(self.times) - 1)*p/100)
+        return self.times[index]
+
+    def ops_per_sec(self):
+        median = self.median()
+        return 1/median if median > 0 else float("inf")
+
+    def as_dict(self):
+        return {
+                "name": self.name,
+                "number": self.number,
+                "samples": len(self.times),
+                "median": self.median(),
+                "p10": self.percentile(10),
+                "p90": self.percentile(90),
+                "ops_per_sec": self.ops_per_sec(),
+        }
+
+    def __repr__(self):
+        return "%-40s %12.1f ops/sec (median %s, p10 %s, p90 %s)" % (self.name,
+                self.ops_per_sec(), _format_time(self.median()),
+                _format_time(self.percentile(10)), _format_time(self.percentile(90)))
+
+# Time fn(), which takes no parameters. Each sample calls it "number" times.
+# If "number" is None, it's picked so that each sample takes about
+# "min_sample_time" seconds.
+def measure(name, fn, number=None, repeat=7, warmup=1, min_sample_time=0.05):
+    for i in range(warmup):
+        fn()
+
+    if number is None:
+        number = _calibrate(fn, min_sample_time)
+
+    times = []
+    for i in range(repeat):
+        begin = time.perf_counter()
+        for j in range(number):
+            fn()
+        times.append((time.perf_counter() - begin)/number)
+
+    return Result(name, number, times)
+
+# Find a call count that takes at least "min_sample_time" seconds.
+def _calibrate(fn, min_sample_time):
+    number = 1
+    while True:
+        begin = time.perf_counter()
+        for i in range(number):
+            fn()
+        elapsed = time.perf_counter() - begin
+        if elapsed >= min_sample_time:
+            return number
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_sample_time/elapsed) + 1))
+
+def _format_time(t):
+    if t >= 1:
+        return "%.2f s" % t
+    if t >= 1e-3:
+        return "%.2f ms" % (t*1e3)
+    if t >= 1e-6:
+        return "%.2f us" % (t*1e6)
+    return "%.0f ns" % (t*1e9)
+
+# Current commit, if running from a git checkout.
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Write a list of Result objects as JSON, with enough context to compare
+# against later runs.
+def save_results(pathname, results):
+    data = {
+            "version": git_version(),
+            "python": platform.python_version(),
+            "results": [result.as_dict() for result in results],
+    }
+    with open(pathname, "w") as f:
+        json.dump(data, f, indent=4)
+        f.write("\n")
+
+# Print how the results compare to those saved by save_results() in the
+# file "baseline_pathname". Ratios above 1 mean faster than the baseline.
+def compare(results, baseline_pathname):
+    with open(baseline_pathname) as f:
+        baseline = json.load(f)
+    baseline_results = {r["name"]: r for r in baseline["results"]}
+
+    print("Compared to %s (%s):" % (baseline_pathname, baseline.get("version")))
+    for result in results:
+        old = baseline_results.get(result.name)
+        if old is None:
+            print("    %-40s (not in baseline)" % result.name)
+        else:
+            print("    %-40s %6.2fx" % (result.name, old["median"]/result.median()))
@@ -0,0 +1,108 @@
+# Bounded least-recently-used cache, safe to share between threads.
+
+import collections
+import threading
+
+class LruCache:
+    # "capacity" is the maximum number of entries.
+    def __init__(self, capacity):
+        assert capacity > 0
+        self.capacity = capacity
+        self.m = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.m)
+
+    def __contains__(self, k):
+        return k in self.m
+
+    # Returns the value for the key, or "default" if it's not in the cache.
+    def get(self, k, default=None):
+        with self.lock:
+            v = self.m.get(k, default)
+            if v is default:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.m.move_to_end(k)
+            return v
+
+    # Set the value for the key, evicting the least recently used entry if
+    # the cache is full.
+    def set(self, k, v):
+        with self.lock:
+            self.m[k] = v
+            self.m.move_to_end(k)
+            if len(self.m) > self.capacity:
+                self.m.popitem(last=False)
+
+    # Remove the key, if it's in the cache.
+    def delete(self, k):
+        with self.lock:
+            self.m.pop(k, None)
+
+    def clear(self):
+        with self.lock:
+            self.m.clear()
+            self.hits = 0
+            self.misses = 0
+
+    # Fraction of get() calls that found their key.
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits/lookups if lookups > 0 else 0
+
+    def as_dict(self):
+        return {
+                "size": len(self.m),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate(),
+        }
+
+def _tests():
+    import random
+
+    c = LruCache(3)
+    c.set(1, "a")
+    c.set(2, "b")
+    c.set(3, "c")
+    assert c.get(1) == "a" # 1 is now the most recently used.
+    c.set(4, "d") # Evicts 2.
+    assert 2 not in c
+    assert c.get(2) is None
+    assert c.get(2, "x") == "x"
+    assert [c.get(k) for k in [1, 3, 4]] == ["a", "c", "d"]
+    assert c.hits == 4 and c.misses == 2
+    c.set(1, "e")
+    assert c.get(1) == "e" and len(c) == 3
+    c.delete(1)
+    c.delete(1)
+    assert 1 not in c and len(c) == 2
+
+    # Many threads using one cache.
+    c = LruCache(100)
+    def work(seed):
+        rng = random.Random(seed)
+        for i in range(20000):
+            k = rng.randrange(200)
+            v = c.get(k)
+            assert v is None or v == k*2
+            if v is None:
+                c.set(k, k*2)
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(c) == 100
+    assert c.hits + c.misses == 8*20000
+
+    print("All good.")
+
+if __name__ == "__main__":
+    _tests()
@@ -1,12 +1,43 @@
 
 # Commonly-used routines.
+#
+# gcd() and find_inverse() use math.gcd() and pow(d, -1, n) where Python
+# has them, which are several times faster than any loop in Python.
+# Otherwise they fall back to Euclid's algorithm, or for big operands to
+# Lehmer's algorithm (lehmer_xgcd()), which does most of the work of
+# Euclid's on single-digit approximations of the operands and touches the
+# big numbers only once per digit's worth of quotients. In Python the
+# interpreter overhead per quotient hides most of that saving, so Lehmer's
+# only wins for operands of thousands of bits.
+
+import math
+
+# Operands with at least this many bits use lehmer_xgcd() in the fallbacks.
+LEHMER_THRESHOLD = 4096
+
+# Bits of the leading digits lehmer_xgcd() works with: one CPython digit,
+# so that its inner loop is on small ints. Below four digits, it finishes
+# with plain Euclid.
+_LEHMER_DIGIT_BITS = 30
+
+try:
+    pow(2, -1, 3)
+    _HAVE_POW_INVERSE = True
+except (TypeError, ValueError):
+    _HAVE_POW_INVERSE = False
+
+_HAVE_MATH_GCD = hasattr(math, "gcd")
 
 def gcd(a, b):
+    if _HAVE_MATH_GCD:
+        return math.gcd(a, b)
+    if min(abs(a), abs(b)).bit_length() >= LEHMER_THRESHOLD:
+        return lehmer_xgcd(abs(a), abs(b))[0]
     while b != 0:
         t = b
         b = a % b
         a = t
-    return a
+    return abs(a)
 
 def lcm(a, b):
     return a*b//gcd(a, b)
@@ -28,19 +59,171 @@ def fastxgcd(a, b):
         x0, x1 = x1, x0 - q * x1
     return x0
 
+def lehmer_xgcd(a, b):
+    """like xgcd(), for a, b >= 0, with Lehmer's algorithm"""
+    swapped = a < b
+    if swapped:
+        a, b = b, a
+
+    # Invariant: a = ua*a0 + va*b0 and b = ub*a0 + vb*b0.
+    ua, va, ub, vb = 1, 0, 0, 1
+    while b.bit_length() >= 4*_LEHMER_DIGIT_BITS:
+        # Run Euclid on the leading digits of a and b, with the cofactors
+        # of the quotients in A, B, C, D, for as long as the quotients are
+        # certainly those of a and b (Knuth's Algorithm L).
+        shift = a.bit_length() - _LEHMER_DIGIT_BITS
+        x = a >> shift
+        y = b >> shift
+        A, B, C, D = 1, 0, 0, 1
+        while y + C != 0 and y + D != 0:
+            q = (x + A)//(y + C)
+            if q != (x + B)//(y + D):
+                break
+            A, C = C, A - q*C
+            B, D = D, B - q*D
+            x, y = y, x - q*y
+
+        if B == 0:
+            # Not even one quotient was certain: do a full division step.
+            q, r = divmod(a, b)
+            a, b = b, r
+            ua, ub = ub, ua - q*ub
+            va, vb = vb, va - q*vb
+        else:
+            a, b = A*a + B*b, C*a + D*b
+            ua, ub = A*ua + B*ub, C*ua + D*ub
+            va, vb = A*va + B*vb, C*va + D*vb
+
+    while b != 0:
+        q, r = divmod(a, b)
+        a, b = b, r
+        ua, ub = ub, ua - q*ub
+        va, vb = vb, va - q*vb
+
+    if swapped:
+        ua, va = va, ua
+    return a, ua, va
+
+# Returns [gcd(a, b) for b in values], for a much larger than the values,
+# like a product of many small primes to sieve candidates with. Rather than
+# dividing the big a by each value, a is divided by products of the values
+# that are about half its size, and the remainders by the products of each
+# half of those, and so on down to the values (a remainder tree). With
+# CPython's schoolbook division this is 1.5 to 5 times faster when a has
+# tens of thousands of bits and the values are small.
+def gcd_many(a, values):
+    values = list(values)
+    if not values:
+        return []
+
+    # Product tree: tree[0] is the values, each level above holds the
+    # products of pairs from the level below.
+    tree = [values]
+    limit = a.bit_length()//2
+    while len(tree[-1]) > 1:
+        level = tree[-1]
+        products = [level[i]*level[i + 1] if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)]
+        if max(p.bit_length() for p in products) > limit:
+            break
+        tree.append(products)
+
+    remainders = [a % p for p in tree[-1]]
+    for level in reversed(tree[:-1]):
+        remainders = [remainders[i//2] % v for i, v in enumerate(level)]
+    return [gcd(r, v) for r, v in zip(remainders, values)]
+
+# Yields the prime factors of a in ascending order, each as many times as
+# it divides a, and nothing if a <= 1. See factor.factorize().
 def prime_factors(a):
-    while a > 1:
-        for i in range(2, a + 1):
-            if a % i == 0:
-                yield i
-                a //= i
+    if a <= 1:
+        return
+    # Not at the top: factor imports prime, which imports this module.
+    import factor
+    for p, k in factor.factorize(a).items():
+        for i in range(k):
+            yield p
 
 def are_relatively_prime(a, b):
     return gcd(a, b) == 1
 
-# Find e such that ed % n = 1
+# Find e such that ed % n = 1. Raises ValueError if there is none.
 def find_inverse(d, n):
-    e = fastxgcd(d, n)
-    if e < 0:
-        e += n
-    return e
+    if _HAVE_POW_INVERSE:
+        return pow(d, -1, n)
+    d %= n
+    if n.bit_length() >= LEHMER_THRESHOLD:
+        g, e, f = lehmer_xgcd(d, n)
+    else:
+        g, e, f = xgcd(d, n)
+    if g != 1:
+        raise ValueError("%d has no inverse modulo %d" % (d, n))
+    return e % n
+
+def _tests():
+    import random
+    global _HAVE_POW_INVERSE, _HAVE_MATH_GCD
+
+    # The Euclid versions, as they were before the fast paths.
+    def euclid_gcd(a, b):
+        while b != 0:
+            a, b = b, a % b
+        return a
+
+    def euclid_inverse(d, n):
+        e = fastxgcd(d, n)
+        return e + n if e < 0 else e
+
+    fast_paths = _HAVE_POW_INVERSE, _HAVE_MATH_GCD
+    try:
+        for _HAVE_POW_INVERSE, _HAVE_MATH_GCD in [fast_paths, (False, False)]:
+            # Exhaustively on small numbers.
+            for a in range(300):
+                for b in range(300):
+                    g, x, y = lehmer_xgcd(a, b)
+                    assert g == gcd(a, b) == euclid_gcd(a, b) == xgcd(a, b)[0]
+                    assert a*x + b*y == g
+            for n in range(2, 600):
+                for d in range(1, n):
+                    if euclid_gcd(d, n) == 1:
+                        assert find_inverse(d, n) == euclid_inverse(d, n)
+                    else:
+                        try:
+                            find_inverse(d, n)
+                            assert False
+                        except ValueError:
+                            pass
+
+            # Big numbers, where the Lehmer steps kick in. The quotients
+            # are the same as Euclid's, so are the cofactors.
+            rng = random.Random(0)
+            for bits in [64, 127, 128, 256, 521, 2048, 4096, 8192]:
+                for i in range(2000//bits + 10):
+                    a = rng.getrandbits(bits)
+                    b = rng.getrandbits(rng.choice([bits, bits//2, bits - 1]))
+                    assert lehmer_xgcd(a, b) == xgcd(a, b)
+                    assert gcd(a, b) == euclid_gcd(a, b)
+                    n = a | 1
+                    if euclid_gcd(b, n) == 1:
+                        assert find_inverse(b, n) == euclid_inverse(b, n)
+            # Large common factors.
+            p = 2**127 - 1
+            assert lehmer_xgcd(p*3**200, p*5**200) == xgcd(p*3**200, p*5**200)
+    finally:
+        _HAVE_POW_INVERSE, _HAVE_MATH_GCD = fast_paths
+
+    assert list(prime_factors(360)) == [2, 2, 2, 3, 3, 5]
+    assert list(prime_factors(0)) == list(prime_factors(1)) == list(prime_factors(-6)) == []
+    assert lcm(4, 6) == 12
+
+    rng = random.Random(1)
+    a = math.prod(range(1, 3000))
+    values = [rng.getrandbits(256) for i in range(100)] + [7, 1, 2**61 - 1]
+    assert gcd_many(a, values) == [euclid_gcd(a, v) for v in values]
+    assert gcd_many(6, [4, 9, 35]) == [2, 3, 1]
+    assert gcd_many(a, []) == []
+
+    print("All good.")
+
+if __name__ == "__main__":
+    _tests()
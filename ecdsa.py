@@ -15,7 +15,7 @@ V_VALUE_ODD = 28
 # Compute the hash of the message.
 def _compute_z(ec, e):
     if isinstance(e, bytes) or isinstance(e, bytearray):
-        e = int.from_bytes(ethsha3.ethsha3(e), "big")
+        e = int.from_bytes(ethsha3.hash(e), "big")
     assert isinstance(e, int)
 
     z = e
@@ -27,13 +27,15 @@ def _compute_z(ec, e):
 
 # Sign the message "e" with the specified private key. The message can either
 # by bytes, which will be hashed, or the integer hash itself. Returns (v, r, s).
-def sign_message(ec, pr, e):
+# The random nonce is drawn from "rng", which can be seeded for reproducible
+# signatures.
+def sign_message(ec, pr, e, rng=random):
     f = Field(ec.n)
 
     z = _compute_z(ec, e)
 
     while True:
-        k = random.randrange(1, ec.n)
+        k = rng.randrange(1, ec.n)
         p1 = ec.G*k
         r = f.value(p1.x)
         if r == 0:
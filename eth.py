@@ -2,13 +2,24 @@
 # Various data structures for Ethereum.
 
 from datetime import datetime
+import concurrent.futures
+import hashlib
+import itertools
 import json
+import multiprocessing
+import os
+import queue
 import random
+import threading
+import time
+import cache
 import ecc
 import rlp
 import mpt
 import ecdsa
 import ethsha3
+import evm
+import metrics
 
 WEI_PER_ETHER = 10**18
 INDENT = "    "
@@ -47,9 +58,9 @@ def all_ascii(b):
     return True
 
 def dump_string(v, key):
-    if isinstance(v, bytes) or isinstance(v, bytearray):
+    if isinstance(v, bytes) or isinstance(v, bytearray) or isinstance(v, memoryview):
         if key in STRING_KEYS and all_ascii(v):
-            v = '"' + v.decode("ascii") + '"'
+            v = '"' + bytes(v).decode("ascii") + '"'
         elif len(v) == 0:
             v = "(empty)"
         else:
@@ -81,6 +92,8 @@ def public_key_to_address(pu):
     return ethsha3.hash(public_key_bytes)[-20:] # Right-most 160 bits.
 
 class Account:
+    __slots__ = ["nonce", "balance", "storage_root", "code_hash"]
+
     def __init__(self, nonce, balance, storage_root, code_hash):
         assert isinstance(nonce, int)
         assert isinstance(balance, int)
@@ -106,9 +119,7 @@ class Account:
                 self.balance + amount, self.storage_root, self.code_hash)
 
     def encode(self):
-        v = [rlp.encode_int(self.nonce), rlp.encode_int(self.balance),
-                self.storage_root, self.code_hash]
-        return rlp.encode(v)
+        return ACCOUNT_SCHEMA.encode(self)
 
     def __repr__(self):
         return "Account[%d,%d,%s,%s]" % (self.nonce, self.balance,
@@ -127,13 +138,7 @@ class Account:
 
     @staticmethod
     def decode(v):
-        v = rlp.decode(v)
-        assert isinstance(v, list)
-        assert len(v) == 4
-        return Account(
-                rlp.decode_int(v[0]),
-                rlp.decode_int(v[1]),
-                v[2], v[3])
+        return ACCOUNT_SCHEMA.decode(v)
 
     # Parse an account hex string to a bytes. The string must represent 20 bytes
     # (have 40 characters) and may include an initial "0x".
@@ -142,7 +147,10 @@ class Account:
         return int(hex_address, 16).to_bytes(20, "big")
 
 class Transaction:
-    def __init__(self, nonce, gasPrice, gasLimit, toAddress, value, data, v, r, s):
+    # If "recover_sender" is false, the sender is left as None for the caller
+    # to fill in (see ImportPipeline).
+    def __init__(self, nonce, gasPrice, gasLimit, toAddress, value, data, v, r, s,
+            recover_sender=True):
         self.nonce = nonce
         self.gasPrice = gasPrice
         self.gasLimit = gasLimit
@@ -152,35 +160,27 @@ class Transaction:
         self.v = v
         self.r = r
         self.s = s
-        self.sender = self.compute_sender()
+        self.sender = self.compute_sender() if recover_sender else None
 
     @staticmethod
     def from_list(v):
-        assert isinstance(v, list) or isinstance(v, tuple)
-        assert len(v) == 9
-
-        return Transaction(rlp.decode_int(v[0]), rlp.decode_int(v[1]), rlp.decode_int(v[2]), v[3],
-                rlp.decode_int(v[4]), v[5], rlp.decode_int(v[6]),
-                rlp.decode_int(v[7]), rlp.decode_int(v[8]))
+        return TRANSACTION_SCHEMA.from_list(v)
 
     def transaction_hash(self):
-        data = [
-                rlp.encode_int(self.nonce),
-                rlp.encode_int(self.gasPrice),
-                rlp.encode_int(self.gasLimit),
-                self.toAddress,
-                rlp.encode_int(self.value),
-                self.data,
-        ]
         assert self.v == 27 or self.v == 28 # else we have to add three things to "data".
-        encoded_data = rlp.encode(data)
+        # Hash the fields up to "data", without the signature.
+        encoded_data = TRANSACTION_SCHEMA.encode(self, 6)
         return ethsha3.hash(encoded_data)
 
-    def compute_sender(self):
-        e = int.from_bytes(self.transaction_hash(), "big")
-        pu = ecdsa.recover_public_key(SECP256K1, e, self.v, self.r, self.s)
-        # assert ecdsa.verify_signature(SECP256K1, pu, e, self.v, self.r, self.s)
-        return public_key_to_address(pu)
+    # "transaction_hash" is the transaction_hash(), if already known.
+    def compute_sender(self, transaction_hash=None):
+        with metrics.timer("evm.recover_sender"):
+            if transaction_hash is None:
+                transaction_hash = self.transaction_hash()
+            e = int.from_bytes(transaction_hash, "big")
+            pu = ecdsa.recover_public_key(SECP256K1, e, self.v, self.r, self.s)
+            # assert ecdsa.verify_signature(SECP256K1, pu, e, self.v, self.r, self.s)
+            return public_key_to_address(pu)
 
     def compute_gas(self, block_number):
         is_istanbul = block_number >= ISTANBUL
@@ -220,12 +220,7 @@ class BlockHeader:
 
     @staticmethod
     def from_list(v):
-        assert isinstance(v, list) or isinstance(v, tuple)
-        assert len(v) == 15
-
-        return BlockHeader(v[0], v[1], v[2], v[3], v[4], v[5], v[6], rlp.decode_int(v[7]),
-                rlp.decode_int(v[8]), rlp.decode_int(v[9]), rlp.decode_int(v[10]),
-                rlp.decode_int(v[11]), v[12], v[13], v[14])
+        return HEADER_SCHEMA.from_list(v)
 
     def dump(self, indent=""):
         print(indent + "Block header:")
@@ -234,25 +229,7 @@ class BlockHeader:
             print("%s%s = %s" % (indent, key, dump_string(value, key)))
 
     def compute_hash(self):
-        v = [
-                self.parentHash,
-                self.ommersHash,
-                self.beneficiary,
-                self.stateRoot,
-                self.transactionsRoot,
-                self.receiptsRoot,
-                self.logsBloom,
-                rlp.encode_int(self.difficulty),
-                rlp.encode_int(self.number),
-                rlp.encode_int(self.gasLimit),
-                rlp.encode_int(self.gasUsed),
-                rlp.encode_int(self.timestamp),
-                self.extraData,
-                self.mixHash,
-                self.nonce,
-        ]
-        b = rlp.encode(v)
-        return ethsha3.hash(b)
+        return ethsha3.hash(HEADER_SCHEMA.encode(self))
 
 class Block:
     # https://ethereum.org/en/developers/docs/blocks/
@@ -263,19 +240,28 @@ class Block:
 
     @staticmethod
     def decode(b):
-        v = rlp.decode(b)
-        return Block.from_list(v)
+        return BLOCK_SCHEMA.decode(b)
 
+    # Decode a sequence of RLP-encoded blocks, yielding each one.
     @staticmethod
-    def from_list(v):
-        assert isinstance(v, list) or isinstance(v, tuple)
-        assert len(v) == 3
-
-        header = BlockHeader.from_list(v[0])
-        transactions = [Transaction.from_list(t) for t in v[1]]
-        ommers = [BlockHeader.from_list(h) for h in v[2]]
+    def decode_multiple(b):
+        return BLOCK_SCHEMA.decode_multiple(b)
 
-        return Block(header, transactions, ommers)
+    @staticmethod
+    def from_list(v):
+        return BLOCK_SCHEMA.from_list(v)
+
+    # Check the header's transactionsRoot and ommersHash against the body.
+    # If "transactions_root" is specified, it's the root of the body's
+    # transactions as already computed elsewhere (e.g., by an ImportPipeline
+    # worker).
+    def validate_body(self, transactions_root=None):
+        if transactions_root is None:
+            transactions_root = compute_transactions_root(self.transactions)
+        _check_commitment("transactionsRoot", self.header.number,
+                self.header.transactionsRoot, transactions_root)
+        _check_commitment("ommersHash", self.header.number,
+                self.header.ommersHash, compute_ommers_hash(self.ommers))
 
     def dump(self, indent=""):
         print(indent + "Block %d:" % self.header.number)
@@ -287,8 +273,537 @@ class Block:
             transaction.dump(indent + INDENT)
         print(indent + "Ommers (%d):" % len(self.ommers))
 
+# RLP layouts of the above, in field order.
+ACCOUNT_SCHEMA = rlp.Schema([
+    ("nonce", rlp.INT),
+    ("balance", rlp.INT),
+    ("storage_root", rlp.BYTES),
+    ("code_hash", rlp.BYTES),
+], Account)
+
+TRANSACTION_SCHEMA = rlp.Schema([
+    ("nonce", rlp.INT),
+    ("gasPrice", rlp.INT),
+    ("gasLimit", rlp.INT),
+    ("toAddress", rlp.BYTES),
+    ("value", rlp.INT),
+    ("data", rlp.VIEW),
+    ("v", rlp.INT),
+    ("r", rlp.INT),
+    ("s", rlp.INT),
+], Transaction)
+
+HEADER_SCHEMA = rlp.Schema([
+    ("parentHash", rlp.BYTES),
+    ("ommersHash", rlp.BYTES),
+    ("beneficiary", rlp.BYTES),
+    ("stateRoot", rlp.BYTES),
+    ("transactionsRoot", rlp.BYTES),
+    ("receiptsRoot", rlp.BYTES),
+    ("logsBloom", rlp.BYTES),
+    ("difficulty", rlp.INT),
+    ("number", rlp.INT),
+    ("gasLimit", rlp.INT),
+    ("gasUsed", rlp.INT),
+    ("timestamp", rlp.INT),
+    ("extraData", rlp.BYTES),
+    ("mixHash", rlp.BYTES),
+    ("nonce", rlp.BYTES),
+], BlockHeader)
+
+BLOCK_SCHEMA = rlp.Schema([
+    ("header", HEADER_SCHEMA),
+    ("transactions", rlp.ListOf(TRANSACTION_SCHEMA)),
+    ("ommers", rlp.ListOf(HEADER_SCHEMA)),
+], Block)
+
+# Hash of the RLP encoding of an empty list, i.e., of no ommers.
+EMPTY_OMMERS_HASH = ethsha3.hash(rlp.encode([]))
+
+# Root of the trie of a block's transactions, keyed by the RLP of their index.
+def compute_transactions_root(transactions):
+    if not transactions:
+        return mpt.EMPTY_TREE_ROOT
+    trie = mpt.MerklePatriciaTrie.build(mpt.HashTable(),
+            ((rlp.encode(rlp.encode_int(i)), TRANSACTION_SCHEMA.encode(transaction))
+                for i, transaction in enumerate(transactions)))
+    return trie.root
+
+# Returns the transaction_hash() of each of the transactions, in one batch.
+def compute_transaction_hashes(transactions):
+    for t in transactions:
+        assert t.v == 27 or t.v == 28
+    return ethsha3.hash_many(TRANSACTION_SCHEMA.encode(t, 6) for t in transactions)
+
+def compute_ommers_hash(ommers):
+    if not ommers:
+        return EMPTY_OMMERS_HASH
+    return ethsha3.hash(rlp.encode([HEADER_SCHEMA.to_list(u) for u in ommers]))
+
+# Raise if the header field "name" of block "number", "expected", doesn't
+# match the value "actual" computed from the body.
+def _check_commitment(name, number, expected, actual):
+    if actual != expected:
+        raise Exception("%s mismatch in block %d: expected %s, got %s" % (
+            name, number, expected.hex(), actual.hex()))
+
+# Check that "headers", a sequence of consecutive BlockHeader objects, are
+# linked by their parentHash fields, starting from "parent_hash" if it's
+# specified. Returns the hash of the last header. This needs no state, so
+# it can run far ahead of block execution. If "executor" is specified
+# (e.g., a ProcessPoolExecutor), the headers are hashed by its workers in
+# chunks of "chunk_size".
+def validate_header_chain(headers, parent_hash=None, executor=None, chunk_size=1024):
+    headers = list(headers)
+    chunks = [headers[i:i + chunk_size] for i in range(0, len(headers), chunk_size)]
+    if executor is None:
+        hashes = map(_hash_headers, chunks)
+    else:
+        hashes = executor.map(_hash_headers, chunks)
+
+    previous = None
+    for chunk, chunk_hashes in zip(chunks, hashes):
+        for header, h in zip(chunk, chunk_hashes):
+            if previous is not None and header.number != previous.number + 1:
+                raise Exception("block %d follows block %d" % (header.number, previous.number))
+            if parent_hash is not None and header.parentHash != parent_hash:
+                raise Exception("parentHash mismatch in block %d: expected %s, got %s" % (
+                    header.number, parent_hash.hex(), header.parentHash.hex()))
+            previous = header
+            parent_hash = h
+
+    return parent_hash
+
+# Hash each of the headers. Runs in a worker process.
+def _hash_headers(headers):
+    return ethsha3.hash_many(HEADER_SCHEMA.encode(header) for header in headers)
+
+# Read the mainnet genesis allocations (see genesis.go). Returns a list of
+# (address, wei) tuples.
+def read_genesis_alloc(pathname="genesis_mainnet_alloc.rlp"):
+    with open(pathname, "rb") as f:
+        alloc = rlp.decode(f.read())
+
+    # Rare case where there are leading zero bytes missing in the binary encoding.
+    return [(address.rjust(20, b"\x00"), rlp.decode_int(value)) for address, value in alloc]
+
+# State root of mainnet block 0.
+MAINNET_GENESIS_STATE_ROOT = bytes.fromhex("d7f8974fb5ac78d9ac099b9ad5018bedc2ce0a72dad1827a1709da30580f0544")
+
+# Cache of the mainnet genesis state trie's nodes, written the first time
+# it's built from the allocations. The file is the magic, the root, the
+# number of nodes, each node as its hash, 4-byte length and RLP, and then
+# the SHA-256 of everything after the magic. The checksum catches any
+# corruption without hashing every node with (possibly pure Python) keccak.
+GENESIS_STATE_PATHNAME = "genesis_mainnet_state.bin"
+_GENESIS_STATE_MAGIC = b"GENSTAT3"
+_GENESIS_STATE_CHECKSUM_LENGTH = hashlib.sha256().digest_size
+
+# Build the state trie of the genesis allocations "alloc", a list of
+# (address, wei) tuples, into "store". Returns the root.
+def build_genesis_state(store, alloc):
+    balances = {}
+    for address, value in alloc:
+        balances[address] = balances.get(address, 0) + value
+    state = mpt.MerklePatriciaTrie.build(store,
+            ((address, Account(0, value, mpt.EMPTY_TREE_ROOT, ethsha3.EMPTY_STRING_HASH).encode())
+                for address, value in balances.items()), True)
+    return state.root
+
+# Put the nodes of the mainnet genesis state trie into "store", and return
+# its root. The nodes are read from the cache at "cache_pathname" if it
+# exists and checks out (see read_genesis_state_cache()), or else built from
+# the allocations, checked against the known root, and cached if possible.
+def load_genesis_state(store, alloc_pathname="genesis_mainnet_alloc.rlp",
+        cache_pathname=GENESIS_STATE_PATHNAME):
+
+    nodes = None
+    try:
+        nodes = read_genesis_state_cache(cache_pathname, MAINNET_GENESIS_STATE_ROOT)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print("Rebuilding the genesis state: %s" % e)
+
+    if nodes is None:
+        nodes = mpt.HashTable()
+        root = build_genesis_state(nodes, read_genesis_alloc(alloc_pathname))
+        if root != MAINNET_GENESIS_STATE_ROOT:
+            raise Exception("genesis state root mismatch: expected %s, got %s" % (
+                MAINNET_GENESIS_STATE_ROOT.hex(), root.hex()))
+        try:
+            write_genesis_state_cache(cache_pathname, root, nodes.items())
+        except OSError as e:
+            print("Not caching the genesis state: %s" % e)
+        nodes = dict(nodes.items())
+
+    for k, v in nodes.items():
+        store.set(k, v)
+    return MAINNET_GENESIS_STATE_ROOT
+
+# Write the nodes, (hash, RLP) pairs, of the trie with the root to a cache
+# file for read_genesis_state_cache().
+def write_genesis_state_cache(pathname, root, nodes):
+    nodes = list(nodes)
+    # Write to a temporary file first so that an interrupted write doesn't
+    # leave a truncated cache.
+    checksum = hashlib.sha256()
+    try:
+        with open(pathname + ".tmp", "wb") as f:
+            f.write(_GENESIS_STATE_MAGIC)
+            def write(b):
+                f.write(b)
+                checksum.update(b)
+            write(root)
+            write(len(nodes).to_bytes(8, "big"))
+            for k, v in nodes:
+                write(k)
+                write(len(v).to_bytes(4, "big"))
+                write(v)
+            f.write(checksum.digest())
+        os.replace(pathname + ".tmp", pathname)
+    except BaseException:
+        # Don't leave a partial file behind.
+        try:
+            os.remove(pathname + ".tmp")
+        except OSError:
+            pass
+        raise
+
+# Returns the nodes in the cache file as a map from hash to RLP, after
+# checking the file's checksum and that it holds exactly the nodes of the
+# trie with "expected_root": the root node's hash matches, every node
+# reachable from the root is there, and nothing else. Raises if any check
+# fails.
+def read_genesis_state_cache(pathname, expected_root):
+    with open(pathname, "rb") as f:
+        data = f.read()
+    if data[:len(_GENESIS_STATE_MAGIC)] != _GENESIS_STATE_MAGIC:
+        raise Exception("%s is not a genesis state cache" % pathname)
+    index = len(_GENESIS_STATE_MAGIC)
+    end = len(data) - _GENESIS_STATE_CHECKSUM_LENGTH
+    if end < index or hashlib.sha256(data[index:end]).digest() != data[end:]:
+        raise Exception("%s is truncated or corrupt (checksum mismatch)" % pathname)
+    data = data[:end]
+    root = data[index:index + ethsha3.ETHSHA3_LENGTH]
+    if root != expected_root:
+        raise Exception("%s has the wrong genesis state root %s" % (pathname, root.hex()))
+    index += ethsha3.ETHSHA3_LENGTH
+    count = int.from_bytes(data[index:index + 8], "big")
+    index += 8
+
+    nodes = {}
+    while index < len(data):
+        if index + ethsha3.ETHSHA3_LENGTH + 4 > len(data):
+            raise Exception("%s is truncated" % pathname)
+        k = data[index:index + ethsha3.ETHSHA3_LENGTH]
+        index += ethsha3.ETHSHA3_LENGTH
+        length = int.from_bytes(data[index:index + 4], "big")
+        index += 4
+        if index + length > len(data):
+            raise Exception("%s is truncated" % pathname)
+        nodes[k] = data[index:index + length]
+        index += length
+    if len(nodes) != count:
+        raise Exception("%s has %d nodes, expected %d" % (pathname, len(nodes), count))
+
+    if root in nodes and ethsha3.hash(nodes[root]) != root:
+        raise Exception("%s has a corrupt node %s" % (pathname, root.hex()))
+
+    reachable = _reachable_nodes(nodes, root)
+    if len(reachable) != len(nodes):
+        raise Exception("%s has %d nodes that aren't in the trie" % (pathname,
+            len(nodes) - len(reachable)))
+    return nodes
+
+# Returns the set of hashes of the stored nodes of the trie with the root,
+# whose nodes are in "nodes", a map from hash to RLP. Raises if one is missing
+# or can't be decoded.
+def _reachable_nodes(nodes, root):
+    reachable = set()
+    # Stack of hashes and inline nodes.
+    stack = [root]
+    while stack:
+        v = stack.pop()
+        if not isinstance(v, list):
+            if v in reachable:
+                continue
+            b = nodes.get(v)
+            if b is None:
+                raise Exception("trie node %s is missing" % v.hex())
+            reachable.add(v)
+            try:
+                v = rlp.decode(b)
+            except Exception:
+                raise Exception("trie node %s can't be decoded" % v.hex())
+        if len(v) == 17:
+            children = v[:16]
+        elif len(v) == 2:
+            children = [] if mpt._is_leaf(v[0]) else [v[1]]
+        else:
+            raise Exception("trie node has %d items" % len(v))
+        for child in children:
+            if isinstance(child, list) or len(child) == ethsha3.ETHSHA3_LENGTH:
+                stack.append(child)
+            elif len(child) != 0:
+                raise Exception("bad trie node reference %s" % child.hex())
+    return reachable
+
+# Write a checkpoint from EthereumVirtualMachine.checkpoint() as a snapshot
+# file that EthereumVirtualMachine.load_snapshot() can read.
+def write_checkpoint(pathname, checkpoint):
+    head_block_number, head_block_hash, state_root, state_roots, hash_table, hot_code = checkpoint
+    snapshot = {
+            "head_block_number": head_block_number,
+            "head_block_hash": head_block_hash.hex(),
+            "state_hash": state_root.hex(),
+            "state_roots": {str(number): root.hex() for number, root in state_roots.items()},
+            "hash_table": hash_table.as_string_dict(),
+            "hot_code": [code_hash.hex() for code_hash in hot_code],
+    }
+
+    with open(pathname, "w") as f:
+        json.dump(snapshot, f)
+
+# Number of decoded trie nodes cached for StateView reads.
+NODE_CACHE_SIZE = 100000
+
+# Number of most called contracts whose hashes are saved in snapshots, to
+# be decoded ahead of time when the snapshot is loaded.
+HOT_CODE_COUNT = 256
+
+# Number of contracts whose storage (trie and cached slots) stays in memory
+# between blocks, so that hot contracts are read from their tries once.
+STORAGE_CACHE_SIZE = 10000
+
+# Most slots cached for one contract. Past that, its cache starts over.
+STORAGE_SLOT_CACHE_SIZE = 100000
+
+# Storage tries are secured tries from the 32-byte big-endian slot number to
+# the RLP of the value with leading zeros stripped. Unset slots are zero,
+# and setting a slot to zero removes it.
+def _storage_key(slot):
+    return slot.to_bytes(32, "big")
+
+def _encode_storage_value(value):
+    return rlp.encode(rlp.encode_int(value))
+
+def _decode_storage_value(b):
+    return rlp.decode_int(rlp.decode(b)) if b != mpt.NO_VALUE else 0
+
+# Storage of one contract. Its trie is opened on first use, and slots are
+# cached as they're read. Writes are kept in "dirty" until commit().
+class AccountStorage:
+    __slots__ = ["store", "node_cache", "root", "_trie", "slots", "slot_cache_size", "dirty"]
+
+    def __init__(self, store, storage_root, node_cache=None,
+            slot_cache_size=STORAGE_SLOT_CACHE_SIZE):
+        self.store = store
+        self.node_cache = node_cache
+        # Storage root as of the last commit.
+        self.root = storage_root
+        self._trie = None
+        # Committed values of slots by slot, including zeros. Once it has
+        # "slot_cache_size" slots, it starts over.
+        self.slots = {}
+        self.slot_cache_size = slot_cache_size
+        # Values written since the last commit, by slot.
+        self.dirty = {}
+
+    @property
+    def trie(self):
+        if self._trie is None:
+            if metrics.enabled:
+                metrics.count("storage.tries_opened")
+            root = mpt.NO_HASH if self.root == mpt.EMPTY_TREE_ROOT else self.root
+            self._trie = mpt.MerklePatriciaTrie(self.store, root, True, self.node_cache)
+        return self._trie
+
+    def get(self, slot):
+        value = self.dirty.get(slot)
+        if value is None:
+            value = self.get_committed(slot)
+        return value
+
+    # Returns the value of the slot as of the last commit.
+    def get_committed(self, slot):
+        value = self.slots.get(slot)
+        if value is None:
+            if metrics.enabled:
+                metrics.count("storage.trie_reads")
+            value = _decode_storage_value(self.trie.get(_storage_key(slot)))
+            self._cache_slot(slot, value)
+        return value
+
+    def _cache_slot(self, slot, value):
+        if len(self.slots) >= self.slot_cache_size and slot not in self.slots:
+            self.slots.clear()
+        self.slots[slot] = value
+
+    # Write the dirty slots to the trie. Returns the new storage root.
+    def commit(self):
+        trie = self.trie
+        for slot, value in sorted(self.dirty.items()):
+            if value == 0:
+                trie = trie.delete(_storage_key(slot))
+            else:
+                trie = trie.set(_storage_key(slot), _encode_storage_value(value))
+            self._cache_slot(slot, value)
+        self.dirty = {}
+        self._trie = trie
+        self.root = mpt.EMPTY_TREE_ROOT if trie.root == mpt.NO_HASH else trie.root
+        return self.root
+
+# Storage of all contracts, as seen by the block being processed. Storage
+# stays open across blocks for the most recently used contracts. Each write
+# is journaled until the end of its transaction, so that a failed
+# transaction or call can be undone with revert(). Writes are only put in
+# the tries by commit(), for all contracts at once.
+class StorageCache:
+    # "get_storage_root" is a function from an address to the storage root
+    # of its account, called when a contract's storage is first opened.
+    def __init__(self, store, get_storage_root, node_cache=None, capacity=STORAGE_CACHE_SIZE,
+            slot_cache_size=STORAGE_SLOT_CACHE_SIZE):
+        self.store = store
+        self.get_storage_root = get_storage_root
+        self.node_cache = node_cache
+        self.accounts = cache.LruCache(capacity)
+        self.slot_cache_size = slot_cache_size
+        # AccountStorage objects written since the last commit, by address.
+        # They stay here even if evicted from "accounts".
+        self.dirty = {}
+        # (AccountStorage, slot, previous dirty value or None) for each
+        # write of the current transaction.
+        self.journal = []
+
+    # Returns the AccountStorage of the address.
+    def open(self, address):
+        storage = self.dirty.get(address)
+        if storage is None:
+            storage = self.accounts.get(address)
+            if storage is None:
+                storage = AccountStorage(self.store, self.get_storage_root(address),
+                        self.node_cache, self.slot_cache_size)
+                self.accounts.set(address, storage)
+        return storage
+
+    def get(self, address, slot):
+        return self.open(address).get(slot)
+
+    def set(self, address, slot, value):
+        assert 0 <= value < 2**256
+        storage = self.open(address)
+        self.journal.append((storage, slot, storage.dirty.get(slot)))
+        storage.dirty[slot] = value
+        self.dirty[address] = storage
+
+    # Returns a marker to pass to revert().
+    def snapshot(self):
+        return len(self.journal)
+
+    # Undo the writes made since snapshot() returned "marker".
+    def revert(self, marker):
+        journal = self.journal
+        while len(journal) > marker:
+            storage, slot, value = journal.pop()
+            if value is None:
+                del storage.dirty[slot]
+            else:
+                storage.dirty[slot] = value
+
+    # Make the current transaction's writes final.
+    def end_transaction(self):
+        self.journal = []
+
+    # Write the dirty slots of all contracts to their tries. Returns a list
+    # of (address, new storage root) for the contracts whose storage changed.
+    def commit(self):
+        self.journal = []
+        roots = []
+        for address, storage in self.dirty.items():
+            if storage.dirty:
+                old_root = storage.root
+                new_root = storage.commit()
+                if new_root != old_root:
+                    roots.append((address, new_root))
+        self.dirty = {}
+        return roots
+
+    # Forget the contract, e.g., when it's destroyed. Its uncommitted writes
+    # are dropped.
+    def discard(self, address):
+        self.dirty.pop(address, None)
+        self.accounts.delete(address)
+
+    # Forget everything, e.g., when the state is replaced.
+    def clear(self):
+        self.accounts.clear()
+        self.dirty = {}
+        self.journal = []
+
+# Read-only view of the accounts as of a given block. Trie nodes are never
+# modified or removed, so a view stays valid while more blocks are
+# processed, and can be read from any thread.
+class StateView:
+    def __init__(self, state, block_number):
+        self.state = state
+        self.block_number = block_number
+
+    @property
+    def root(self):
+        return self.state.root
+
+    # Returns the value of the storage slot of the contract at the address,
+    # or 0 if it's not set.
+    def get_storage(self, address, slot):
+        account = self.get_account(address)
+        if account is None or account.storage_root == mpt.EMPTY_TREE_ROOT:
+            return 0
+        trie = mpt.MerklePatriciaTrie(self.state.key_value_store, account.storage_root, True,
+                self.state.node_cache)
+        return _decode_storage_value(trie.get(_storage_key(slot)))
+
+    # Returns the code of the account at the address.
+    def get_code(self, address):
+        account = self.get_account(address)
+        if account is None or account.code_hash == ethsha3.EMPTY_STRING_HASH:
+            return b""
+        return bytes(self.state.key_value_store.get(account.code_hash))
+
+    # Returns the Account at the address, or None if there's none.
+    def get_account(self, address):
+        b = self.state.get(address)
+        if b is mpt.NO_VALUE:
+            return None
+        else:
+            return Account.decode(b)
+
+    def get_balance(self, address):
+        account = self.get_account(address)
+        return account.balance if account is not None else 0
+
+    def get_nonce(self, address):
+        account = self.get_account(address)
+        return account.nonce if account is not None else 0
+
+    # Yields (hashed address, old Account, new Account) for each account
+    # that differs between this view and "other", with None for a missing
+    # account.
+    def diff(self, other):
+        for key, old_value, new_value in self.state.diff(other.state):
+            old_account = Account.decode(old_value) if old_value != mpt.NO_VALUE else None
+            new_account = Account.decode(new_value) if new_value != mpt.NO_VALUE else None
+            yield key, old_account, new_account
+
 class EthereumVirtualMachine:
-    def __init__(self):
+    # If "genesis_alloc" is specified, it's a list of (address, wei) tuples
+    # credited in block 0 instead of the mainnet allocations.
+    # "retained_blocks" is the number of most recent blocks whose state can
+    # be viewed with state_at(), or None for all of them.
+    def __init__(self, genesis_alloc=None, retained_blocks=None):
+        self.genesis_alloc = genesis_alloc
+        self.retained_blocks = retained_blocks
+
         # Underlying storage.
         self.hash_table = mpt.HashTable()
 
@@ -300,15 +815,61 @@ class EthereumVirtualMachine:
 
         self.head_block_hash = ethsha3.ZERO_HASH
 
+        # Map from block number to the state root after that block, for
+        # the retained blocks, oldest first.
+        self.state_roots = {}
+
+        # Decoded nodes for StateView reads, shared by all threads.
+        self.node_cache = cache.LruCache(NODE_CACHE_SIZE)
+
+        # Storage of contracts, in the same store as the state.
+        self.storage = StorageCache(self.hash_table, self._get_storage_root, self.node_cache)
+
+        # Code of contracts, also in the same store.
+        self.code_store = evm.CodeStore(self.hash_table)
+
     def should_skip_block(self, number):
         return self.head_block_number is not None and number <= self.head_block_number
 
-    def process_block(self, b):
+    # Process the block "b" on top of the current head. If "validated" is
+    # true, the caller has already checked the body against the header
+    # (see Block.validate_body() and ImportPipeline).
+    def process_block(self, b, validated=False):
         assert self.head_block_number is None or b.header.number == self.head_block_number + 1
         assert b.header.parentHash == self.head_block_hash
 
-        print(b.header.number, len(b.transactions), len(b.ommers), b.header.beneficiary == EMPTY_ADDRESS) # TODO delete
+        if metrics.enabled:
+            metrics.block_started(b.header.number)
+            begin = time.perf_counter()
+
+        if not validated:
+            with metrics.timer("evm.validate_body"):
+                b.validate_body()
+
+        parent_state = self.state
+        self.apply_block(b)
+        self.head_block_hash = b.header.compute_hash()
+
+        if metrics.enabled:
+            metrics.record("evm.block", time.perf_counter() - begin)
+            metrics.count("evm.blocks")
+            metrics.count("evm.transactions", len(b.transactions))
+            metrics.block_finished(b.header.number)
+
+        if b.header.stateRoot != self.state.root:
+            print("State root mismatch in block %d: expected %s, got %s" % (b.header.number,
+                b.header.stateRoot.hex(), self.state.root.hex()))
+            self.dump_state_diff(parent_state)
+        assert b.header.stateRoot == self.state.root
+        # Retain the root first, so that other threads can always get
+        # state_at(head_block_number).
+        self._retain_state_root(b.header.number, self.state.root)
+        self.head_block_number = b.header.number
 
+    # Apply the block's transactions and rewards to the state. Unlike
+    # process_block(), doesn't check or update the head of the chain, and
+    # doesn't check the header's stateRoot.
+    def apply_block(self, b):
         # The genesis block has implicit hard-coded transactions.
         if b.header.number == 0:
             assert len(b.transactions) == 0
@@ -318,19 +879,14 @@ class EthereumVirtualMachine:
             assert b.header.transactionsRoot == mpt.EMPTY_TREE_ROOT
             assert b.header.receiptsRoot == mpt.EMPTY_TREE_ROOT
 
-            # Read genesis allocations. See genesis.go.
-            alloc = rlp.decode(open("genesis_mainnet_alloc.rlp", "rb").read())
-            print("Adding %d genesis transactions..." % len(alloc))
-            total = 0
-            for address, value in alloc:
-                # Rare case where there are leading zero bytes missing in the binary encoding.
-                address = address.rjust(20, b"\x00")
-
-                # Process fake transaction.
-                value = rlp.decode_int(value)
-                self.add_value_to_account(address, value, False)
-                total += value
-            print("Total eth distributed: %d eth" % (total/WEI_PER_ETHER))
+            # The allocations are the first accounts in the state.
+            assert self.state.root == mpt.NO_HASH
+            if self.genesis_alloc is None:
+                root = load_genesis_state(self.hash_table)
+            else:
+                root = build_genesis_state(self.hash_table, self.genesis_alloc)
+            self.state = mpt.MerklePatriciaTrie(self.hash_table, root, True)
+            self.storage.clear()
 
         # Process transactions.
         block_gas = 0
@@ -342,8 +898,9 @@ class EthereumVirtualMachine:
             self.add_value_to_account(transaction.sender, -(transaction.value + gasFee), True)
             self.add_value_to_account(transaction.toAddress, transaction.value, False)
             self.add_value_to_account(b.header.beneficiary, gasFee, False)
-        print("block gas", block_gas, b.header.gasUsed)
+            self.storage.end_transaction()
         assert block_gas == b.header.gasUsed
+        self.commit_storage()
 
         # Reward miner of this block.
         r_block = 5 if b.header.number < BYZANTIUM else 3 if b.header.number < CONSTANTINOPLE else 2
@@ -359,22 +916,40 @@ class EthereumVirtualMachine:
             if r != 0:
                 self.add_value_to_account(u.beneficiary, r, False)
 
-        self.head_block_hash = b.header.compute_hash()
-
-        print("state", "official", b.header.stateRoot.hex(), "mine", self.state.root.hex()) # TODO delete
-        assert b.header.stateRoot == self.state.root
-        self.head_block_number = b.header.number
+    # Returns a StateView of the state after the block number, which must
+    # be one of the retained blocks. Safe to call from any thread while
+    # another thread processes blocks.
+    def state_at(self, block_number):
+        root = self.state_roots.get(block_number)
+        if root is None:
+            raise Exception("state of block %d is not retained" % block_number)
+        return StateView(mpt.MerklePatriciaTrie(self.hash_table, root, True, self.node_cache),
+                block_number)
+
+    # Returns a StateView of the current state. Must be called from the
+    # thread that processes blocks, since the state changes during a block;
+    # other threads should use state_at(head_block_number).
+    def head_state(self):
+        return StateView(self.state, self.head_block_number)
+
+    def _retain_state_root(self, block_number, root):
+        self.state_roots[block_number] = root
+        if self.retained_blocks is not None:
+            while len(self.state_roots) > self.retained_blocks:
+                del self.state_roots[next(iter(self.state_roots))]
 
     def save_snapshot(self, pathname):
-        snapshot = {
-                "head_block_number": self.head_block_number,
-                "head_block_hash": self.head_block_hash.hex(),
-                "state_hash": self.state.root.hex(),
-                "hash_table": self.hash_table.as_string_dict(),
-        }
-
-        with open(pathname, "w") as f:
-            json.dump(snapshot, f)
+        write_checkpoint(pathname, self.checkpoint())
+
+    # Capture the state that save_snapshot() writes, as a tuple that
+    # write_checkpoint() can save later (e.g., from another thread) while
+    # this object keeps processing blocks. Takes constant time in the size
+    # of the store, which is only viewed (see mpt.HashTable.view()), but the
+    # checkpoint is invalid once load_snapshot() is called.
+    def checkpoint(self):
+        return (self.head_block_number, self.head_block_hash, self.state.root,
+                dict(self.state_roots), self.hash_table.view(),
+                self.code_store.most_called(HOT_CODE_COUNT))
 
     def load_snapshot(self, pathname):
         with open(pathname) as f:
@@ -385,16 +960,29 @@ class EthereumVirtualMachine:
         self.hash_table.replace_with_string_dict(snapshot["hash_table"])
         state_hash = bytes.fromhex(snapshot["state_hash"])
         self.state = mpt.MerklePatriciaTrie(self.hash_table, state_hash, True)
+        self.storage.clear()
+
+        # Older snapshots only have the head's state.
+        self.state_roots = {}
+        state_roots = snapshot.get("state_roots", {str(self.head_block_number): snapshot["state_hash"]})
+        for number, root in state_roots.items():
+            self._retain_state_root(int(number), bytes.fromhex(root))
+
+        self.code_store.preload(bytes.fromhex(h) for h in snapshot.get("hot_code", []))
 
     def add_value_to_account(self, address, value, bumpNonce):
-        account = self.get_account(address)
-        if account is None:
+        # Hash the address once for both the get and the set.
+        key = mpt.hash_secured_key(address)
+        b = self.state.get_hashed(key)
+        if b is mpt.NO_VALUE:
             account = Account(0, 0, mpt.EMPTY_TREE_ROOT, ethsha3.EMPTY_STRING_HASH)
+        else:
+            account = Account.decode(b)
         if value > 0:
             account = account.credit(value, bumpNonce)
         else:
             account = account.debit(-value, bumpNonce)
-        self.state = self.state.set(address, account.encode())
+        self.state = self.state.set_hashed(key, account.encode())
 
     def get_account(self, address):
         b = self.state.get(address)
@@ -403,10 +991,68 @@ class EthereumVirtualMachine:
         else:
             return Account.decode(b)
 
+    # Returns the value of the contract's storage slot as seen by the
+    # current transaction, including its uncommitted writes.
+    def get_storage(self, address, slot):
+        return self.storage.get(address, slot)
+
+    def set_storage(self, address, slot, value):
+        self.storage.set(address, slot, value)
+
+    # Write the storage changed since the last commit to the contracts'
+    # tries, and their new roots to their accounts.
+    def commit_storage(self):
+        with metrics.timer("evm.commit_storage"):
+            for address, root in self.storage.commit():
+                key = mpt.hash_secured_key(address)
+                b = self.state.get_hashed(key)
+                if b is mpt.NO_VALUE:
+                    account = Account(0, 0, root, ethsha3.EMPTY_STRING_HASH)
+                else:
+                    account = Account.decode(b)
+                    account = Account(account.nonce, account.balance, root, account.code_hash)
+                self.state = self.state.set_hashed(key, account.encode())
+
+    # Returns the code of the account at the address.
+    def get_code(self, address):
+        account = self.get_account(address)
+        return self.code_store.get(account.code_hash if account is not None
+                else ethsha3.EMPTY_STRING_HASH)
+
+    # Returns the evm.DecodedCode of the account at the address, to run it.
+    def get_decoded_code(self, address):
+        account = self.get_account(address)
+        return self.code_store.get_decoded(account.code_hash if account is not None
+                else ethsha3.EMPTY_STRING_HASH)
+
+    # Store the code, and make it the code of the account at the address.
+    def set_code(self, address, code):
+        code_hash = self.code_store.put(code)
+        key = mpt.hash_secured_key(address)
+        b = self.state.get_hashed(key)
+        if b is mpt.NO_VALUE:
+            account = Account(0, 0, mpt.EMPTY_TREE_ROOT, code_hash)
+        else:
+            account = Account.decode(b)
+            account = Account(account.nonce, account.balance, account.storage_root, code_hash)
+        self.state = self.state.set_hashed(key, account.encode())
+
+    def _get_storage_root(self, address):
+        account = self.get_account(address)
+        return account.storage_root if account is not None else mpt.EMPTY_TREE_ROOT
+
     def dump_account(self, address):
         account = self.get_account(address)
         print("0x%s = %s" % (address.hex(), account))
 
+    # Print the accounts that differ between the "old_state" trie and the
+    # current state. Addresses are shown hashed, as they're stored in the trie.
+    def dump_state_diff(self, old_state, indent=""):
+        print("%sState changes:" % indent)
+        indent += INDENT
+        for key, old_account, new_account in StateView(old_state, None).diff(self.head_state()):
+            print("%s0x%s: %s -> %s" % (indent, key.hex(), old_account, new_account))
+
     def dump(self, indent=""):
         print("%sEthereumVirtualMachine:" % indent)
         indent += INDENT
@@ -414,3 +1060,587 @@ class EthereumVirtualMachine:
         print("%sEntries in hash table: %d" % (indent, len(self.hash_table)))
         # print("%sEntries in state: %d" % (indent, len(self.state)))
 
+
+# Block decoding that leaves transaction senders unrecovered.
+_UNRECOVERED_BLOCK_SCHEMA = rlp.Schema([
+    ("header", HEADER_SCHEMA),
+    ("transactions", rlp.ListOf(TRANSACTION_SCHEMA.with_record_type(
+        lambda *values: Transaction(*values, recover_sender=False)))),
+    ("ommers", rlp.ListOf(HEADER_SCHEMA)),
+], Block)
+
+# How ImportPipeline starts its worker processes: "forkserver" where
+# available, since it starts them without forking the threaded importer.
+_WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() \
+        else "spawn"
+
+# Marks the end of the blocks in a pipeline queue.
+_END = object()
+
+# Recover the senders of the transactions of block "number", given as lists
+# of their fields, and check them against the header's "transactions_root".
+# Returns the senders. Runs in a worker process.
+def _recover_senders(number, transactions_root, transaction_fields):
+    transactions = [Transaction(*fields, recover_sender=False) for fields in transaction_fields]
+    _check_commitment("transactionsRoot", number, transactions_root,
+            compute_transactions_root(transactions))
+    hashes = compute_transaction_hashes(transactions)
+    return [t.compute_sender(h) for t, h in zip(transactions, hashes)]
+
+# Counters for one stage of the ImportPipeline.
+class PipelineStage:
+    def __init__(self, name):
+        self.name = name
+        # Blocks and transactions that went through this stage.
+        self.blocks = 0
+        self.transactions = 0
+        # Seconds spent doing work.
+        self.busy_time = 0
+        # Seconds spent waiting for the previous stage.
+        self.input_wait_time = 0
+        # Seconds spent waiting for room in the next stage's queue (backpressure).
+        self.output_wait_time = 0
+
+    def blocks_per_second(self):
+        return self.blocks/self.busy_time if self.busy_time > 0 else 0
+
+    def as_dict(self):
+        return {
+                "blocks": self.blocks,
+                "transactions": self.transactions,
+                "busy_time": self.busy_time,
+                "input_wait_time": self.input_wait_time,
+                "output_wait_time": self.output_wait_time,
+                "blocks_per_second": self.blocks_per_second(),
+        }
+
+    def __repr__(self):
+        return "%-8s %8d blocks %10.1f blocks/sec busy, waited %.2f s for input, %.2f s for output" % (
+                self.name, self.blocks, self.blocks_per_second(),
+                self.input_wait_time, self.output_wait_time)
+
+# Imports blocks into an EthereumVirtualMachine as four concurrent stages
+# connected by bounded queues:
+#
+#   decode:  RLP-decode blocks from the binary file, and check that their
+#            headers form a chain (thread, hashing headers in the pool).
+#   recover: recover transaction senders and check the bodies against
+#            the headers, in parallel across worker processes since the
+#            ECDSA math is pure Python (thread plus pool).
+#   execute: process blocks in order (the calling thread).
+#   flush:   write snapshots (thread).
+#
+# When a queue is full the stage feeding it waits, so a slow stage
+# throttles the ones before it instead of buffering the whole chain.
+# Execution only waits if decoding or recovery fall behind, and snapshots
+# are captured in constant time between blocks and written in the
+# background. If writing a snapshot takes longer than executing
+# "snapshot_interval" blocks, the next one is skipped.
+class ImportPipeline:
+    # "workers" is the number of sender recovery processes, or 0 to recover
+    # senders in the recover thread. "queue_size" is the number of blocks
+    # each queue can hold. If "snapshot_pathname" is specified, a snapshot is
+    # written every "snapshot_interval" blocks and after the last block.
+    def __init__(self, evm, workers=None, queue_size=64, snapshot_pathname=None,
+            snapshot_interval=1000):
+        self.evm = evm
+        self.workers = workers
+        self.queue_size = queue_size
+        self.snapshot_pathname = snapshot_pathname
+        self.snapshot_interval = snapshot_interval
+
+        self.decode_stage = PipelineStage("decode")
+        self.recover_stage = PipelineStage("recover")
+        self.execute_stage = PipelineStage("execute")
+        self.flush_stage = PipelineStage("flush")
+        self.stages = [self.decode_stage, self.recover_stage, self.execute_stage, self.flush_stage]
+
+        self._recover_queue = queue.Queue(queue_size)
+        self._execute_queue = queue.Queue(queue_size)
+        # Holds the next checkpoint to write. A checkpoint that comes while
+        # the previous one is still waiting is skipped rather than wait.
+        self._flush_queue = queue.Queue(1)
+        # Checkpoints skipped because the flush stage was behind.
+        self.skipped_snapshots = 0
+        self._stop = threading.Event()
+        self._errors = []
+
+    # Import the concatenated RLP-encoded blocks in blocks_binary, skipping
+    # those the EthereumVirtualMachine already has. If "on_block" is
+    # specified, it's called with each block after it's been processed.
+    def run(self, blocks_binary, on_block=None):
+        executor = None
+        if self.workers != 0:
+            # Workers start on the first submit(), from the decode thread while
+            # the other stages run. Forking a threaded process can deadlock
+            # the child on a lock another thread held, so start them from a
+            # clean server process instead.
+            executor = concurrent.futures.ProcessPoolExecutor(self.workers,
+                    mp_context=multiprocessing.get_context(_WORKER_START_METHOD))
+
+        threads = [
+            threading.Thread(target=self._run_stage, args=(self._decode, blocks_binary, executor)),
+            threading.Thread(target=self._run_stage, args=(self._recover, executor)),
+            threading.Thread(target=self._run_stage, args=(self._flush,)),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            self._execute(on_block)
+        except BaseException as e:
+            self._errors.append(e)
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        if self._errors:
+            raise self._errors[0]
+
+    # Queue depths, to see where blocks pile up.
+    def queue_sizes(self):
+        return {
+                "recover": self._recover_queue.qsize(),
+                "execute": self._execute_queue.qsize(),
+                "flush": self._flush_queue.qsize(),
+        }
+
+    def as_dict(self):
+        return {stage.name: stage.as_dict() for stage in self.stages}
+
+    def dump(self, indent=""):
+        print("%sImport pipeline:" % indent)
+        for stage in self.stages:
+            print("%s%s%s" % (indent, INDENT, stage))
+        if self.skipped_snapshots > 0:
+            print("%s%sSkipped %d snapshots" % (indent, INDENT, self.skipped_snapshots))
+
+    def _run_stage(self, stage, *args):
+        try:
+            stage(*args)
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    # Headers are checked in batches of "queue_size" blocks, which are
+    # passed on once their batch checks out.
+    def _decode(self, blocks_binary, executor):
+        stage = self.decode_stage
+        parent_hash = self.evm.head_block_hash
+        batch = []
+        begin = time.perf_counter()
+        for b in itertools.chain(_UNRECOVERED_BLOCK_SCHEMA.decode_multiple(blocks_binary), [_END]):
+            if b is not _END:
+                if self.evm.should_skip_block(b.header.number):
+                    continue
+                batch.append(b)
+                stage.blocks += 1
+                stage.transactions += len(b.transactions)
+                if len(batch) < self.queue_size:
+                    continue
+
+            if batch:
+                parent_hash = validate_header_chain((b.header for b in batch), parent_hash, executor)
+            stage.busy_time += time.perf_counter() - begin
+            for block in batch:
+                if not self._put(self._recover_queue, block, stage):
+                    return
+            batch = []
+            begin = time.perf_counter()
+        self._put(self._recover_queue, _END, stage)
+
+    def _recover(self, executor):
+        stage = self.recover_stage
+        while True:
+            b = self._get(self._recover_queue, stage)
+            if b is None:
+                return
+            if b is _END:
+                self._put(self._execute_queue, _END, stage)
+                return
+
+            begin = time.perf_counter()
+            _check_commitment("ommersHash", b.header.number, b.header.ommersHash,
+                    compute_ommers_hash(b.ommers))
+            transaction_fields = [[t.nonce, t.gasPrice, t.gasLimit, t.toAddress, t.value,
+                bytes(t.data), t.v, t.r, t.s] for t in b.transactions]
+            args = (b.header.number, b.header.transactionsRoot, transaction_fields)
+            if executor is None:
+                senders = concurrent.futures.Future()
+                senders.set_result(_recover_senders(*args))
+            else:
+                senders = executor.submit(_recover_senders, *args)
+            stage.blocks += 1
+            stage.transactions += len(b.transactions)
+            stage.busy_time += time.perf_counter() - begin
+
+            if not self._put(self._execute_queue, (b, senders), stage):
+                return
+
+    def _execute(self, on_block):
+        stage = self.execute_stage
+        evm = self.evm
+        while True:
+            item = self._get(self._execute_queue, stage)
+            if item is None:
+                return
+            if item is _END:
+                break
+            b, senders = item
+
+            # Waiting for signature math counts as waiting for input.
+            begin = time.perf_counter()
+            senders = senders.result()
+            stage.input_wait_time += time.perf_counter() - begin
+
+            begin = time.perf_counter()
+            for transaction, sender in zip(b.transactions, senders):
+                transaction.sender = sender
+            evm.process_block(b, True)
+            stage.blocks += 1
+            stage.transactions += len(b.transactions)
+
+            checkpoint = None
+            if self.snapshot_pathname is not None and \
+                    b.header.number % self.snapshot_interval == 0:
+                checkpoint = evm.checkpoint()
+            stage.busy_time += time.perf_counter() - begin
+
+            if checkpoint is not None:
+                try:
+                    self._flush_queue.put_nowait(checkpoint)
+                except queue.Full:
+                    self.skipped_snapshots += 1
+            if on_block is not None:
+                on_block(b)
+
+        if self.snapshot_pathname is not None and stage.blocks > 0:
+            self._put(self._flush_queue, evm.checkpoint(), stage)
+        self._put(self._flush_queue, _END, stage)
+
+    def _flush(self):
+        stage = self.flush_stage
+        while True:
+            checkpoint = self._get(self._flush_queue, stage)
+            if checkpoint is None or checkpoint is _END:
+                return
+            begin = time.perf_counter()
+            write_checkpoint(self.snapshot_pathname, checkpoint)
+            stage.blocks += 1
+            stage.busy_time += time.perf_counter() - begin
+
+    # Put the item into the queue, waiting for room. Returns False if the
+    # pipeline was stopped in the meantime.
+    def _put(self, q, item, stage):
+        begin = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            stage.output_wait_time += time.perf_counter() - begin
+
+    # Get the next item from the queue, or None if the pipeline was stopped.
+    def _get(self, q, stage):
+        begin = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+        finally:
+            stage.input_wait_time += time.perf_counter() - begin
+
+def _genesis_state_cache_tests():
+    import tempfile
+
+    alloc = [(i.to_bytes(20, "big"), i*WEI_PER_ETHER) for i in range(1, 50)]
+    nodes = mpt.HashTable()
+    root = build_genesis_state(nodes, alloc)
+    items = list(nodes.items())
+
+    def expect_failure(pathname, message):
+        try:
+            read_genesis_state_cache(pathname, root)
+        except Exception as e:
+            assert message in str(e), e
+            return
+        raise Exception("expected a failure with " + message)
+
+    with tempfile.TemporaryDirectory() as directory:
+        pathname = os.path.join(directory, "state.bin")
+        write_genesis_state_cache(pathname, root, items)
+        assert read_genesis_state_cache(pathname, root) == dict(items)
+        try:
+            read_genesis_state_cache(pathname, ethsha3.ZERO_HASH)
+            raise Exception("expected a failure with the wrong root")
+        except Exception as e:
+            assert "wrong genesis state root" in str(e), e
+
+        # Any truncation or changed byte fails the checksum, including in
+        # nodes other than the root.
+        with open(pathname, "rb") as f:
+            data = f.read()
+        last_length = ethsha3.ETHSHA3_LENGTH + 4 + len(items[-1][1]) + _GENESIS_STATE_CHECKSUM_LENGTH
+        for length in (len(data) - 1, len(data) - 40, len(data) - last_length, 20):
+            with open(pathname, "wb") as f:
+                f.write(data[:length])
+            expect_failure(pathname, "checksum mismatch")
+        first_node = len(_GENESIS_STATE_MAGIC) + ethsha3.ETHSHA3_LENGTH + 8
+        for index in (first_node + ethsha3.ETHSHA3_LENGTH + 4 + len(items[0][1]) - 1,
+                len(data) - 1):
+            with open(pathname, "wb") as f:
+                f.write(data[:index] + bytes([data[index] ^ 1]) + data[index + 1:])
+            expect_failure(pathname, "checksum mismatch")
+
+        # Corrupt root.
+        corrupt = [(k, v[:-1] + bytes([v[-1] ^ 1]) if k == root else v) for k, v in items]
+        write_genesis_state_cache(pathname, root, corrupt)
+        expect_failure(pathname, "corrupt node")
+
+        # Missing and extra nodes, with a consistent count.
+        write_genesis_state_cache(pathname, root, [(k, v) for k, v in items if k != items[0][0]])
+        expect_failure(pathname, "is missing")
+        extra = rlp.encode([b"\x20", b"extra"])
+        write_genesis_state_cache(pathname, root, items + [(ethsha3.hash(extra), extra)])
+        expect_failure(pathname, "aren't in the trie")
+
+        # A failed write leaves nothing behind.
+        missing = os.path.join(directory, "missing", "state.bin")
+        try:
+            write_genesis_state_cache(missing, root, items)
+            raise Exception("expected a failure")
+        except OSError:
+            pass
+        os.replace(pathname, pathname + ".tmp")
+        os.mkdir(pathname)
+        try:
+            write_genesis_state_cache(pathname, root, items)
+            raise Exception("expected a failure")
+        except OSError:
+            pass
+        assert not os.path.exists(pathname + ".tmp")
+
+# Returns a new EthereumVirtualMachine with the synthetic chain imported.
+def _import_chain(chain):
+    evm = chain.make_evm()
+    for b in chain.blocks:
+        evm.process_block(b)
+    return evm
+
+def _state_view_tests(chain):
+    import synthetic
+
+    evm = _import_chain(chain)
+    sender = chain.blocks[1].transactions[0].sender
+    assert evm.state_at(0).get_balance(sender) == synthetic.GENESIS_BALANCE
+    assert evm.state_at(0).get_nonce(sender) == 0
+    assert evm.state_at(3).get_nonce(sender) > 0
+    assert evm.state_at(3).root == evm.head_state().root == chain.blocks[3].header.stateRoot
+    assert any(key == ethsha3.hash(sender) for key, old, new in evm.state_at(0).diff(evm.state_at(1)))
+
+    evm = chain.make_evm()
+    evm.retained_blocks = 2
+    for b in chain.blocks:
+        evm.process_block(b)
+    assert list(evm.state_roots) == [2, 3]
+    try:
+        evm.state_at(1)
+        raise Exception("expected a failure")
+    except Exception as e:
+        assert "not retained" in str(e)
+
+def _storage_tests(chain):
+    evm = _import_chain(chain)
+    sender = chain.blocks[1].transactions[0].sender
+
+    # Journaled writes, then one commit.
+    evm.set_storage(sender, 1, 10)
+    marker = evm.storage.snapshot()
+    evm.set_storage(sender, 1, 11)
+    evm.set_storage(sender, 2, 20)
+    assert evm.get_storage(sender, 2) == 20
+    evm.storage.revert(marker)
+    assert evm.get_storage(sender, 1) == 10 and evm.get_storage(sender, 2) == 0
+    evm.set_storage(sender, 3, 2**256 - 1)
+    evm.commit_storage()
+    trie = mpt.MerklePatriciaTrie(mpt.HashTable(), mpt.NO_HASH, True)
+    trie = trie.set((1).to_bytes(32, "big"), rlp.encode(b"\x0a"))
+    trie = trie.set((3).to_bytes(32, "big"), rlp.encode(b"\xff"*32))
+    assert evm.get_account(sender).storage_root == trie.root
+    assert evm.head_state().get_storage(sender, 3) == 2**256 - 1
+    assert evm.head_state().get_storage(sender, 2) == 0
+    # Still in memory for the next block.
+    assert evm.storage.open(sender).slots == {1: 10, 2: 0, 3: 2**256 - 1}
+
+    # Clearing every slot empties the trie.
+    evm.set_storage(sender, 1, 0)
+    evm.set_storage(sender, 3, 0)
+    evm.commit_storage()
+    assert evm.get_account(sender).storage_root == mpt.EMPTY_TREE_ROOT
+    evm.storage.clear()
+    assert evm.get_storage(sender, 1) == 0
+
+    # Neither reads nor commits cache more than slot_cache_size slots.
+    evm.storage.slot_cache_size = 4
+    evm.storage.clear()
+    for slot in range(10):
+        evm.set_storage(sender, slot, slot + 1)
+    evm.commit_storage()
+    assert 0 < len(evm.storage.open(sender).slots) <= 4
+    assert [evm.get_storage(sender, slot) for slot in range(10)] == list(range(1, 11))
+    assert len(evm.storage.open(sender).slots) <= 4
+
+def _code_store_tests(chain):
+    import tempfile
+
+    evm = _import_chain(chain)
+    sender = chain.blocks[1].transactions[0].sender
+
+    # Code is stored once per hash, and decoded once.
+    code = bytes([0x60, 0x01, 0x00]) # PUSH1 1 STOP
+    nodes = len(evm.hash_table)
+    evm.set_code(sender, code)
+    evm.set_code(chain.blocks[1].transactions[1].sender, code)
+    assert len(evm.hash_table) > nodes
+    nodes = len(evm.hash_table)
+    evm.set_code(sender, code)
+    assert len(evm.hash_table) == nodes
+    assert evm.get_code(sender) == evm.head_state().get_code(sender) == code
+    assert evm.get_decoded_code(sender) is evm.get_decoded_code(sender)
+    assert evm.code_store.decoded.misses == 1
+    assert evm.get_code(bytes(20)) == b""
+
+    # Snapshots name the hot code, which is decoded on loading.
+    with tempfile.TemporaryDirectory() as directory:
+        pathname = os.path.join(directory, "snapshot.json")
+        evm.save_snapshot(pathname)
+        loaded = chain.make_evm()
+        loaded.load_snapshot(pathname)
+    assert ethsha3.hash(code) in loaded.code_store.decoded
+    assert loaded.get_code(sender) == code
+
+def _commitment_tests(chain):
+    transactions = chain.blocks[1].transactions
+    assert compute_transaction_hashes(transactions) == [t.transaction_hash() for t in transactions]
+    fields = [[t.nonce, t.gasPrice, t.gasLimit, t.toAddress, t.value, t.data, t.v, t.r, t.s]
+            for t in transactions]
+    assert _recover_senders(1, chain.blocks[1].header.transactionsRoot, fields) == \
+            [t.sender for t in transactions]
+
+    headers = [b.header for b in chain.blocks]
+    assert validate_header_chain(headers, ethsha3.ZERO_HASH, chunk_size=3) == \
+            chain.blocks[-1].header.compute_hash()
+    b = Block.decode(BLOCK_SCHEMA.encode(chain.blocks[2]))
+    b.transactions.pop()
+    try:
+        b.validate_body()
+        raise Exception("expected a failure")
+    except Exception as e:
+        assert "transactionsRoot" in str(e), e
+    headers = [Block.decode(BLOCK_SCHEMA.encode(b)).header for b in chain.blocks]
+    headers[2].parentHash = ethsha3.ZERO_HASH
+    try:
+        validate_header_chain(headers)
+        raise Exception("expected a failure")
+    except Exception as e:
+        assert "parentHash" in str(e), e
+
+def _import_pipeline_tests():
+    import contextlib
+    import io
+    import tempfile
+    import synthetic
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        chain = synthetic.make_chain(7, 20, 4)
+    blocks_binary = chain.encode()
+    expected = chain.make_evm()
+    for b in chain.blocks:
+        expected.process_block(b)
+
+    with tempfile.TemporaryDirectory() as directory:
+        pathname = os.path.join(directory, "snapshot.json")
+        for workers in [0, 2]:
+            evm = chain.make_evm()
+            processed = []
+            pipeline = ImportPipeline(evm, workers=workers, queue_size=2,
+                    snapshot_pathname=pathname, snapshot_interval=3)
+            pipeline.run(blocks_binary, lambda b: processed.append(b.header.number))
+            assert processed == list(range(len(chain.blocks)))
+            assert evm.state.root == expected.state.root
+            assert evm.head_block_hash == expected.head_block_hash
+            assert pipeline.execute_stage.blocks == len(chain.blocks)
+            assert pipeline.flush_stage.blocks + pipeline.skipped_snapshots == 4
+
+            # The last snapshot is of the head, and imports continue from it.
+            loaded = chain.make_evm()
+            loaded.load_snapshot(pathname)
+            assert loaded.head_block_number == expected.head_block_number
+            assert loaded.state.root == expected.state.root
+            assert loaded.get_account(chain.genesis_alloc[0][0]) == \
+                    expected.get_account(chain.genesis_alloc[0][0])
+            pipeline = ImportPipeline(loaded, workers=0)
+            pipeline.run(blocks_binary)
+            assert pipeline.execute_stage.blocks == 0
+
+    # Errors in any stage stop the pipeline and are raised by run().
+    def fail(b):
+        if b.header.number == 3:
+            raise ValueError("stop at 3")
+    evm = chain.make_evm()
+    try:
+        ImportPipeline(evm, workers=0).run(blocks_binary, fail)
+        raise Exception("expected a failure")
+    except ValueError as e:
+        assert str(e) == "stop at 3"
+    assert evm.head_block_number == 3
+
+    evm = chain.make_evm()
+    try:
+        ImportPipeline(evm, workers=0).run(blocks_binary[:-10])
+        raise Exception("expected a failure")
+    except Exception as e:
+        assert "expected a failure" not in str(e)
+    assert evm.head_block_number != len(chain.blocks) - 1
+
+    # Headers and bodies are checked before blocks are executed.
+    for field, tamper in [
+            ("parentHash", lambda b: setattr(b.header, "parentHash", ethsha3.ZERO_HASH)),
+            ("transactionsRoot", lambda b: b.transactions.pop()),
+            ("ommersHash", lambda b: b.ommers.append(b.header))]:
+        blocks = [Block.decode(BLOCK_SCHEMA.encode(b)) for b in chain.blocks[:3]]
+        tamper(blocks[2])
+        evm = chain.make_evm()
+        try:
+            ImportPipeline(evm, workers=0, queue_size=2).run(
+                    b"".join(BLOCK_SCHEMA.encode(b) for b in blocks))
+            raise Exception("expected a failure")
+        except Exception as e:
+            assert field in str(e), e
+        assert evm.head_block_number is None or evm.head_block_number < 2
+
+def _tests():
+    import synthetic
+
+    _genesis_state_cache_tests()
+    # Each test imports the chain into its own EthereumVirtualMachine.
+    chain = synthetic.make_chain(4, 5, 3)
+    _state_view_tests(chain)
+    _storage_tests(chain)
+    _code_store_tests(chain)
+    _commitment_tests(chain)
+    _import_pipeline_tests()
+    print("All good.")
+
+if __name__ == "__main__":
+    _tests()
@@ -1,8 +1,26 @@
 
-# Ethereum-flavor sha3.
+# Ethereum-flavor sha3, i.e., Keccak-256.
+#
+# The implementation is picked at import time, fastest first: the "pysha3"
+# module, then pycryptodome (or pycryptodomex), then keccak.py, which is
+# pure Python and much slower, but always available. BACKEND names the one
+# in use.
 
-# "pysha3" module:
-from sha3 import keccak_256
+try:
+    # "pysha3" module:
+    from sha3 import keccak_256
+    BACKEND = "pysha3"
+except ImportError:
+    try:
+        from Crypto.Hash import keccak as _keccak
+        BACKEND = "pycryptodome"
+    except ImportError:
+        try:
+            from Cryptodome.Hash import keccak as _keccak
+            BACKEND = "pycryptodome"
+        except ImportError:
+            import keccak as _keccak
+            BACKEND = "python"
 
 # Number of bytes in the result of ethsha3().
 ETHSHA3_LENGTH = 32
@@ -10,10 +28,26 @@ ETHSHA3_LENGTH = 32
 # A hash result with all zero bytes. Used to indicate "no hash".
 ZERO_HASH = b"\x00"*ETHSHA3_LENGTH
 
-# Return the length-32 bytes object for the hash of the bytes parameter.
-def hash(b):
-    h = keccak_256()
-    h.update(b)
-    return h.digest()
+if BACKEND == "pysha3":
+    # Return the length-32 bytes object for the hash of the bytes parameter.
+    def hash(b):
+        return keccak_256(b).digest()
+
+    # Return a list of the hashes of each bytes object of the iterable.
+    def hash_many(bs):
+        return [keccak_256(b).digest() for b in bs]
+elif BACKEND == "pycryptodome":
+    def hash(b):
+        return _keccak.new(data=b, digest_bits=256).digest()
+
+    def hash_many(bs):
+        new = _keccak.new
+        return [new(data=b, digest_bits=256).digest() for b in bs]
+else:
+    hash = _keccak.keccak_256
+
+    def hash_many(bs):
+        return [_keccak.keccak_256(b) for b in bs]
 
 EMPTY_STRING_HASH = hash(b"")
+assert EMPTY_STRING_HASH.hex() == "c5d2460186f7233c927e7db2dcc703c0e500b653ca82273b7bfad8045d85a470"
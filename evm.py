@@ -0,0 +1,1195 @@
+
+# Interpreter for EVM bytecode, with the Frontier and Homestead rules (the
+# chain's first contracts).
+#
+# Code is decoded once, into a list of instructions: PUSH immediates are
+# already ints, jump destinations are mapped to instruction indices, and
+# each instruction carries its handler from a 256-entry dispatch table, so
+# that the main loop is just "call the next handler". Code is stored and
+# kept decoded by code hash in a CodeStore.
+#
+# Static gas is charged per basic block rather than per instruction: the
+# first instruction of each block carries the total for the block. Running
+# out of gas part way through a block is an exceptional halt either way, so
+# the outcome is the same. Instructions that read the gas left (GAS, the
+# calls, CREATE) end their block so that they see the exact amount.
+#
+# The state and the rest of the chain are reached through a "host" object,
+# which must have these methods:
+#
+#     get_balance(address) -> int
+#     get_code(address) -> bytes
+#     get_code_hash(address) -> bytes
+#     account_exists(address) -> bool
+#     get_storage(address, key) -> int
+#     set_storage(address, key, value)
+#     get_block_hash(number) -> bytes
+#     log(address, topics, data)
+#     selfdestruct(address, beneficiary) -> whether it's the first time
+#     call(kind, message) -> ExecutionResult, for CALL, CALLCODE and
+#         DELEGATECALL: transfers the value (if CALL or CALLCODE), runs the
+#         code with execute(), and undoes its changes if it fails.
+#     create(message) -> (address or None, ExecutionResult): makes the
+#         account, runs message.data as init code, and stores the output as
+#         the account's code.
+#
+# and these attributes: origin, gas_price, coinbase, timestamp, number,
+# difficulty, gas_limit (of the transaction and block), and homestead
+# (whether Homestead rules apply). MemoryHost is a simple one.
+
+import collections
+import cache
+import ethsha3
+import mpt
+import rlp
+
+WORD_MASK = 2**256 - 1
+SIGN_BIT = 2**255
+STACK_LIMIT = 1024
+CALL_DEPTH_LIMIT = 1024
+
+# Number of contracts a CodeStore keeps decoded.
+DECODED_CODE_CACHE_SIZE = 1000
+
+# Most code hashes a CodeStore counts calls of. Past that, the less called
+# half are forgotten and the rest's counts halved, so that recent calls
+# outweigh old ones.
+CALL_COUNT_LIMIT = 10000
+
+# Exceptional halt: consumes all the frame's gas and undoes its changes.
+class ExecutionError(Exception):
+    pass
+
+# Call or contract creation.
+class Message:
+    __slots__ = ["caller", "address", "code_address", "value", "data", "gas", "depth"]
+
+    # "address" is the account whose storage and balance the code runs
+    # with, "code_address" the account the code came from (different for
+    # CALLCODE and DELEGATECALL). For a creation, "data" is the init code.
+    def __init__(self, caller, address, code_address, value, data, gas, depth):
+        self.caller = caller
+        self.address = address
+        self.code_address = code_address
+        self.value = value
+        self.data = data
+        self.gas = gas
+        self.depth = depth
+
+class ExecutionResult:
+    __slots__ = ["success", "gas_left", "output", "refund"]
+
+    def __init__(self, success, gas_left, output, refund):
+        self.success = success
+        self.gas_left = gas_left
+        self.output = output
+        # Gas refund earned by this frame and successful sub-calls.
+        self.refund = refund
+
+    def __repr__(self):
+        return "ExecutionResult[%s,%d,%s,%d]" % ("success" if self.success else "failure",
+                self.gas_left, self.output.hex(), self.refund)
+
+# Bytecode decoded for execution. "instructions" is a list of (handler,
+# argument, gas) tuples, where "gas" is the static gas of the basic block
+# the instruction starts (0 if it doesn't), and "jumpdests" maps the code
+# offset of each JUMPDEST to its instruction index. A STOP is appended so
+# that running off the end stops.
+class DecodedCode:
+    __slots__ = ["code", "instructions", "jumpdests", "pcs"]
+
+    def __init__(self, code):
+        self.code = bytes(code)
+        ops = []
+        args = []
+        self.pcs = []
+        self.jumpdests = {}
+
+        pc = 0
+        while pc < len(code):
+            op = code[pc]
+            arg = None
+            next_pc = pc + 1
+            if PUSH1 <= op <= PUSH32:
+                size = op - PUSH1 + 1
+                immediate = self.code[pc + 1:pc + 1 + size]
+                # Code that ends early is padded with zeros.
+                arg = int.from_bytes(immediate, "big") << 8*(size - len(immediate))
+                next_pc += size
+            elif DUP1 <= op <= DUP16:
+                arg = op - DUP1 + 1
+            elif SWAP1 <= op <= SWAP16:
+                arg = op - SWAP1 + 2
+            elif LOG0 <= op <= LOG4:
+                arg = op - LOG0
+            elif op == PC:
+                arg = pc
+            elif op == JUMPDEST:
+                self.jumpdests[pc] = len(ops)
+            ops.append(op)
+            args.append(arg)
+            self.pcs.append(pc)
+            pc = next_pc
+        ops.append(STOP)
+        args.append(None)
+        self.pcs.append(pc)
+
+        # Sum the static gas of each basic block into its first instruction.
+        gas = [0]*len(ops)
+        block_start = 0
+        for i, op in enumerate(ops):
+            if op == JUMPDEST:
+                block_start = i
+            gas[block_start] += _STATIC_GAS[op]
+            if op in _BLOCK_ENDS:
+                block_start = i + 1
+
+        self.instructions = [(_HANDLERS[op], arg, g) for op, arg, g in zip(ops, args, gas)]
+
+    def __len__(self):
+        return len(self.code)
+
+# Contract code by code hash. The code is kept in a key-value store, which
+# can be the one of the state trie: trie nodes are also keyed by the hash of
+# their bytes, so the two can't clash. Identical code deployed many times
+# is stored once. The most recently run codes are kept decoded, so that
+# calling a contract again neither reads nor decodes its code.
+class CodeStore:
+    # "key_value_store" has set(k, v), get(k) and "in", like mpt.HashTable.
+    def __init__(self, key_value_store, decoded_cache_size=DECODED_CODE_CACHE_SIZE,
+            call_count_limit=CALL_COUNT_LIMIT):
+        self.key_value_store = key_value_store
+        # DecodedCode by code hash.
+        self.decoded = cache.LruCache(decoded_cache_size)
+        # Number of get_decoded() calls by code hash, decayed (see
+        # CALL_COUNT_LIMIT).
+        self.call_counts = collections.Counter()
+        self.call_count_limit = call_count_limit
+
+    # Store the code, unless it's already there. Returns its hash.
+    def put(self, code):
+        code = bytes(code)
+        code_hash = ethsha3.hash(code)
+        if code and code_hash not in self.key_value_store:
+            self.key_value_store.set(code_hash, code)
+        return code_hash
+
+    # Returns the code with the hash as a bytes object.
+    def get(self, code_hash):
+        if code_hash == ethsha3.EMPTY_STRING_HASH:
+            return b""
+        return bytes(self.key_value_store.get(code_hash))
+
+    # Returns the DecodedCode of the code with the hash, to run it.
+    def get_decoded(self, code_hash):
+        self.call_counts[code_hash] += 1
+        if len(self.call_counts) > self.call_count_limit:
+            self._decay_call_counts()
+        decoded = self.decoded.get(code_hash)
+        if decoded is None:
+            decoded = DecodedCode(self.get(code_hash))
+            self.decoded.set(code_hash, decoded)
+        return decoded
+
+    # Returns the hashes of the "count" most called codes, most called first.
+    def most_called(self, count):
+        return [code_hash for code_hash, calls in self.call_counts.most_common(count)]
+
+    def _decay_call_counts(self):
+        kept = self.call_counts.most_common(self.call_count_limit//2)
+        self.call_counts = collections.Counter({code_hash: (calls + 1)//2
+            for code_hash, calls in kept})
+
+    # Decode codes before they're first called, e.g., the most_called() of
+    # an earlier run. "code_hashes" is ordered most important first, and
+    # only as many as the cache holds are loaded. Codes not in the store
+    # are skipped.
+    def preload(self, code_hashes):
+        code_hashes = list(code_hashes)[:self.decoded.capacity]
+        # Least important first, so that they're the first evicted.
+        for code_hash in reversed(code_hashes):
+            if code_hash not in self.decoded and code_hash in self.key_value_store:
+                self.decoded.set(code_hash, DecodedCode(self.get(code_hash)))
+
+# State of one running frame.
+class Frame:
+    __slots__ = ["message", "code", "host", "stack", "memory", "gas", "output", "refund"]
+
+    def __init__(self, message, code, host):
+        self.message = message
+        self.code = code
+        self.host = host
+        self.stack = []
+        self.memory = bytearray()
+        self.gas = message.gas
+        self.output = b""
+        self.refund = 0
+
+# Run the DecodedCode for the message. Returns an ExecutionResult.
+def execute(message, code, host):
+    f = Frame(message, code, host)
+    instructions = code.instructions
+    stack = f.stack
+    i = 0
+    try:
+        # Handlers return the index of the next instruction, or None to halt.
+        while i is not None:
+            handler, arg, gas = instructions[i]
+            if gas:
+                f.gas -= gas
+                if f.gas < 0:
+                    raise ExecutionError("out of gas")
+            i = handler(f, stack, arg, i + 1)
+            if len(stack) > STACK_LIMIT:
+                raise ExecutionError("stack overflow")
+    except ExecutionError:
+        return ExecutionResult(False, 0, b"", 0)
+    except IndexError:
+        # Popping an empty list, or DUP or SWAP past the bottom.
+        return ExecutionResult(False, 0, b"", 0)
+    return ExecutionResult(True, f.gas, f.output, f.refund)
+
+def _charge(f, gas):
+    f.gas -= gas
+    if f.gas < 0:
+        raise ExecutionError("out of gas")
+
+# Charge for and grow memory to cover "size" bytes at "offset".
+def _expand_memory(f, offset, size):
+    if size == 0:
+        return
+    end = offset + size
+    length = len(f.memory)
+    if end > length:
+        words = (end + 31)//32
+        old_words = length//32
+        _charge(f, 3*(words - old_words) + words*words//512 - old_words*old_words//512)
+        f.memory.extend(bytes(words*32 - length))
+
+def _to_signed(x):
+    return x - 2**256 if x & SIGN_BIT else x
+
+def _words(size):
+    return (size + 31)//32
+
+# Returns "size" bytes of b starting at "offset", padded with zeros.
+def _padded_slice(b, offset, size):
+    if offset >= len(b):
+        return bytes(size)
+    chunk = b[offset:offset + size]
+    return bytes(chunk) + bytes(size - len(chunk))
+
+# Arithmetic, comparison and bitwise operations. The first operand is the
+# top of the stack.
+
+def _op_stop(f, stack, arg, i):
+    return None
+
+def _op_add(f, stack, arg, i):
+    a = stack.pop()
+    stack[-1] = (a + stack[-1]) & WORD_MASK
+    return i
+
+def _op_mul(f, stack, arg, i):
+    a = stack.pop()
+    stack[-1] = (a*stack[-1]) & WORD_MASK
+    return i
+
+def _op_sub(f, stack, arg, i):
+    a = stack.pop()
+    stack[-1] = (a - stack[-1]) & WORD_MASK
+    return i
+
+def _op_div(f, stack, arg, i):
+    a = stack.pop()
+    b = stack[-1]
+    stack[-1] = a//b if b != 0 else 0
+    return i
+
+def _op_sdiv(f, stack, arg, i):
+    a = _to_signed(stack.pop())
+    b = _to_signed(stack[-1])
+    if b == 0:
+        stack[-1] = 0
+    else:
+        q = abs(a)//abs(b)
+        stack[-1] = (-q if (a < 0) != (b < 0) else q) & WORD_MASK
+    return i
+
+def _op_mod(f, stack, arg, i):
+    a = stack.pop()
+    b = stack[-1]
+    stack[-1] = a % b if b != 0 else 0
+    return i
+
+def _op_smod(f, stack, arg, i):
+    a = _to_signed(stack.pop())
+    b = _to_signed(stack[-1])
+    if b == 0:
+        stack[-1] = 0
+    else:
+        r = abs(a) % abs(b)
+        stack[-1] = (-r if a < 0 else r) & WORD_MASK
+    return i
+
+def _op_addmod(f, stack, arg, i):
+    a = stack.pop()
+    b = stack.pop()
+    n = stack[-1]
+    stack[-1] = (a + b) % n if n != 0 else 0
+    return i
+
+def _op_mulmod(f, stack, arg, i):
+    a = stack.pop()
+    b = stack.pop()
+    n = stack[-1]
+    stack[-1] = (a*b) % n if n != 0 else 0
+    return i
+
+def _op_exp(f, stack, arg, i):
+    base = stack.pop()
+    exponent = stack[-1]
+    _charge(f, 10*((exponent.bit_length() + 7)//8))
+    stack[-1] = pow(base, exponent, 2**256)
+    return i
+
+def _op_signextend(f, stack, arg, i):
+    b = stack.pop()
+    x = stack[-1]
+    if b < 31:
+        sign = 1 << (8*b + 7)
+        if x & sign:
+            stack[-1] = x | (WORD_MASK - (2*sign - 1))
+        else:
+            stack[-1] = x & (2*sign - 1)
+    return i
+
+def _op_lt(f, stack, arg, i):
+    a = stack.pop()
+    stack[-1] = 1 if a < stack[-1] else 0
+    return i
+
+def _op_gt(f, stack, arg, i):
+    a = stack.pop()
+    stack[-1] = 1 if a > stack[-1] else 0
+    return i
+
+def _op_slt(f, stack, arg, i):
+    a = _to_signed(stack.pop())
+    stack[-1] = 1 if a < _to_signed(stack[-1]) else 0
+    return i
+
+def _op_sgt(f, stack, arg, i):
+    a = _to_signed(stack.pop())
+    stack[-1] = 1 if a > _to_signed(stack[-1]) else 0
+    return i
+
+def _op_eq(f, stack, arg, i):
+    a = stack.pop()
+    stack[-1] = 1 if a == stack[-1] else 0
+    return i
+
+def _op_iszero(f, stack, arg, i):
+    stack[-1] = 1 if stack[-1] == 0 else 0
+    return i
+
+def _op_and(f, stack, arg, i):
+    a = stack.pop()
+    stack[-1] &= a
+    return i
+
+def _op_or(f, stack, arg, i):
+    a = stack.pop()
+    stack[-1] |= a
+    return i
+
+def _op_xor(f, stack, arg, i):
+    a = stack.pop()
+    stack[-1] ^= a
+    return i
+
+def _op_not(f, stack, arg, i):
+    stack[-1] = WORD_MASK - stack[-1]
+    return i
+
+def _op_byte(f, stack, arg, i):
+    n = stack.pop()
+    stack[-1] = (stack[-1] >> (248 - 8*n)) & 0xFF if n < 32 else 0
+    return i
+
+def _op_sha3(f, stack, arg, i):
+    offset = stack.pop()
+    size = stack[-1]
+    _charge(f, 6*_words(size))
+    _expand_memory(f, offset, size)
+    stack[-1] = int.from_bytes(ethsha3.hash(f.memory[offset:offset + size]), "big")
+    return i
+
+# Environment.
+
+def _op_address(f, stack, arg, i):
+    stack.append(int.from_bytes(f.message.address, "big"))
+    return i
+
+def _op_balance(f, stack, arg, i):
+    stack[-1] = f.host.get_balance(_to_address(stack[-1]))
+    return i
+
+def _op_origin(f, stack, arg, i):
+    stack.append(int.from_bytes(f.host.origin, "big"))
+    return i
+
+def _op_caller(f, stack, arg, i):
+    stack.append(int.from_bytes(f.message.caller, "big"))
+    return i
+
+def _op_callvalue(f, stack, arg, i):
+    stack.append(f.message.value)
+    return i
+
+def _op_calldataload(f, stack, arg, i):
+    stack[-1] = int.from_bytes(_padded_slice(f.message.data, stack[-1], 32), "big")
+    return i
+
+def _op_calldatasize(f, stack, arg, i):
+    stack.append(len(f.message.data))
+    return i
+
+# Copy "source" to memory, for CALLDATACOPY, CODECOPY and EXTCODECOPY.
+def _copy_to_memory(f, stack, source):
+    memory_offset = stack.pop()
+    offset = stack.pop()
+    size = stack.pop()
+    _charge(f, 3*_words(size))
+    _expand_memory(f, memory_offset, size)
+    if size:
+        f.memory[memory_offset:memory_offset + size] = _padded_slice(source, offset, size)
+
+def _op_calldatacopy(f, stack, arg, i):
+    _copy_to_memory(f, stack, f.message.data)
+    return i
+
+def _op_codesize(f, stack, arg, i):
+    stack.append(len(f.code.code))
+    return i
+
+def _op_codecopy(f, stack, arg, i):
+    _copy_to_memory(f, stack, f.code.code)
+    return i
+
+def _op_gasprice(f, stack, arg, i):
+    stack.append(f.host.gas_price)
+    return i
+
+def _op_extcodesize(f, stack, arg, i):
+    stack[-1] = len(f.host.get_code(_to_address(stack[-1])))
+    return i
+
+def _op_extcodecopy(f, stack, arg, i):
+    code = f.host.get_code(_to_address(stack.pop()))
+    _copy_to_memory(f, stack, code)
+    return i
+
+def _op_blockhash(f, stack, arg, i):
+    number = stack[-1]
+    if f.host.number - 256 <= number < f.host.number:
+        stack[-1] = int.from_bytes(f.host.get_block_hash(number), "big")
+    else:
+        stack[-1] = 0
+    return i
+
+def _op_coinbase(f, stack, arg, i):
+    stack.append(int.from_bytes(f.host.coinbase, "big"))
+    return i
+
+def _op_timestamp(f, stack, arg, i):
+    stack.append(f.host.timestamp)
+    return i
+
+def _op_number(f, stack, arg, i):
+    stack.append(f.host.number)
+    return i
+
+def _op_difficulty(f, stack, arg, i):
+    stack.append(f.host.difficulty)
+    return i
+
+def _op_gaslimit(f, stack, arg, i):
+    stack.append(f.host.gas_limit)
+    return i
+
+# Stack, memory, storage and flow.
+
+def _op_pop(f, stack, arg, i):
+    stack.pop()
+    return i
+
+def _op_mload(f, stack, arg, i):
+    offset = stack[-1]
+    _expand_memory(f, offset, 32)
+    stack[-1] = int.from_bytes(f.memory[offset:offset + 32], "big")
+    return i
+
+def _op_mstore(f, stack, arg, i):
+    offset = stack.pop()
+    value = stack.pop()
+    _expand_memory(f, offset, 32)
+    f.memory[offset:offset + 32] = value.to_bytes(32, "big")
+    return i
+
+def _op_mstore8(f, stack, arg, i):
+    offset = stack.pop()
+    value = stack.pop()
+    _expand_memory(f, offset, 1)
+    f.memory[offset] = value & 0xFF
+    return i
+
+def _op_sload(f, stack, arg, i):
+    stack[-1] = f.host.get_storage(f.message.address, stack[-1])
+    return i
+
+def _op_sstore(f, stack, arg, i):
+    key = stack.pop()
+    value = stack.pop()
+    current = f.host.get_storage(f.message.address, key)
+    _charge(f, 20000 if value != 0 and current == 0 else 5000)
+    if value == 0 and current != 0:
+        f.refund += 15000
+    f.host.set_storage(f.message.address, key, value)
+    return i
+
+def _op_jump(f, stack, arg, i):
+    i = f.code.jumpdests.get(stack.pop())
+    if i is None:
+        raise ExecutionError("invalid jump destination")
+    return i
+
+def _op_jumpi(f, stack, arg, i):
+    destination = stack.pop()
+    if stack.pop() == 0:
+        return i
+    i = f.code.jumpdests.get(destination)
+    if i is None:
+        raise ExecutionError("invalid jump destination")
+    return i
+
+def _op_pc(f, stack, arg, i):
+    stack.append(arg)
+    return i
+
+def _op_msize(f, stack, arg, i):
+    stack.append(len(f.memory))
+    return i
+
+def _op_gas(f, stack, arg, i):
+    stack.append(f.gas)
+    return i
+
+def _op_jumpdest(f, stack, arg, i):
+    return i
+
+def _op_push(f, stack, arg, i):
+    stack.append(arg)
+    return i
+
+def _op_dup(f, stack, arg, i):
+    stack.append(stack[-arg])
+    return i
+
+def _op_swap(f, stack, arg, i):
+    stack[-1], stack[-arg] = stack[-arg], stack[-1]
+    return i
+
+def _op_log(f, stack, arg, i):
+    offset = stack.pop()
+    size = stack.pop()
+    topics = [stack.pop().to_bytes(32, "big") for j in range(arg)]
+    _charge(f, 8*size)
+    _expand_memory(f, offset, size)
+    f.host.log(f.message.address, topics, bytes(f.memory[offset:offset + size]))
+    return i
+
+# System operations.
+
+def _op_create(f, stack, arg, i):
+    value = stack.pop()
+    offset = stack.pop()
+    size = stack.pop()
+    _expand_memory(f, offset, size)
+    init_code = bytes(f.memory[offset:offset + size])
+    message = f.message
+    host = f.host
+
+    if message.depth + 1 > CALL_DEPTH_LIMIT or host.get_balance(message.address) < value:
+        stack.append(0)
+        return i
+
+    # All the remaining gas goes to the init code.
+    gas = f.gas
+    f.gas = 0
+    address, result = host.create(Message(message.address, None, None, value, init_code,
+        gas, message.depth + 1))
+    f.gas += result.gas_left
+    if result.success:
+        f.refund += result.refund
+    stack.append(int.from_bytes(address, "big") if address is not None else 0)
+    return i
+
+# CALL, CALLCODE and DELEGATECALL, which differ in what they pass on.
+def _call(f, stack, kind):
+    gas = stack.pop()
+    to = _to_address(stack.pop())
+    value = stack.pop() if kind != DELEGATECALL else f.message.value
+    in_offset = stack.pop()
+    in_size = stack.pop()
+    out_offset = stack.pop()
+    out_size = stack.pop()
+    message = f.message
+    host = f.host
+
+    _expand_memory(f, in_offset, in_size)
+    _expand_memory(f, out_offset, out_size)
+    extra = 0
+    if kind != DELEGATECALL and value != 0:
+        extra += 9000
+    if kind == CALL and not host.account_exists(to):
+        extra += 25000
+    _charge(f, extra + gas)
+    # The callee gets a stipend on top of the gas, to pay for logging the
+    # value it received.
+    if kind != DELEGATECALL and value != 0:
+        gas += 2300
+
+    if message.depth + 1 > CALL_DEPTH_LIMIT or \
+            (kind != DELEGATECALL and host.get_balance(message.address) < value):
+        f.gas += gas
+        stack.append(0)
+        return
+
+    data = bytes(f.memory[in_offset:in_offset + in_size])
+    if kind == CALL:
+        callee = Message(message.address, to, to, value, data, gas, message.depth + 1)
+    elif kind == CALLCODE:
+        callee = Message(message.address, message.address, to, value, data, gas,
+                message.depth + 1)
+    else:
+        callee = Message(message.caller, message.address, to, value, data, gas,
+                message.depth + 1)
+    result = host.call(kind, callee)
+
+    f.gas += result.gas_left
+    if result.success:
+        f.refund += result.refund
+    output = result.output[:out_size]
+    f.memory[out_offset:out_offset + len(output)] = output
+    stack.append(1 if result.success else 0)
+
+def _op_call(f, stack, arg, i):
+    _call(f, stack, CALL)
+    return i
+
+def _op_callcode(f, stack, arg, i):
+    _call(f, stack, CALLCODE)
+    return i
+
+def _op_delegatecall(f, stack, arg, i):
+    if not f.host.homestead:
+        raise ExecutionError("invalid opcode 0x%02x" % DELEGATECALL)
+    _call(f, stack, DELEGATECALL)
+    return i
+
+def _op_return(f, stack, arg, i):
+    offset = stack.pop()
+    size = stack.pop()
+    _expand_memory(f, offset, size)
+    f.output = bytes(f.memory[offset:offset + size])
+    return None
+
+def _op_selfdestruct(f, stack, arg, i):
+    beneficiary = _to_address(stack.pop())
+    if f.host.selfdestruct(f.message.address, beneficiary):
+        f.refund += 24000
+    return None
+
+def _op_invalid(f, stack, arg, i):
+    raise ExecutionError("invalid opcode")
+
+def _to_address(x):
+    return (x & (2**160 - 1)).to_bytes(20, "big")
+
+# Opcodes: name, static gas, handler.
+_OPCODES = {
+        0x00: ("STOP", 0, _op_stop),
+        0x01: ("ADD", 3, _op_add),
+        0x02: ("MUL", 5, _op_mul),
+        0x03: ("SUB", 3, _op_sub),
+        0x04: ("DIV", 5, _op_div),
+        0x05: ("SDIV", 5, _op_sdiv),
+        0x06: ("MOD", 5, _op_mod),
+        0x07: ("SMOD", 5, _op_smod),
+        0x08: ("ADDMOD", 8, _op_addmod),
+        0x09: ("MULMOD", 8, _op_mulmod),
+        0x0A: ("EXP", 10, _op_exp),
+        0x0B: ("SIGNEXTEND", 5, _op_signextend),
+        0x10: ("LT", 3, _op_lt),
+        0x11: ("GT", 3, _op_gt),
+        0x12: ("SLT", 3, _op_slt),
+        0x13: ("SGT", 3, _op_sgt),
+        0x14: ("EQ", 3, _op_eq),
+        0x15: ("ISZERO", 3, _op_iszero),
+        0x16: ("AND", 3, _op_and),
+        0x17: ("OR", 3, _op_or),
+        0x18: ("XOR", 3, _op_xor),
+        0x19: ("NOT", 3, _op_not),
+        0x1A: ("BYTE", 3, _op_byte),
+        0x20: ("SHA3", 30, _op_sha3),
+        0x30: ("ADDRESS", 2, _op_address),
+        0x31: ("BALANCE", 20, _op_balance),
+        0x32: ("ORIGIN", 2, _op_origin),
+        0x33: ("CALLER", 2, _op_caller),
+        0x34: ("CALLVALUE", 2, _op_callvalue),
+        0x35: ("CALLDATALOAD", 3, _op_calldataload),
+        0x36: ("CALLDATASIZE", 2, _op_calldatasize),
+        0x37: ("CALLDATACOPY", 3, _op_calldatacopy),
+        0x38: ("CODESIZE", 2, _op_codesize),
+        0x39: ("CODECOPY", 3, _op_codecopy),
+        0x3A: ("GASPRICE", 2, _op_gasprice),
+        0x3B: ("EXTCODESIZE", 20, _op_extcodesize),
+        0x3C: ("EXTCODECOPY", 20, _op_extcodecopy),
+        0x40: ("BLOCKHASH", 20, _op_blockhash),
+        0x41: ("COINBASE", 2, _op_coinbase),
+        0x42: ("TIMESTAMP", 2, _op_timestamp),
+        0x43: ("NUMBER", 2, _op_number),
+        0x44: ("DIFFICULTY", 2, _op_difficulty),
+        0x45: ("GASLIMIT", 2, _op_gaslimit),
+        0x50: ("POP", 2, _op_pop),
+        0x51: ("MLOAD", 3, _op_mload),
+        0x52: ("MSTORE", 3, _op_mstore),
+        0x53: ("MSTORE8", 3, _op_mstore8),
+        0x54: ("SLOAD", 50, _op_sload),
+        0x55: ("SSTORE", 0, _op_sstore),
+        0x56: ("JUMP", 8, _op_jump),
+        0x57: ("JUMPI", 10, _op_jumpi),
+        0x58: ("PC", 2, _op_pc),
+        0x59: ("MSIZE", 2, _op_msize),
+        0x5A: ("GAS", 2, _op_gas),
+        0x5B: ("JUMPDEST", 1, _op_jumpdest),
+        0xF0: ("CREATE", 32000, _op_create),
+        0xF1: ("CALL", 40, _op_call),
+        0xF2: ("CALLCODE", 40, _op_callcode),
+        0xF3: ("RETURN", 0, _op_return),
+        0xF4: ("DELEGATECALL", 40, _op_delegatecall),
+        0xFF: ("SELFDESTRUCT", 0, _op_selfdestruct),
+}
+for _i in range(32):
+    _OPCODES[0x60 + _i] = ("PUSH%d" % (_i + 1), 3, _op_push)
+for _i in range(16):
+    _OPCODES[0x80 + _i] = ("DUP%d" % (_i + 1), 3, _op_dup)
+    _OPCODES[0x90 + _i] = ("SWAP%d" % (_i + 1), 3, _op_swap)
+for _i in range(5):
+    _OPCODES[0xA0 + _i] = ("LOG%d" % _i, 375 + 375*_i, _op_log)
+
+# Map from name to opcode.
+OPCODE_BY_NAME = {name: op for op, (name, gas, handler) in _OPCODES.items()}
+OPCODE_BY_NAME["SUICIDE"] = OPCODE_BY_NAME["SELFDESTRUCT"]
+
+STOP = OPCODE_BY_NAME["STOP"]
+PC = OPCODE_BY_NAME["PC"]
+GAS = OPCODE_BY_NAME["GAS"]
+JUMP = OPCODE_BY_NAME["JUMP"]
+JUMPI = OPCODE_BY_NAME["JUMPI"]
+JUMPDEST = OPCODE_BY_NAME["JUMPDEST"]
+PUSH1 = OPCODE_BY_NAME["PUSH1"]
+PUSH32 = OPCODE_BY_NAME["PUSH32"]
+DUP1 = OPCODE_BY_NAME["DUP1"]
+DUP16 = OPCODE_BY_NAME["DUP16"]
+SWAP1 = OPCODE_BY_NAME["SWAP1"]
+SWAP16 = OPCODE_BY_NAME["SWAP16"]
+LOG0 = OPCODE_BY_NAME["LOG0"]
+LOG4 = OPCODE_BY_NAME["LOG4"]
+CREATE = OPCODE_BY_NAME["CREATE"]
+CALL = OPCODE_BY_NAME["CALL"]
+CALLCODE = OPCODE_BY_NAME["CALLCODE"]
+RETURN = OPCODE_BY_NAME["RETURN"]
+DELEGATECALL = OPCODE_BY_NAME["DELEGATECALL"]
+SELFDESTRUCT = OPCODE_BY_NAME["SELFDESTRUCT"]
+
+# Dispatch tables, indexed by opcode.
+_HANDLERS = [_op_invalid]*256
+_STATIC_GAS = [0]*256
+for _op, (_name, _gas, _handler) in _OPCODES.items():
+    _HANDLERS[_op] = _handler
+    _STATIC_GAS[_op] = _gas
+
+# Opcodes after which a new basic block starts: jumps, halts, and those
+# that read the gas left.
+_BLOCK_ENDS = set([STOP, JUMP, JUMPI, GAS, CREATE, CALL, CALLCODE, RETURN, DELEGATECALL,
+    SELFDESTRUCT] + [op for op in range(256) if op not in _OPCODES])
+
+# Assemble whitespace-separated opcode names and PUSH arguments into code.
+# A token "name:" is a JUMPDEST labeled "name", and "@name" is its offset
+# as a PUSH argument, e.g. "loop: ... PUSH2 @loop JUMP".
+def assemble(source):
+    tokens = source.split()
+    # Two passes: the first finds the label offsets.
+    labels = {}
+    for labels_known in [False, True]:
+        code = bytearray()
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            i += 1
+            if token.endswith(":"):
+                labels[token[:-1]] = len(code)
+                code.append(JUMPDEST)
+                continue
+            op = OPCODE_BY_NAME.get(token.upper())
+            if op is None:
+                raise Exception("unknown opcode %r" % token)
+            code.append(op)
+            if PUSH1 <= op <= PUSH32:
+                size = op - PUSH1 + 1
+                argument = tokens[i]
+                i += 1
+                if argument.startswith("@"):
+                    value = labels[argument[1:]] if labels_known else 0
+                else:
+                    value = int(argument, 0)
+                code.extend(value.to_bytes(size, "big"))
+    return bytes(code)
+
+# Returns the code as a list of lines of text.
+def disassemble(code):
+    lines = []
+    decoded = DecodedCode(code)
+    for (handler, arg, gas), pc in zip(decoded.instructions[:-1], decoded.pcs):
+        op = code[pc]
+        name = _OPCODES[op][0] if op in _OPCODES else "INVALID(0x%02x)" % op
+        if PUSH1 <= op <= PUSH32:
+            name += " 0x%x" % arg
+        lines.append("%5d %s" % (pc, name))
+    return lines
+
+# Account in a MemoryHost.
+class MemoryAccount:
+    def __init__(self, balance=0, code=b"", nonce=0):
+        self.nonce = nonce
+        self.balance = balance
+        self.code = code
+        self.code_hash = ethsha3.hash(code)
+        # Map from key to value, both ints. Zeros aren't stored.
+        self.storage = {}
+
+    def copy(self):
+        account = MemoryAccount(self.balance, b"", self.nonce)
+        account.code = self.code
+        account.code_hash = self.code_hash
+        account.storage = dict(self.storage)
+        return account
+
+# Host that keeps accounts in a dictionary, for tests and benchmarks.
+# Changes of failed calls are undone by restoring a copy of all accounts,
+# which is fine for small states. Code is run from "code_store", which
+# gets the code of all accounts.
+class MemoryHost:
+    def __init__(self, accounts=None, homestead=True, code_store=None):
+        # Map from address to MemoryAccount.
+        self.accounts = accounts if accounts is not None else {}
+        self.code_store = code_store if code_store is not None else CodeStore(mpt.HashTable())
+        for account in self.accounts.values():
+            self.code_store.put(account.code)
+        self.homestead = homestead
+        self.origin = bytes(20)
+        self.gas_price = 1
+        self.coinbase = bytes(20)
+        self.timestamp = 0
+        self.number = 1
+        self.difficulty = 0
+        self.gas_limit = 10**7
+        # List of (address, topics, data) tuples.
+        self.logs = []
+        self.destructed = set()
+
+    def get_balance(self, address):
+        account = self.accounts.get(address)
+        return account.balance if account is not None else 0
+
+    def get_code(self, address):
+        account = self.accounts.get(address)
+        return account.code if account is not None else b""
+
+    def get_code_hash(self, address):
+        account = self.accounts.get(address)
+        return account.code_hash if account is not None else ethsha3.EMPTY_STRING_HASH
+
+    def account_exists(self, address):
+        return address in self.accounts
+
+    def get_storage(self, address, key):
+        account = self.accounts.get(address)
+        return account.storage.get(key, 0) if account is not None else 0
+
+    def set_storage(self, address, key, value):
+        storage = self._account(address).storage
+        if value == 0:
+            storage.pop(key, None)
+        else:
+            storage[key] = value
+
+    def get_block_hash(self, number):
+        return ethsha3.hash(number.to_bytes(32, "big"))
+
+    def log(self, address, topics, data):
+        self.logs.append((address, topics, data))
+
+    def selfdestruct(self, address, beneficiary):
+        account = self._account(address)
+        self._account(beneficiary).balance += account.balance
+        account.balance = 0
+        first = address not in self.destructed
+        self.destructed.add(address)
+        return first
+
+    def call(self, kind, message):
+        snapshot = self._snapshot()
+        if kind != DELEGATECALL and message.value != 0:
+            self._account(message.caller).balance -= message.value
+            self._account(message.address).balance += message.value
+        code = self.code_store.get_decoded(self.get_code_hash(message.code_address))
+        result = execute(message, code, self)
+        if not result.success:
+            self._restore(snapshot)
+        return result
+
+    def create(self, message):
+        snapshot = self._snapshot()
+        creator = self._account(message.caller)
+        address = ethsha3.hash(rlp.encode([message.caller, rlp.encode_int(creator.nonce)]))[12:]
+        creator.nonce += 1
+        creator.balance -= message.value
+        account = self._account(address)
+        account.balance += message.value
+        message.address = address
+        message.code_address = address
+
+        result = execute(message, DecodedCode(message.data), self)
+        if result.success:
+            # Code deposit.
+            cost = 200*len(result.output)
+            if cost <= result.gas_left:
+                result.gas_left -= cost
+                account.code = result.output
+                account.code_hash = self.code_store.put(result.output)
+            elif self.homestead:
+                result = ExecutionResult(False, 0, b"", 0)
+        if not result.success:
+            self._restore(snapshot)
+            self._account(message.caller).nonce += 1
+            return None, result
+        return address, result
+
+    # Run a transaction's code: "code" at "to" with "data" and "gas". If
+    # "to" has no account, it's created with the code.
+    def run(self, code, data=b"", gas=10**6, value=0, caller=None, to=None):
+        caller = caller if caller is not None else bytes(20)
+        to = to if to is not None else bytes(19) + b"\x01"
+        if to not in self.accounts:
+            self.accounts[to] = MemoryAccount(0, code)
+            self.code_store.put(code)
+        message = Message(caller, to, to, value, data, gas, 0)
+        return self.call(CALL, message)
+
+    def _account(self, address):
+        account = self.accounts.get(address)
+        if account is None:
+            account = MemoryAccount()
+            self.accounts[address] = account
+        return account
+
+    def _snapshot(self):
+        return ({address: account.copy() for address, account in self.accounts.items()},
+                len(self.logs), set(self.destructed))
+
+    def _restore(self, snapshot):
+        accounts, log_count, destructed = snapshot
+        self.accounts.clear()
+        self.accounts.update(accounts)
+        del self.logs[log_count:]
+        self.destructed = destructed
+
+# Test vectors: (assembly, expected output as an int or None for failure,
+# gas used or None to skip the check). Programs that succeed return the top
+# of the stack as 32 bytes.
+_RETURN_TOP = " PUSH1 0 MSTORE PUSH1 32 PUSH1 0 RETURN"
+_RETURN_TOP_GAS = 3 + 3 + 3 + 3 + 3
+_TEST_VECTORS = [
+        ("PUSH1 2 PUSH1 3 ADD" + _RETURN_TOP, 5, 3 + 3 + 3 + _RETURN_TOP_GAS),
+        ("PUSH1 2 PUSH1 3 SUB" + _RETURN_TOP, 1, None),
+        ("PUSH1 3 PUSH1 2 SUB" + _RETURN_TOP, WORD_MASK, None),
+        ("PUSH1 7 PUSH1 6 MUL" + _RETURN_TOP, 42, None),
+        ("PUSH1 0 PUSH1 6 DIV" + _RETURN_TOP, 0, None),
+        ("PUSH1 4 PUSH1 13 DIV" + _RETURN_TOP, 3, None),
+        ("PUSH1 3 PUSH1 8 PUSH1 0 SUB SDIV" + _RETURN_TOP, 2**256 - 2, None),
+        ("PUSH1 0 NOT PUSH32 0x8000000000000000000000000000000000000000000000000000000000000000 SDIV"
+            + _RETURN_TOP, SIGN_BIT, None),
+        ("PUSH1 3 PUSH1 8 PUSH1 0 SUB SMOD" + _RETURN_TOP, 2**256 - 2, None),
+        ("PUSH1 3 PUSH1 8 MOD" + _RETURN_TOP, 2, None),
+        ("PUSH1 5 PUSH1 4 PUSH1 3 ADDMOD" + _RETURN_TOP, 2, None),
+        ("PUSH1 0 NOT PUSH1 0 NOT PUSH1 0 NOT MULMOD" + _RETURN_TOP, 0, None),
+        ("PUSH1 10 PUSH1 2 EXP" + _RETURN_TOP, 1024, 3 + 3 + 10 + 10 + _RETURN_TOP_GAS),
+        ("PUSH2 0x100 PUSH1 2 EXP" + _RETURN_TOP, 0, None),
+        ("PUSH1 0xFF PUSH1 0 SIGNEXTEND" + _RETURN_TOP, WORD_MASK, None),
+        ("PUSH1 0x7F PUSH1 0 SIGNEXTEND" + _RETURN_TOP, 0x7F, None),
+        ("PUSH2 0x12FF PUSH1 0 SIGNEXTEND" + _RETURN_TOP, WORD_MASK, None),
+        ("PUSH1 1 PUSH1 0 SUB PUSH1 0 SLT" + _RETURN_TOP, 0, None),
+        ("PUSH1 1 PUSH1 0 SUB PUSH1 0 SGT" + _RETURN_TOP, 1, None),
+        ("PUSH1 1 PUSH1 2 LT" + _RETURN_TOP, 0, None),
+        ("PUSH1 1 PUSH1 2 GT" + _RETURN_TOP, 1, None),
+        ("PUSH1 0 ISZERO PUSH1 5 EQ" + _RETURN_TOP, 0, None),
+        ("PUSH1 0x0F PUSH1 0x3C AND PUSH1 0x40 OR PUSH1 0x01 XOR" + _RETURN_TOP, 0x4D, None),
+        ("PUSH2 0x1234 PUSH1 30 BYTE" + _RETURN_TOP, 0x12, None),
+        ("PUSH2 0x1234 PUSH1 32 BYTE" + _RETURN_TOP, 0, None),
+        # Sum of 1 to 10 in a loop.
+        ("PUSH1 0 PUSH1 10 loop: DUP1 SWAP2 ADD SWAP1 PUSH1 1 SWAP1 SUB DUP1 PUSH2 @loop JUMPI"
+            " POP" + _RETURN_TOP, 55, None),
+        ("PUSH1 0 PUSH1 0 SHA3" + _RETURN_TOP, int.from_bytes(ethsha3.EMPTY_STRING_HASH, "big"),
+            3 + 3 + 30 + _RETURN_TOP_GAS),
+        ("PUSH1 42 PUSH1 0 SSTORE PUSH1 0 SLOAD" + _RETURN_TOP, 42,
+            3 + 3 + 20000 + 3 + 50 + _RETURN_TOP_GAS),
+        ("PUSH1 0x11 PUSH1 33 MSTORE8 PUSH1 2 MLOAD MSIZE ADD" + _RETURN_TOP, 0x11 + 64, None),
+        ("PC PC PC ADD ADD" + _RETURN_TOP, 3, None),
+        ("PUSH1 100 GAS SWAP1 POP" + _RETURN_TOP, 10**6 - 3 - 2, None),
+        ("CALLDATASIZE PUSH1 1 CALLDATALOAD ADD" + _RETURN_TOP, (0x0203 << 240) + 3, None),
+        ("CODESIZE" + _RETURN_TOP, 9, None),
+        # Exceptional halts.
+        ("ADD", None, 10**6),
+        ("PUSH1 2 JUMP JUMPDEST", None, None),
+        ("PUSH1 4 JUMP PUSH1 0x5B", None, None),
+        ("PUSH1 0xFF PUSH1 0 PUSH1 0 SSTORE JUMP", None, None),
+        ("GAS" + " DUP1"*1024, None, None),
+        ("PUSH32 0xFFFFFFFF MLOAD", None, None),
+]
+
+def _tests():
+    for source, expected, gas_used in _TEST_VECTORS:
+        result = MemoryHost().run(assemble(source), b"\x01\x02\x03")
+        if expected is None:
+            assert not result.success, source
+            assert result.gas_left == 0
+        else:
+            assert result.success, source
+            assert result.output == expected.to_bytes(32, "big"), (source, result)
+        if gas_used is not None:
+            assert 10**6 - result.gas_left == gas_used, (source, 10**6 - result.gas_left)
+
+    # Stack limit: 1024 is fine.
+    result = MemoryHost().run(assemble("GAS" + " DUP1"*1023 + " STOP"))
+    assert result.success
+    # Undefined opcode.
+    assert not MemoryHost().run(assemble("PUSH1 1") + b"\x0C").success
+
+    # Out of gas part way through a block.
+    code = assemble("PUSH1 1 PUSH1 2 ADD" + _RETURN_TOP)
+    assert MemoryHost().run(code, gas=24).success
+    assert not MemoryHost().run(code, gas=23).success
+
+    # Truncated PUSH, padded with zeros.
+    assert DecodedCode(bytes([PUSH1 + 1, 0x12])).instructions[0][1] == 0x1200
+    # Jump into PUSH data is invalid.
+    assert list(DecodedCode(assemble("PUSH1 0x5B JUMPDEST")).jumpdests) == [2]
+
+    # Storage refund.
+    host = MemoryHost()
+    result = host.run(assemble("PUSH1 1 PUSH1 0 SSTORE PUSH1 0 PUSH1 0 SSTORE"))
+    assert result.success and result.refund == 15000
+    assert host.get_storage(bytes(19) + b"\x01", 0) == 0
+
+    # Logs.
+    host = MemoryHost()
+    result = host.run(assemble("PUSH1 0xAB PUSH1 0 MSTORE8 PUSH1 7 PUSH1 1 PUSH1 0 LOG1"))
+    assert result.success and host.logs == [(bytes(19) + b"\x01", [(7).to_bytes(32, "big")], b"\xAB")]
+
+    # A contract calling another, which returns CALLER + CALLVALUE + 1.
+    callee_address = b"\x02"*20
+    callee = assemble("CALLER CALLVALUE ADD PUSH1 1 ADD" + _RETURN_TOP)
+    host = MemoryHost({callee_address: MemoryAccount(0, callee)})
+    caller = assemble("PUSH1 32 PUSH1 0 PUSH1 0 PUSH1 0 PUSH1 5 PUSH20 0x" + callee_address.hex() +
+            " PUSH2 5000 CALL PUSH1 0 MLOAD ADD" + _RETURN_TOP)
+    result = host.run(caller, to=b"\x01"*20)
+    # Not enough balance for the value: the call fails, not the caller.
+    assert result.success and int.from_bytes(result.output, "big") == 0
+    host.accounts[b"\x01"*20].balance = 100
+    result = host.run(caller, to=b"\x01"*20)
+    assert result.success
+    assert int.from_bytes(result.output, "big") == int.from_bytes(b"\x01"*20, "big") + 5 + 1 + 1
+    assert host.get_balance(callee_address) == 5 and host.get_balance(b"\x01"*20) == 95
+
+    # DELEGATECALL keeps the caller and value; not before Homestead.
+    delegate = assemble("PUSH1 32 PUSH1 0 PUSH1 0 PUSH1 0 PUSH20 0x" + callee_address.hex() +
+            " PUSH2 5000 DELEGATECALL PUSH1 0 MLOAD" + _RETURN_TOP)
+    result = host.run(delegate, to=b"\x03"*20, caller=b"\x04"*20)
+    assert int.from_bytes(result.output, "big") == int.from_bytes(b"\x04"*20, "big") + 1
+    result = MemoryHost({callee_address: MemoryAccount(0, callee)}, homestead=False).run(delegate)
+    assert not result.success
+
+    # CREATE of a contract whose code is a single STOP, then calling it.
+    init = assemble("PUSH1 0 PUSH1 0 MSTORE8 PUSH1 1 PUSH1 0 RETURN")
+    creator = assemble("PUSH%d 0x%s PUSH1 0 MSTORE PUSH1 %d PUSH1 %d PUSH1 0 CREATE" % (
+        len(init), init.hex(), len(init), 32 - len(init)) + _RETURN_TOP)
+    host = MemoryHost()
+    result = host.run(creator, gas=100000)
+    assert result.success
+    address = result.output[12:]
+    assert host.get_code(address) == b"\x00"
+    assert host.get_code_hash(address) == ethsha3.hash(b"\x00")
+    assert address == ethsha3.hash(rlp.encode([bytes(19) + b"\x01", rlp.encode_int(0)]))[12:]
+    # Not enough gas for the code deposit: the init code gets 118 gas, uses
+    # 18, and the deposit needs 200. That fails in Homestead (taking all
+    # the gas), and before it makes an account without code.
+    for homestead in [True, False]:
+        host = MemoryHost(homestead=homestead)
+        result = host.run(creator, gas=3 + 3 + 6 + 3 + 3 + 3 + 32000 + 118)
+        assert result.success != homestead
+        if not homestead:
+            address = result.output[12:]
+            assert address in host.accounts and host.get_code(address) == b""
+
+    # Code is stored once, and decoded once.
+    store = mpt.HashTable()
+    code_store = CodeStore(store, decoded_cache_size=2)
+    code = assemble("PUSH1 1" + _RETURN_TOP)
+    code_hash = code_store.put(code)
+    assert code_store.put(code) == code_hash == ethsha3.hash(code)
+    assert len(store) == 1 and code_store.get(code_hash) == code
+    assert code_store.put(b"") == ethsha3.EMPTY_STRING_HASH and len(store) == 1
+    host = MemoryHost({b"\x01"*20: MemoryAccount(0, code)}, code_store=code_store)
+    for i in range(3):
+        assert host.run(code, to=b"\x01"*20).output[-1] == 1
+    assert code_store.decoded.misses == 1 and code_store.decoded.hits == 2
+    assert code_store.get_decoded(code_hash) is code_store.get_decoded(code_hash)
+    assert code_store.most_called(1) == [code_hash]
+
+    # Call counts are bounded, and keep the most called.
+    counting_store = CodeStore(store, call_count_limit=4)
+    hashes = [counting_store.put(bytes([i])) for i in range(10)]
+    for i, h in enumerate(hashes):
+        for j in range(10 - i):
+            counting_store.get_decoded(h)
+        assert len(counting_store.call_counts) <= 4
+    assert counting_store.most_called(2) == hashes[:2]
+
+    # Preloading keeps the most called when there are too many.
+    hashes = [code_store.put(bytes([i])) for i in range(3)] + [b"\x00"*32]
+    code_store.decoded.clear()
+    code_store.preload(hashes)
+    assert hashes[0] in code_store.decoded and hashes[1] in code_store.decoded
+    assert hashes[2] not in code_store.decoded
+    code_store.preload(hashes[3:])
+    assert b"\x00"*32 not in code_store.decoded
+
+    assert disassemble(assemble("PUSH2 0x1234 a: STOP"))[0] == "    0 PUSH2 0x1234"
+
+    print("All good.")
+
+if __name__ == "__main__":
+    _tests()
@@ -0,0 +1,215 @@
+
+# Integer factorization. Factors are found in tiers, cheapest first:
+#
+#   1. Trial division by small primes.
+#   2. Pollard's p-1, which quickly finds primes p where p - 1 is smooth.
+#   3. Pollard's rho (Brent's variant), which finds a prime p in about
+#      sqrt(p) steps whatever its form. Optionally on several cores.
+#
+# The rest is split recursively until prime.is_prime() says each part is prime.
+
+import math
+import multiprocessing
+import random
+import prime
+
+# Primes for trial division, so the other tiers only see factors of at
+# least TRIAL_BOUND.
+TRIAL_BOUND = 10000
+TRIAL_PRIMES = prime.primes_below(TRIAL_BOUND)
+
+# Smoothness bound for Pollard's p-1.
+P_MINUS_1_BOUND = 10000
+_P_MINUS_1_PRIMES = prime.primes_below(P_MINUS_1_BOUND + 1)
+
+# Returns the prime factorization of n > 0 as a map from prime to
+# multiplicity. If "workers" is more than one, Pollard's rho runs in that
+# many processes with different polynomials, and the first to find a
+# factor wins. Starting the processes costs around 10 ms, so this only pays
+# off for factors of more than about 32 bits.
+def factorize(n, workers=1):
+    assert n > 0
+    factors = {}
+
+    # Trial division.
+    for p in TRIAL_PRIMES:
+        if p*p > n:
+            break
+        if n % p == 0:
+            count = 0
+            while n % p == 0:
+                n //= p
+                count += 1
+            factors[p] = count
+
+    if n > 1:
+        _factorize_large(n, factors, workers)
+
+    return dict(sorted(factors.items()))
+
+# Add the factors of n, which has no factors in TRIAL_PRIMES, to "factors".
+def _factorize_large(n, factors, workers):
+    stack = [n]
+    while stack:
+        n = stack.pop()
+        if n == 1:
+            continue
+        if prime.is_prime(n):
+            factors[n] = factors.get(n, 0) + 1
+            continue
+
+        # Perfect powers defeat rho, and are cheap to check.
+        root, exponent = _perfect_power(n, TRIAL_BOUND)
+        if exponent > 1:
+            stack.extend([root]*exponent)
+            continue
+
+        d = pollard_p_minus_1(n)
+        if d is None:
+            d = _rho(n, workers)
+        stack.append(d)
+        stack.append(n//d)
+
+# Returns (r, k) with n = r^k and k as large as possible, where r is known
+# to be at least "min_root", so k is at most log_min_root(n).
+def _perfect_power(n, min_root=2):
+    max_k = n.bit_length()//(min_root.bit_length() - 1)
+    for k in range(max_k, 1, -1):
+        r = _integer_root(n, k)
+        if r > 1 and r**k == n:
+            # Take the largest k, so r isn't itself a power.
+            return r, k
+    return n, 1
+
+# Floor of the k-th root of n.
+def _integer_root(n, k):
+    r = 1 << ((n.bit_length() + k - 1)//k)
+    while True:
+        s = ((k - 1)*r + n//r**(k - 1))//k
+        if s >= r:
+            return r
+        r = s
+
+# Pollard's p-1 with smoothness bound B. Returns a non-trivial factor of
+# the composite n, or None.
+def pollard_p_minus_1(n, B=P_MINUS_1_BOUND):
+    a = 2
+    primes = _P_MINUS_1_PRIMES if B == P_MINUS_1_BOUND else prime.primes_below(B + 1)
+    for p in primes:
+        # Largest power of p not above B.
+        pk = p
+        while pk*p <= B:
+            pk *= p
+        a = pow(a, pk, n)
+    d = math.gcd(a - 1, n)
+    return d if 1 < d < n else None
+
+# Find a non-trivial factor of the composite n with rho, in this process
+# or racing "workers" processes.
+def _rho(n, workers):
+    if workers <= 1:
+        return _rho_worker((n, n))
+
+    # Each worker tries its own polynomials. Leaving the "with" terminates
+    # the losers.
+    with multiprocessing.Pool(workers) as pool:
+        for d in pool.imap_unordered(_rho_worker, [(n, seed) for seed in range(workers)]):
+            return d
+
+# Find a non-trivial factor of the composite n with rho, trying random
+# polynomials picked with the seed. Takes one tuple to suit Pool.
+def _rho_worker(args):
+    n, seed = args
+    rng = random.Random(seed)
+    while True:
+        d = pollard_brent(n, rng.randrange(1, n), rng.randrange(1, n))
+        if d is not None:
+            return d
+
+# Brent's variant of Pollard's rho on x -> x^2 + c (mod n), starting at y.
+# Products of differences are accumulated so that only one gcd is needed
+# every "m" steps. Returns a non-trivial factor of the composite n, or None
+# if this polynomial fails (or takes more than "max_steps", if specified);
+# then try another c.
+def pollard_brent(n, c, y, max_steps=None, m=128):
+    if n % 2 == 0:
+        return 2
+    g = 1
+    r = 1
+    q = 1
+    steps = 0
+    while g == 1:
+        x = y
+        for i in range(r):
+            y = (y*y + c) % n
+        k = 0
+        while k < r and g == 1:
+            ys = y
+            for i in range(min(m, r - k)):
+                y = (y*y + c) % n
+                q = q*abs(x - y) % n
+            g = math.gcd(q, n)
+            k += m
+        r *= 2
+        steps += r
+        if max_steps is not None and steps > max_steps and g == 1:
+            return None
+
+    if g == n:
+        # Overshot: back up one step at a time.
+        while True:
+            ys = (ys*ys + c) % n
+            g = math.gcd(abs(x - ys), n)
+            if g > 1:
+                break
+
+    return g if g != n else None
+
+# Returns the product of the factorization from factorize().
+def product(factors):
+    return math.prod(p**k for p, k in factors.items())
+
+def _tests():
+    assert factorize(1) == {}
+    assert factorize(2) == {2: 1}
+    assert factorize(360) == {2: 3, 3: 2, 5: 1}
+    for n in range(1, 3000):
+        factors = factorize(n)
+        assert product(factors) == n
+        assert all(prime.is_prime(p) for p in factors)
+
+    rng = random.Random(0)
+    for bits in [20, 32, 40]:
+        p = prime.random_prime_bits(bits, rng=rng)
+        q = prime.random_prime_bits(bits, rng=rng)
+        r = prime.random_prime_bits(bits//2, rng=rng)
+        n = p*q*r*r*7**3
+        assert factorize(n) == dict(sorted(_add({p: 1}, {q: 1}, {r: 2}, {7: 3}).items()))
+
+    # Perfect powers, and smooth p - 1.
+    p = prime.random_prime_bits(40, rng=rng)
+    assert factorize(p**5) == {p: 5}
+    assert _perfect_power(10007**4, TRIAL_BOUND) == (10007, 4)
+    assert _perfect_power(2**12*3**12) == (6, 12)
+    p = 2**3*3**5*5*7*11*13*17*19*41 + 1
+    assert prime.is_prime(p)
+    q = prime.random_prime_bits(64, rng=rng)
+    assert pollard_p_minus_1(p*q) == p
+
+    # On several processes.
+    p = prime.random_prime_bits(32, rng=rng)
+    q = prime.random_prime_bits(32, rng=rng)
+    assert factorize(p*q, workers=2) == dict(sorted({p: 1, q: 1}.items()))
+
+    print("All good.")
+
+# Sum the multiplicities of several factorizations.
+def _add(*factorizations):
+    result = {}
+    for factors in factorizations:
+        for p, k in factors.items():
+            result[p] = result.get(p, 0) + k
+    return result
+
+if __name__ == "__main__":
+    _tests()
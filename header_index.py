@@ -0,0 +1,173 @@
+# Header-only scan of a block file, for when only the canonical header
+# chain is needed (e.g., for indexing). Unlike full import, transactions and
+# ommers are skipped without being decoded, so no senders are recovered.
+# Each header is hashed straight from its bytes in the file, which is
+# what BlockHeader.compute_hash() would re-encode, and must link to the
+# previous one by its parentHash.
+#
+# The result can be written as a compact binary index of fixed-size
+# records, one per block:
+#
+#     python header_index.py BLOCKS_FILE INDEX_FILE
+#
+# Without arguments, runs the self-tests.
+
+import argparse
+import struct
+import sys
+import time
+import eth
+import ethsha3
+import rlp
+
+_MAGIC = b"HDRINDEX"
+
+# Block number, hash, timestamp, gas used, and the block's offset and
+# length in the block file.
+_RECORD = struct.Struct(">Q32sQQQI")
+
+# One scanned header.
+class HeaderEntry:
+    __slots__ = ["number", "hash", "timestamp", "gas_used", "offset", "length"]
+
+    def __init__(self, number, hash, timestamp, gas_used, offset, length):
+        self.number = number
+        self.hash = hash
+        self.timestamp = timestamp
+        self.gas_used = gas_used
+        # Location of the whole block in the block file.
+        self.offset = offset
+        self.length = length
+
+    def __eq__(self, o):
+        return isinstance(o, HeaderEntry) and \
+                all(getattr(self, name) == getattr(o, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return "HeaderEntry(%d, %s, %d, %d, %d, %d)" % (self.number, self.hash.hex(),
+                self.timestamp, self.gas_used, self.offset, self.length)
+
+# Scan the concatenated RLP-encoded blocks in blocks_binary, yielding a
+# HeaderEntry for each. Raises if a header doesn't link to the previous one,
+# or to "parent_hash" for the first one if it's specified.
+def scan_headers(blocks_binary, parent_hash=None):
+    b = memoryview(blocks_binary)
+    previous_number = None
+    offset = 0
+    while offset < len(b):
+        # Find the header, the first item of the block's list, and skip the rest.
+        is_list, header_offset, block_end = rlp.item_range(b, offset)
+        assert is_list
+        is_list, _, header_end = rlp.item_range(b, header_offset)
+        assert is_list
+
+        header = eth.HEADER_SCHEMA.decode(b[header_offset:header_end])
+        if previous_number is not None and header.number != previous_number + 1:
+            raise Exception("block %d follows block %d" % (header.number, previous_number))
+        if parent_hash is not None and header.parentHash != parent_hash:
+            raise Exception("parentHash mismatch in block %d: expected %s, got %s" % (
+                header.number, parent_hash.hex(), header.parentHash.hex()))
+
+        h = ethsha3.hash(b[header_offset:header_end])
+        yield HeaderEntry(header.number, h, header.timestamp, header.gasUsed,
+                offset, block_end - offset)
+
+        previous_number = header.number
+        parent_hash = h
+        offset = block_end
+
+# Write the entries to the binary file f. Returns the number written.
+def write_index(f, entries):
+    f.write(_MAGIC)
+    count = 0
+    for entry in entries:
+        f.write(_RECORD.pack(entry.number, entry.hash, entry.timestamp, entry.gas_used,
+            entry.offset, entry.length))
+        count += 1
+    return count
+
+# Index written by write_index(), read into memory. Entries are looked up
+# by block number.
+class HeaderIndex:
+    def __init__(self, data):
+        if data[:len(_MAGIC)] != _MAGIC:
+            raise Exception("not a header index file")
+        self.data = memoryview(data)[len(_MAGIC):]
+        if len(self.data) % _RECORD.size != 0:
+            raise Exception("truncated header index file")
+        self.first_number = self._entry_at(0).number if len(self) > 0 else 0
+
+    @staticmethod
+    def load(pathname):
+        with open(pathname, "rb") as f:
+            return HeaderIndex(f.read())
+
+    def __len__(self):
+        return len(self.data) // _RECORD.size
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._entry_at(i)
+
+    # Returns the HeaderEntry for the block number, which must be in the index.
+    def get(self, number):
+        i = number - self.first_number
+        if i < 0 or i >= len(self):
+            raise Exception("block %d is not in the index" % number)
+        return self._entry_at(i)
+
+    def _entry_at(self, i):
+        return HeaderEntry(*_RECORD.unpack_from(self.data, i*_RECORD.size))
+
+def _tests():
+    import io
+    import synthetic
+
+    chain = synthetic.make_chain(6, 5, 2)
+    binary = chain.encode()
+
+    entries = list(scan_headers(binary, ethsha3.ZERO_HASH))
+    assert len(entries) == len(chain.blocks)
+    for entry, b in zip(entries, chain.blocks):
+        assert entry.number == b.header.number
+        assert entry.hash == b.header.compute_hash()
+        assert entry.timestamp == b.header.timestamp
+        assert entry.gas_used == b.header.gasUsed
+        assert eth.Block.decode(binary[entry.offset:entry.offset + entry.length]).header.number == entry.number
+
+    f = io.BytesIO()
+    assert write_index(f, entries) == len(entries)
+    index = HeaderIndex(f.getvalue())
+    assert list(index) == entries
+    assert index.get(3) == entries[3]
+
+    # Broken link.
+    try:
+        list(scan_headers(binary[entries[1].offset:], ethsha3.ZERO_HASH))
+        assert False
+    except Exception as e:
+        assert "parentHash" in str(e)
+
+    print("All good.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a header index of a block file.")
+    parser.add_argument("blocks", help="concatenated RLP-encoded blocks")
+    parser.add_argument("index", help="output index file")
+    args = parser.parse_args()
+
+    with open(args.blocks, "rb") as f:
+        blocks_binary = f.read()
+
+    begin = time.perf_counter()
+    with open(args.index, "wb") as f:
+        count = write_index(f, scan_headers(blocks_binary, ethsha3.ZERO_HASH))
+    elapsed = time.perf_counter() - begin
+    print("Indexed %d headers in %.1f seconds (%.0f headers/sec)" % (count, elapsed,
+        count/elapsed if elapsed > 0 else 0))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        _tests()
+    else:
+        main()
@@ -13,22 +13,18 @@ _T_FLAG = 0x20
 # is encoded in the first nybble (see spec).
 def bytes_to_hp(b, begin, end, t):
     nybble_count = end - begin
-    out = bytearray(nybble_count // 2 + 1)
-    if t != 0:
-        out[0] |= _T_FLAG
+    flags = _T_FLAG if t != 0 else 0
+    v = nybbles.nybbles_to_int(b, begin, end)
 
     if nybble_count % 2 != 0:
-        out[0] |= _ODD_FLAG
-        o = 1
+        # Flags share the first byte with the first nybble.
+        flags |= _ODD_FLAG
+        v |= (flags >> 4) << (nybble_count*4)
     else:
-        o = 2
+        # Flags get a byte of their own.
+        v |= flags << (nybble_count*4)
 
-    for i in range(begin, end):
-        v = nybbles.get_nybble(b, i)
-        out[o // 2] |= v << 4 if o % 2 == 0 else v
-        o += 1
-
-    return bytes(out)
+    return v.to_bytes(nybble_count // 2 + 1, "big")
 
 # Converts an array of nybbles (as a bytes) to a hex prefix.
 def nybbles_to_hp(ny, t):
@@ -54,6 +50,11 @@ def hp_to_nybbles(hp):
 
     return ny
 
+# Returns (begin, end), the nybble indices of the path within hp, so that
+# hp itself can be used as packed key bytes without unpacking it.
+def hp_nybble_range(hp):
+    return (1 if _is_odd_nybble_count(hp) else 2), len(hp)*2
+
 # Whether the t that was passed in to this hp was non-zero.
 def get_flag(hp):
     assert isinstance(hp, bytes)
@@ -67,31 +68,17 @@ def common_prefix(hp, b, b_begin):
     assert isinstance(hp, bytes)
     assert isinstance(b, bytes)
 
-    hp_count = _get_nybble_count(hp)
+    hp_begin, hp_end = hp_nybble_range(hp)
+    hp_count = hp_end - hp_begin
     b_count = len(b)*2 - b_begin
-    count = min(hp_count, b_count)
-
-    for i in range(count):
-        hp_nybble = _get_hp_nybble(hp, i)
-        b_nybble = nybbles.get_nybble(b, b_begin + i)
-
-        if hp_nybble != b_nybble:
-            return i, hp_count - i, b_count - i
+    count = nybbles.common_prefix_length(hp, hp_begin, hp_end, b, b_begin, len(b)*2)
 
     return count, hp_count - count, b_count - count
 
-# The number of nybbles in the hp.
-def _get_nybble_count(hp):
-    return (len(hp) - 1)*2 + (1 if _is_odd_nybble_count(hp) else 0)
-
 # Whether the hp has an odd number of nybbles.
 def _is_odd_nybble_count(hp):
     return (hp[0] & _ODD_FLAG) != 0
 
-# Get the ith nybble of hp b.
-def _get_hp_nybble(hp, i):
-    return nybbles.get_nybble(hp, i + (1 if _is_odd_nybble_count(hp) else 2))
-
 if __name__ == "__main__":
     b = bytes([0x12, 0x34, 0x56, 0x78])
 
@@ -132,6 +119,10 @@ if __name__ == "__main__":
     assert common_prefix(bytes_to_hp(b, 4, 8, 0), b"\x12\x34\x56\x79", 4) == (3, 1, 1)
     assert common_prefix(bytes_to_hp(b, 0, 8, 0), b"\x12", 0) == (2, 6, 0)
 
+    # Hex prefix nybble range.
+    assert hp_nybble_range(b"\x00\x12\x34") == (2, 6)
+    assert hp_nybble_range(b"\x31\x23") == (1, 4)
+
     # Nybbles to hex prefix.
     assert nybbles_to_hp(b"\x01\x02\x03\x04", 0) == b"\x00\x12\x34"
     assert nybbles_to_hp(b"\x01\x02\x03\x04", 1) == b"\x20\x12\x34"
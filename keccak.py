@@ -0,0 +1,112 @@
+
+# Keccak-256 in pure Python, for when no compiled implementation is
+# installed (see ethsha3.py). This is the original Keccak padding, not the
+# one of the final SHA-3 standard (hashlib.sha3_256).
+#
+# The state is a flat list of 25 64-bit lanes, lane (x, y) at x + 5*y.
+
+import struct
+
+# Bytes absorbed per permutation: 1600 bits minus twice the output size.
+RATE = 136
+
+_MASK = (1 << 64) - 1
+
+_ROUND_CONSTANTS = [
+        0x0000000000000001, 0x0000000000008082, 0x800000000000808A, 0x8000000080008000,
+        0x000000000000808B, 0x0000000080000001, 0x8000000080008081, 0x8000000000008009,
+        0x000000000000008A, 0x0000000000000088, 0x0000000080008009, 0x000000008000000A,
+        0x000000008000808B, 0x800000000000008B, 0x8000000000008089, 0x8000000000008003,
+        0x8000000000008002, 0x8000000000000080, 0x000000000000800A, 0x800000008000000A,
+        0x8000000080008081, 0x8000000000008080, 0x0000000080000001, 0x8000000080008008,
+]
+
+# Rotation of each lane in the rho step.
+_ROTATIONS = [
+        0, 1, 62, 28, 27,
+        36, 44, 6, 55, 20,
+        3, 10, 43, 25, 39,
+        41, 45, 15, 21, 8,
+        18, 2, 61, 56, 14,
+]
+
+# The rho and pi steps together, as (source lane, destination lane,
+# rotation) tuples: lane (x, y) rotated goes to (y, 2x + 3y).
+_RHO_PI = [(x + 5*y, y + 5*((2*x + 3*y) % 5), _ROTATIONS[x + 5*y])
+        for y in range(5) for x in range(5)]
+
+_LANES = struct.Struct("<17Q")
+_DIGEST = struct.Struct("<4Q")
+
+# The Keccak-f[1600] permutation, returning a new state.
+def _permute(A):
+    mask = _MASK
+    rho_pi = _RHO_PI
+    B = [0]*25
+    for rc in _ROUND_CONSTANTS:
+        # Theta: XOR each lane with the parities of two nearby columns.
+        c0 = A[0] ^ A[5] ^ A[10] ^ A[15] ^ A[20]
+        c1 = A[1] ^ A[6] ^ A[11] ^ A[16] ^ A[21]
+        c2 = A[2] ^ A[7] ^ A[12] ^ A[17] ^ A[22]
+        c3 = A[3] ^ A[8] ^ A[13] ^ A[18] ^ A[23]
+        c4 = A[4] ^ A[9] ^ A[14] ^ A[19] ^ A[24]
+        D = (
+                c4 ^ (((c1 << 1) | (c1 >> 63)) & mask),
+                c0 ^ (((c2 << 1) | (c2 >> 63)) & mask),
+                c1 ^ (((c3 << 1) | (c3 >> 63)) & mask),
+                c2 ^ (((c4 << 1) | (c4 >> 63)) & mask),
+                c3 ^ (((c0 << 1) | (c0 >> 63)) & mask),
+        )
+
+        # Rho and pi: rotate each lane and move it.
+        for source, destination, rotation in rho_pi:
+            a = A[source] ^ D[source % 5]
+            B[destination] = ((a << rotation) | (a >> (64 - rotation))) & mask
+
+        # Chi: combine each lane with the next two in its row.
+        A = [
+                B[0] ^ (~B[1] & B[2]), B[1] ^ (~B[2] & B[3]), B[2] ^ (~B[3] & B[4]),
+                B[3] ^ (~B[4] & B[0]), B[4] ^ (~B[0] & B[1]),
+                B[5] ^ (~B[6] & B[7]), B[6] ^ (~B[7] & B[8]), B[7] ^ (~B[8] & B[9]),
+                B[8] ^ (~B[9] & B[5]), B[9] ^ (~B[5] & B[6]),
+                B[10] ^ (~B[11] & B[12]), B[11] ^ (~B[12] & B[13]), B[12] ^ (~B[13] & B[14]),
+                B[13] ^ (~B[14] & B[10]), B[14] ^ (~B[10] & B[11]),
+                B[15] ^ (~B[16] & B[17]), B[16] ^ (~B[17] & B[18]), B[17] ^ (~B[18] & B[19]),
+                B[18] ^ (~B[19] & B[15]), B[19] ^ (~B[15] & B[16]),
+                B[20] ^ (~B[21] & B[22]), B[21] ^ (~B[22] & B[23]), B[22] ^ (~B[23] & B[24]),
+                B[23] ^ (~B[24] & B[20]), B[24] ^ (~B[20] & B[21]),
+        ]
+
+        # Iota.
+        A[0] ^= rc
+    return A
+
+# Return the length-32 bytes object for the Keccak-256 hash of b.
+def keccak_256(b):
+    # Pad with 0x01 ... 0x80 to a multiple of the rate.
+    padded = bytearray(b)
+    padded.append(0x01)
+    padded.extend(bytes(-len(padded) % RATE))
+    padded[-1] |= 0x80
+
+    A = [0]*25
+    for offset in range(0, len(padded), RATE):
+        lanes = _LANES.unpack_from(padded, offset)
+        for i in range(17):
+            A[i] ^= lanes[i]
+        A = _permute(A)
+    return _DIGEST.pack(A[0], A[1], A[2], A[3])
+
+def _tests():
+    assert keccak_256(b"").hex() == \
+            "c5d2460186f7233c927e7db2dcc703c0e500b653ca82273b7bfad8045d85a470"
+    assert keccak_256(b"abc").hex() == \
+            "4e03657aea45a94fc7d47ba826c8d667c0d1e6e33a64a036ec44f58fa12d6c45"
+    # Around the block size, where the padding takes one byte, or a new block.
+    for size in [135, 136, 137, 272]:
+        assert len(keccak_256(bytes(size))) == 32
+    assert keccak_256(bytes(135)) != keccak_256(bytes(136))
+    print("All good.")
+
+if __name__ == "__main__":
+    _tests()
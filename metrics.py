@@ -0,0 +1,348 @@
+
+# Lightweight counters and timing histograms for finding where import time
+import weakref
+# goes. Disabled by default. Instrumented code checks "metrics.enabled"
+# before recording anything, so while disabled the cost is one attribute
+# lookup per call site:
+#
+#     if metrics.enabled:
+#         metrics.count("trie.get")
+#
+# Counter and histogram names are dotted, e.g. "store.read" or "evm.block".
+
+import cProfile
+import collections
+import json
+import sys
+import threading
+import time
+
+# Whether metrics are being recorded.
+enabled = False
+
+# Counters are kept per thread, so that count(), which hot paths call for
+# every trie node, takes no lock. Each thread's counters are registered in
+# _all_counters, as (weak reference to the thread, counters), when it first
+# counts, and summary() adds them up. The counters of threads that have
+# finished are folded into _finished_counters then, so that short-lived
+# threads (e.g., those of each ImportPipeline run) don't pile up.
+_local = threading.local()
+_all_counters = []
+_finished_counters = collections.defaultdict(int)
+_histograms = {}
+# Histograms, and the registration of counters, may happen from several threads.
+_lock = threading.Lock()
+
+# Profiling of a block range, see profile_blocks().
+_profile_range = None
+_profiler = None
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+# Clear everything recorded. Counts made by other threads while this runs
+# may be lost.
+def reset():
+    with _lock:
+        for thread, counters in _all_counters:
+            counters.clear()
+        _finished_counters.clear()
+        _histograms.clear()
+
+# Add n to the named counter.
+def count(name, n=1):
+    try:
+        counters = _local.counters
+    except AttributeError:
+        counters = _register_counters()
+    counters[name] += n
+
+# Make the calling thread's counters.
+def _register_counters():
+    counters = collections.defaultdict(int)
+    _local.counters = counters
+    with _lock:
+        _all_counters.append((weakref.ref(threading.current_thread()), counters))
+    return counters
+
+# Sum of the counters of all threads. Call with _lock held.
+def _merged_counters():
+    running = []
+    for thread, counters in _all_counters:
+        thread = thread()
+        if thread is None or not thread.is_alive():
+            # The thread can't count anymore.
+            for name, n in counters.items():
+                _finished_counters[name] += n
+        else:
+            running.append((weakref.ref(thread), counters))
+    _all_counters[:] = running
+
+    merged = collections.defaultdict(int, _finished_counters)
+    for thread, counters in running:
+        # copy() is atomic, so the owning thread can keep counting.
+        for name, n in counters.copy().items():
+            merged[name] += n
+    return dict(merged)
+
+# Record a duration, in seconds, in the named histogram.
+def record(name, seconds):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = Histogram()
+            _histograms[name] = histogram
+        histogram.add(seconds)
+
+# Context manager that records the duration of its block in the named
+# histogram, or does nothing if metrics are disabled.
+def timer(name):
+    return _Timer(name) if enabled else _NULL_TIMER
+
+class _Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.name, time.perf_counter() - self.begin)
+
+class _NullTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+# Histogram of durations with power-of-two microsecond buckets.
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        # Bucket i holds durations of less than 2**i microseconds (and at
+        # least 2**(i - 1) microseconds for i > 0).
+        self.buckets = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        i = int(seconds*1e6).bit_length()
+        if i >= len(self.buckets):
+            self.buckets.extend([0]*(i + 1 - len(self.buckets)))
+        self.buckets[i] += 1
+
+    # Upper bound of the bucket containing percentile p (0 to 100), in seconds.
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        target = self.count*p/100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min(2**i/1e6, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+                "count": self.count,
+                "total": self.total,
+                "mean": self.total/self.count if self.count else 0,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+        }
+
+# Everything recorded so far, as a dictionary.
+def summary():
+    with _lock:
+        return {
+                "counters": _merged_counters(),
+                "histograms": {name: h.as_dict() for name, h in _histograms.items()},
+        }
+
+def to_json():
+    return json.dumps(summary(), indent=4, sort_keys=True)
+
+def dump(f=None):
+    f = f or sys.stdout
+    s = summary()
+    print("Metrics:", file=f)
+    for name, value in sorted(s["counters"].items()):
+        print("    %-32s %12d" % (name, value), file=f)
+    for name, h in sorted(s["histograms"].items()):
+        print("    %-32s %8d x, mean %9.3f ms, p90 %9.3f ms, max %9.3f ms" % (name,
+            h["count"], h["mean"]*1e3, h["p90"]*1e3, h["max"]*1e3), file=f)
+
+# Calls report() every "interval" seconds from a background thread until
+# stopped. By default, prints the summary. If "pathname" is specified,
+# writes the JSON summary to that file instead.
+class Reporter:
+    def __init__(self, interval, pathname=None, report=None):
+        self.interval = interval
+        self.pathname = pathname
+        self.report = report or self._report
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def _report(self):
+        if self.pathname is None:
+            dump()
+        else:
+            with open(self.pathname, "w") as f:
+                f.write(to_json() + "\n")
+
+# Profile blocks "first" through "last" (inclusive) with cProfile and write
+# the stats to "pathname" (read them with the pstats module) once block
+# "last" is done. Enables metrics, since that's what calls the hooks below.
+def profile_blocks(first, last, pathname):
+    global _profile_range
+    _profile_range = (first, last, pathname)
+    enable()
+
+# Called by EthereumVirtualMachine.process_block() when metrics are enabled.
+def block_started(number):
+    global _profiler
+    if _profile_range is not None and _profile_range[0] == number:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+def block_finished(number):
+    global _profiler, _profile_range
+    if _profiler is not None and _profile_range[1] == number:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_range[2])
+        _profiler = None
+        _profile_range = None
+
+# Statistical profiler: samples the stack of one thread every "interval"
+# seconds from a background thread, and counts the functions it finds.
+# Unlike cProfile it doesn't slow down the profiled code, so timings stay
+# realistic.
+class Sampler:
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.samples = 0
+        # Samples with the function at the top of the stack.
+        self.self_counts = collections.Counter()
+        # Samples with the function anywhere in the stack.
+        self.total_counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.self_counts[_frame_name(frame)] += 1
+            seen = set()
+            while frame is not None:
+                name = _frame_name(frame)
+                if name not in seen:
+                    seen.add(name)
+                    self.total_counts[name] += 1
+                frame = frame.f_back
+
+    def dump(self, limit=20, f=None):
+        f = f or sys.stdout
+        print("Samples: %d" % self.samples, file=f)
+        print("    %6s %6s  function" % ("self", "total"), file=f)
+        for name, n in self.self_counts.most_common(limit):
+            print("    %5.1f%% %5.1f%%  %s" % (100*n/self.samples,
+                100*self.total_counts[name]/self.samples, name), file=f)
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "%s:%d(%s)" % (code.co_filename.rsplit("/", 1)[-1], code.co_firstlineno, code.co_name)
+
+def _tests():
+    reset()
+    enable()
+    try:
+        # Counters from several threads add up.
+        def work():
+            for i in range(10000):
+                count("test.count")
+            count("test.other", 5)
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        count("test.count")
+        counters = summary()["counters"]
+        assert counters["test.count"] == 40001 and counters["test.other"] == 20
+        # Finished threads' counters are folded together.
+        assert len(_all_counters) == 1
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        assert summary()["counters"]["test.count"] == 50001 and len(_all_counters) == 1
+
+        # Bucket i holds durations below 2**i microseconds.
+        h = Histogram()
+        for seconds in [0, 1.5e-6, 3e-6, 3e-6, 1e-3]:
+            h.add(seconds)
+        assert h.buckets[:3] == [1, 1, 2] and h.buckets[10] == 1 and len(h.buckets) == 11
+        assert h.percentile(50) == 4e-6 and h.percentile(100) == 1e-3
+        assert h.as_dict()["min"] == 0 and h.as_dict()["max"] == 1e-3
+        assert Histogram().percentile(50) == 0
+
+        with timer("test.timer"):
+            time.sleep(0.01)
+        h = summary()["histograms"]["test.timer"]
+        assert h["count"] == 1 and h["min"] >= 0.01
+
+        reset()
+        assert summary() == {"counters": {}, "histograms": {}}
+    finally:
+        disable()
+    # Disabled timers record nothing.
+    with timer("test.timer"):
+        pass
+    assert summary()["histograms"] == {}
+
+    print("All good.")
+
+if __name__ == "__main__":
+    _tests()
@@ -2,20 +2,45 @@
 # Implementation of Merkle Patricia Trie.
 # https://eth.wiki/en/fundamentals/patricia-tree
 
+import itertools
 import json
+from array import array
+import cache
 import rlp
 import hexprefix
 import nybbles
 import ethsha3
+import metrics
 from testing import random_bytes
 
 NO_HASH = b""
 NO_VALUE = b""
 INDENT = "    "
 
+# Returned by _delete() when the key isn't in the sub-tree.
+_UNCHANGED = object()
+
 # This is the root of an empty tree (secured or not).
 EMPTY_TREE_ROOT = bytes.fromhex("56e81f171bcc55a6ff8345e692c0f86e5b48e01b996cadc001622fb5e363b421")
 
+# Hashes of secured keys, by key. Addresses of popular accounts (miners,
+# exchanges) are looked up over and over, so this saves most of the keccak
+# calls of secured tries. Shared by all tries and threads.
+SECURED_KEY_CACHE_SIZE = 100000
+secured_key_cache = cache.LruCache(SECURED_KEY_CACHE_SIZE)
+
+# Returns the key under which a secured trie stores "key": its hash. Pass
+# the result to set_hashed() and get_hashed() to hash only once for several
+# operations on the same key.
+def hash_secured_key(key):
+    h = secured_key_cache.get(key)
+    if h is None:
+        if metrics.enabled:
+            metrics.count("trie.secured_keys_hashed")
+        h = ethsha3.hash(key)
+        secured_key_cache.set(key, h)
+    return h
+
 # Get the nybble_index for the b bytes object, where 0 means the
 # most significant nybble of the first byte, 1 is the least significant,
 # etc.
@@ -38,118 +63,320 @@ def _is_extension(hp):
 # 16 are the roots of the sub-trees for the nybble in the trie, and the 17th element,
 # if not NO_VALUE, is the value for that key. Missing children (in the first 16 entries)
 # are represented by an empty byte array.
+#
+# Concurrency: a MerklePatriciaTrie object never changes (set() returns a new
+# one), and nodes are only ever added to the store, keyed by their hash. So
+# any number of threads can read from tries sharing a store, without locks,
+# while one thread writes new roots with set(), as long as the store allows
+# a single writer with concurrent readers (HashTable and ArenaHashTable do).
+# A reader sees the state of the root it was given, never a partial write.
 class MerklePatriciaTrie:
     # key_value_store is a hash map with set(k,v) and get(k) methods.
     # Keys are fixed-length (256-bit) bytes objects.
     # Values are arbitrary bytes objects. The get() method throws on unknown key.
     # The root, if specified, is a 256-bit bytes object.
-    def __init__(self, key_value_store, root=NO_HASH, secured=False):
+    # node_cache, if specified, is a cache.LruCache of decoded nodes by hash
+    # used by get(). It can be shared by tries with different roots and
+    # between threads.
+    def __init__(self, key_value_store, root=NO_HASH, secured=False, node_cache=None):
         self.key_value_store = key_value_store
         self.root = root
         self.secured = secured
+        self.node_cache = node_cache
 
     # key and value are arbitrary bytes objects. Does not modify the current
     # object -- returns a new MerklePatriciaTrie object.
     def set(self, key, value):
+        assert isinstance(key, bytes)
+        if self.secured:
+            key = hash_secured_key(key)
+        return self.set_hashed(key, value)
+
+    # Like set(), but for a secured trie "key" is already hashed (see
+    # hash_secured_key()). Same as set() for other tries.
+    def set_hashed(self, key, value):
         assert isinstance(key, bytes)
         assert isinstance(value, bytes)
+        if metrics.enabled:
+            metrics.count("trie.set")
+        new_root = self._set(key, 0, len(key)*2, self.root, value, is_root=True)
+        return MerklePatriciaTrie(self.key_value_store, new_root, self.secured, self.node_cache)
+
+    # Returns a new MerklePatriciaTrie without the key, which need not be in
+    # this one. The result has the root the trie would have if the key had
+    # never been set.
+    def delete(self, key):
+        assert isinstance(key, bytes)
         if self.secured:
-            key = ethsha3.hash(key)
-        new_root = self._set(nybbles.bytes_to_nybbles(key), self.root, 0, value)
-        return MerklePatriciaTrie(self.key_value_store, new_root, self.secured)
+            key = hash_secured_key(key)
+        return self.delete_hashed(key)
+
+    # Like delete(), but for a secured trie "key" is already hashed.
+    def delete_hashed(self, key):
+        assert isinstance(key, bytes)
+        if metrics.enabled:
+            metrics.count("trie.delete")
+        v = self._delete(key, 0, self.root)
+        if v is _UNCHANGED:
+            return self
+        new_root = NO_HASH if v is None else self._put_in_store(v, False)
+        return MerklePatriciaTrie(self.key_value_store, new_root, self.secured, self.node_cache)
 
     # Returns the value for the key (which are both bytes objects), or NO_VALUE
     # if this object does not contain the key.
     def get(self, key):
         assert isinstance(key, bytes)
         if self.secured:
-            key = ethsha3.hash(key)
+            key = hash_secured_key(key)
+        return self.get_hashed(key)
+
+    # Like get(), but for a secured trie "key" is already hashed (see
+    # hash_secured_key()). Same as get() for other tries.
+    def get_hashed(self, key):
+        assert isinstance(key, bytes)
+        if metrics.enabled:
+            metrics.count("trie.get")
         return self._get(key, self.root, 0)
 
+    # Returns the Merkle proof for the key, as in eth_getProof: the RLP
+    # encodings of the stored nodes on the path from the root towards the
+    # key, whether or not the key is in the trie. See verify_proof().
+    def get_proof(self, key):
+        assert isinstance(key, bytes)
+        if self.secured:
+            key = hash_secured_key(key)
+
+        proof = []
+        root = self.root
+        nybble_index = 0
+        while root != NO_HASH:
+            if isinstance(root, list) or isinstance(root, tuple):
+                # Inline nodes are part of their parent's encoding.
+                v = root
+            else:
+                encoded = bytes(self.key_value_store.get(root))
+                proof.append(encoded)
+                v = rlp.decode(encoded)
+
+            if len(v) == 2:
+                advance, hp_left, b_left = hexprefix.common_prefix(v[0], key, nybble_index)
+                if _is_leaf(v[0]) or hp_left != 0:
+                    break
+                root = v[1]
+                nybble_index += advance
+            else:
+                if nybble_index == len(key)*2:
+                    break
+                root = v[_get_nybble(key, nybble_index)]
+                nybble_index += 1
+
+        return proof
+
+    # Returns a new MerklePatriciaTrie containing the (key, value) pairs of
+    # "items", an iterable of bytes pairs. If a key appears more than once
+    # the last value wins. The result is identical to calling set() for
+    # each pair on an empty trie, but each node is built and hashed exactly
+    # once, rather than once per key inserted below it.
+    @staticmethod
+    def build(key_value_store, items, secured=False):
+        m = {}
+        for key, value in items:
+            assert isinstance(key, bytes)
+            assert isinstance(value, bytes)
+            if secured:
+                key = hash_secured_key(key)
+            m[key] = value
+        trie = MerklePatriciaTrie(key_value_store, NO_HASH, secured)
+        keys = sorted(m)
+        if keys:
+            trie.root = trie._put_in_store(trie._build(keys, m, 0, len(keys), 0), False)
+        return trie
+
+    # Recurse to build the node for keys[begin:end], which are sorted and
+    # share their first "depth" nybbles. Returns the node as a list.
+    def _build(self, keys, m, begin, end, depth):
+        first = keys[begin]
+        if end - begin == 1:
+            return [hexprefix.bytes_to_hp(first, depth, len(first)*2, 1), m[first]]
+
+        # Since the keys are sorted, the prefix common to the first and
+        # last is common to all of them.
+        last = keys[end - 1]
+        length = nybbles.common_prefix_length(first, depth, len(first)*2, last, depth, len(last)*2)
+        if length != 0:
+            branch = self._build_branch(keys, m, begin, end, depth + length)
+            return [hexprefix.bytes_to_hp(first, depth, depth + length, 0),
+                    self._put_in_store(branch, True)]
+        return self._build_branch(keys, m, begin, end, depth)
+
+    # Build a branch for keys[begin:end], which diverge at nybble "depth".
+    def _build_branch(self, keys, m, begin, end, depth):
+        node = [NO_HASH]*16 + [NO_VALUE]
+
+        # A key that ends here sorts first, and goes in the branch itself.
+        if len(keys[begin])*2 == depth:
+            node[16] = m[keys[begin]]
+            begin += 1
+
+        while begin < end:
+            nybble = _get_nybble(keys[begin], depth)
+            group_end = begin + 1
+            while group_end < end and _get_nybble(keys[group_end], depth) == nybble:
+                group_end += 1
+            child = self._build(keys, m, begin, group_end, depth + 1)
+            node[nybble] = self._put_in_store(child, True)
+            begin = group_end
+
+        return node
+
     # Recurse to set the value for the root.
     #
-    # key: the key in nybble format (one byte per nybble in the original key).
+    # key: the key as packed bytes (two nybbles per byte). This is either the
+    #     key passed to set() or the hex prefix of an existing node.
+    # begin, end: the nybble indices of the part of the key left to process.
     # root: the root we're replacing (NO_HASH or a bytes hash).
-    # nybble_index: the number of nybbles processed so far.
     # value: the value to insert at this key.
     # value_is_hash: whether the value is a value or a hash of a sub-tree.
-    def _set(self, key, root, nybble_index, value, value_is_hash=False):
+    # is_root: whether this is the top of the trie, which is never inlined.
+    def _set(self, key, begin, end, root, value, value_is_hash=False, is_root=False):
         if root == NO_HASH:
-            if nybble_index == len(key) and value_is_hash:
+            if begin == end and value_is_hash:
                 # No key left to encode, just use value.
                 return value
             else:
                 # Make leaf or extension.
-                v = [hexprefix.nybbles_to_hp(key[nybble_index:], 0 if value_is_hash else 1),
-                        value]
+                v = [hexprefix.bytes_to_hp(key, begin, end, 0 if value_is_hash else 1), value]
         else:
             v = self._get_from_store(root)
             if len(v) == 2:
                 # Leaf or extension.
-                old_key_ny = hexprefix.hp_to_nybbles(v[0])
-                new_key_ny = key[nybble_index:]
-                prefix, old_key_left, new_key_left = nybbles.common_prefix(old_key_ny, new_key_ny)
-                # print("common_prefix", prefix.hex(), old_key_left.hex(), new_key_left.hex())
-                if _is_leaf(v[0]) and old_key_left == b"" and new_key_left == b"":
+                hp = v[0]
+                hp_begin, hp_end = hexprefix.hp_nybble_range(hp)
+                prefix_length = nybbles.common_prefix_length(hp, hp_begin, hp_end, key, begin, end)
+                old_key_left = hp_end - hp_begin - prefix_length
+                new_key_left = end - begin - prefix_length
+                is_leaf = _is_leaf(hp)
+                if is_leaf and old_key_left == 0 and new_key_left == 0:
                     # Replace value in existing leaf.
                     assert not value_is_hash # Not sure if this can happen.
                     v[-1] = value
                 else:
                     # Keys don't match. We must make a branch here.
-                    if _is_leaf(v[0]) or old_key_left != b"":
+                    if is_leaf or old_key_left != 0:
                         # Old key was a leaf, or a longer extension than our prefix.
                         # Create a branch for the prefix.
                         branch = [NO_HASH]*16 + [NO_VALUE]
 
-                        if _is_leaf(v[0]) and old_key_left == b"":
+                        if is_leaf and old_key_left == 0:
                             # Put old leaf value in this branch since key matches.
                             branch[-1] = v[1]
                         else:
-                            # Put old value as sub-tree.
-                            old_key = key[:nybble_index] + prefix + old_key_left
-                            branch[old_key_left[0]] = self._set(old_key, branch[old_key_left[0]],
-                                    nybble_index + 1 + len(prefix), v[1],
-                                    value_is_hash=_is_extension(v[0]))
+                            # Put old value as sub-tree, keyed by the rest of its hex prefix.
+                            old_index = hp_begin + prefix_length
+                            old_nybble = nybbles.get_nybble(hp, old_index)
+                            branch[old_nybble] = self._set(hp, old_index + 1, hp_end,
+                                    branch[old_nybble], v[1], value_is_hash=not is_leaf)
                     else:
                         # It's an extension and the old key is already
                         # of the right length. Use existing branch.
                         branch = self._get_from_store(v[1])
                         assert len(branch) == 17
 
-                    if new_key_left == b"":
+                    if new_key_left == 0:
                         # Put new value in this branch since key matches.
                         assert not value_is_hash # Not sure if this can happen.
                         branch[-1] = value
                     else:
                         # Put new value as sub-tree.
                         assert not value_is_hash # Not sure if this can happen.
-                        branch[new_key_left[0]] = self._set(key, branch[new_key_left[0]],
-                                nybble_index + 1 + len(prefix), value, value_is_hash=value_is_hash)
-                    # print("branch", branch)
+                        new_index = begin + prefix_length
+                        new_nybble = nybbles.get_nybble(key, new_index)
+                        branch[new_nybble] = self._set(key, new_index + 1, end,
+                                branch[new_nybble], value, value_is_hash=value_is_hash)
 
-                    if prefix == b"":
+                    if prefix_length == 0:
                         # No prefix, use branch directly.
                         v = branch
                     else:
                         # Make extension with prefix.
-                        v = [hexprefix.nybbles_to_hp(prefix, 0),
+                        v = [hexprefix.bytes_to_hp(key, begin, begin + prefix_length, 0),
                                 self._put_in_store(branch, True)]
             else:
                 assert len(v) == 17
 
-                if nybble_index == len(key):
+                if begin == end:
                     # Done recursing, set value.
                     assert not value_is_hash # Not sure if this can happen.
                     v[-1] = value
-                    new_root = root
                 else:
-                    nybble = key[nybble_index]
-                    old_root = v[nybble]
+                    nybble = nybbles.get_nybble(key, begin)
                     assert not value_is_hash # Not sure if this can happen.
-                    new_root = self._set(key, old_root, nybble_index + 1, value, value_is_hash=value_is_hash)
-                    v[nybble] = new_root
+                    v[nybble] = self._set(key, begin + 1, end, v[nybble], value,
+                            value_is_hash=value_is_hash)
 
-        return self._put_in_store(v, nybble_index != 0)
+        return self._put_in_store(v, not is_root)
+
+    # Recurse to delete the key from the root, of which "begin" nybbles have
+    # already been processed. Returns the new node as a list, None if the
+    # node is now empty, or _UNCHANGED if the key isn't there. A branch left
+    # with a single entry is folded into a leaf or extension, so that the
+    # trie stays in the canonical form that set() alone would produce.
+    def _delete(self, key, begin, root):
+        if root == NO_HASH:
+            return _UNCHANGED
+
+        end = len(key)*2
+        v = self._get_from_store(root)
+        if len(v) == 2:
+            # Leaf or extension.
+            hp = v[0]
+            hp_begin, hp_end = hexprefix.hp_nybble_range(hp)
+            length = hp_end - hp_begin
+            if nybbles.common_prefix_length(hp, hp_begin, hp_end, key, begin, end) != length:
+                return _UNCHANGED
+            if _is_leaf(hp):
+                return None if begin + length == end else _UNCHANGED
+            child = self._delete(key, begin + length, v[1])
+            if child is _UNCHANGED:
+                return _UNCHANGED
+            # A branch always keeps at least one entry, so child isn't None.
+            if len(child) == 17:
+                return [hp, self._put_in_store(child, True)]
+            return self._join(hexprefix.hp_to_nybbles(hp), child)
+
+        assert len(v) == 17
+        if begin == end:
+            if v[-1] == NO_VALUE:
+                return _UNCHANGED
+            v[-1] = NO_VALUE
+        else:
+            nybble = _get_nybble(key, begin)
+            child = self._delete(key, begin + 1, v[nybble])
+            if child is _UNCHANGED:
+                return _UNCHANGED
+            v[nybble] = NO_HASH if child is None else self._put_in_store(child, True)
+
+        children = [i for i in range(16) if v[i] != NO_HASH]
+        if v[-1] != NO_VALUE:
+            if children:
+                return v
+            # Only the value is left.
+            return [hexprefix.nybbles_to_hp(b"", 1), v[-1]]
+        if len(children) > 1:
+            return v
+        # Only one child is left: make it an extension, or merge the nybble
+        # into the child's path.
+        i = children[0]
+        child = self._get_from_store(v[i])
+        if len(child) == 17:
+            return [hexprefix.nybbles_to_hp(bytes([i]), 0), v[i]]
+        return self._join(bytes([i]), child)
+
+    # Returns the leaf or extension "v" with the nybbles "prefix" in front
+    # of its path.
+    def _join(self, prefix, v):
+        return [hexprefix.nybbles_to_hp(prefix + hexprefix.hp_to_nybbles(v[0]),
+            1 if _is_leaf(v[0]) else 0), v[1]]
 
     # Recurse to get the value for the root. Assumes that "nybble_index" nybbles
     # have already been processed. The root is either NO_HASH or a bytes hash.
@@ -158,7 +385,7 @@ class MerklePatriciaTrie:
             # Value not in data structure.
             return NO_VALUE
 
-        v = self._get_from_store(root)
+        v = self._get_node(root)
         if len(v) == 2:
             # Leaf or extension.
             advance, hp_left, b_left = hexprefix.common_prefix(v[0], key, nybble_index)
@@ -187,8 +414,24 @@ class MerklePatriciaTrie:
         if isinstance(v, list) or isinstance(v, tuple):
             return v
         else:
+            if metrics.enabled:
+                metrics.count("store.read")
             k = self.key_value_store.get(v)
-            return rlp.decode(k)
+            if type(k) is bytes:
+                return rlp.decode(k)
+            # Stores like ArenaHashTable return views: decode in place.
+            return rlp.decode_bytes(k)
+
+    # Like _get_from_store(), but goes through the node cache if there is
+    # one. The returned node must not be modified.
+    def _get_node(self, v):
+        if self.node_cache is None or isinstance(v, list) or isinstance(v, tuple):
+            return self._get_from_store(v)
+        node = self.node_cache.get(v)
+        if node is None:
+            node = self._get_from_store(v)
+            self.node_cache.set(v, node)
+        return node
 
     # Given a value, either returns it (if its RLP is short and we're
     # optimizing) or stores it by the hash of its RLP.
@@ -197,6 +440,9 @@ class MerklePatriciaTrie:
         if optimize and len(k) < ethsha3.ETHSHA3_LENGTH:
             return v
         else:
+            if metrics.enabled:
+                metrics.count("trie.nodes_hashed")
+                metrics.count("store.write")
             h = ethsha3.hash(k)
             self.key_value_store.set(h, k)
             return h
@@ -282,11 +528,115 @@ class MerklePatriciaTrie:
         assert isinstance(v, bytes)
         return v.hex() if v != NO_HASH else "()"
 
-# Straightforward hash table for bytes keys and values.
+    # Yields a (key, old_value, new_value) tuple for every key whose value
+    # differs between this trie (old) and "other" (new). Added keys have an
+    # old_value of NO_VALUE, removed keys a new_value of NO_VALUE. Keys come
+    # out in sorted order. For secured tries the keys are the hashed keys.
+    #
+    # Sub-trees that are identical in both tries (same hash) are skipped
+    # without being read, so the cost is proportional to the size of the
+    # change, not the size of the tries. The two tries may use different
+    # key-value stores.
+    def diff(self, other):
+        assert self.secured == other.secured
+        return self._diff(other, (self.root, 0), (other.root, 0), [], {}, {})
+
+    # Recurse to diff two sub-trees. Each sub-tree is given as a cursor, a
+    # (node, consumed) tuple where "node" is a hash or inline node and
+    # "consumed" is the number of nybbles of a leaf or extension's path that
+    # have already been matched. "path" is the list of nybbles so far.
+    # "a_nodes" and "b_nodes" map hashes to nodes already read from each
+    # store, since a leaf is visited once per nybble of its path.
+    def _diff(self, other, a, b, path, a_nodes, b_nodes):
+        a = self._normalize_cursor(a, a_nodes)
+        b = other._normalize_cursor(b, b_nodes)
+        if a == b:
+            # Same sub-tree.
+            return
+
+        a_value, a_children = self._expand_cursor(a, a_nodes)
+        b_value, b_children = other._expand_cursor(b, b_nodes)
+
+        if a_value != b_value:
+            yield nybbles.nybbles_to_bytes(bytes(path)), a_value, b_value
+
+        for nybble in sorted(a_children.keys() | b_children.keys()):
+            path.append(nybble)
+            yield from self._diff(other,
+                    a_children.get(nybble, _EMPTY_CURSOR),
+                    b_children.get(nybble, _EMPTY_CURSOR), path, a_nodes, b_nodes)
+            path.pop()
+
+    # Skip past extensions whose path has been entirely consumed, so that
+    # equal sub-trees always have equal cursors.
+    def _normalize_cursor(self, cursor, nodes):
+        node, consumed = cursor
+        while consumed != 0:
+            v = self._get_from_store_cached(node, nodes)
+            hp_begin, hp_end = hexprefix.hp_nybble_range(v[0])
+            if hp_begin + consumed != hp_end or _is_leaf(v[0]):
+                break
+            node, consumed = v[1], 0
+        return node, consumed
+
+    # Returns (value, children) for the cursor as if it were a branch, where
+    # children maps each nybble to a cursor. Leaves and extensions have at
+    # most one child, the rest of their path.
+    def _expand_cursor(self, cursor, nodes):
+        node, consumed = cursor
+        if node == NO_HASH:
+            return NO_VALUE, {}
+
+        v = self._get_from_store_cached(node, nodes)
+        if len(v) == 2:
+            hp_begin, hp_end = hexprefix.hp_nybble_range(v[0])
+            index = hp_begin + consumed
+            if index == hp_end:
+                if _is_leaf(v[0]):
+                    return v[1], {}
+                # Extension, continue in its branch.
+                v = self._get_from_store_cached(v[1], nodes)
+            else:
+                return NO_VALUE, {nybbles.get_nybble(v[0], index): (node, consumed + 1)}
+
+        assert len(v) == 17
+        return v[16], {i: (v[i], 0) for i in range(16) if v[i] != NO_HASH}
+
+    # Like _get_from_store(), but remembers hashed nodes in the "nodes" map.
+    # The returned node must not be modified.
+    def _get_from_store_cached(self, v, nodes):
+        if isinstance(v, list) or isinstance(v, tuple):
+            return v
+        node = nodes.get(v)
+        if node is None:
+            node = self._get_from_store(v)
+            nodes[v] = node
+        return node
+
+# Returns the value of the key (NO_VALUE if it's absent) in the trie with
+# the given root, using only the nodes in "proof" (from get_proof()).
+# Raises if the proof is incomplete.
+def verify_proof(root, key, proof, secured=False):
+    store = HashTable()
+    for h, encoded in zip(ethsha3.hash_many(proof), proof):
+        store.set(h, encoded)
+    return MerklePatriciaTrie(store, root, secured).get(key)
+
+# Cursor (see MerklePatriciaTrie._diff()) for an empty sub-tree.
+_EMPTY_CURSOR = (NO_HASH, 0)
+
+# Straightforward hash table for bytes keys and values. One thread may call
+# set() while others call get(), since each is a single dict operation.
 class HashTable:
     def __init__(self):
         self.m = {}
         self.default_value = object()
+        # Keys in the order they were first set. Nothing is ever removed
+        # except by replace_with_string_dict(), so a prefix of this list is
+        # the whole table as of some earlier time (see view()).
+        self.keys = []
+        # Incremented when the table is replaced, which invalidates views.
+        self.generation = 0
 
     def __len__(self):
         return len(self.m)
@@ -295,8 +645,13 @@ class HashTable:
         # Make sure these are immutable.
         assert isinstance(k, bytes)
         assert isinstance(v, bytes)
+        if k not in self.m:
+            self.keys.append(k)
         self.m[k] = v
 
+    def __contains__(self, k):
+        return k in self.m
+
     def get(self, k):
         assert isinstance(k, bytes)
         v = self.m.get(k, self.default_value)
@@ -305,6 +660,21 @@ class HashTable:
         else:
             return v
 
+    def items(self):
+        return self.m.items()
+
+    # Returns a new HashTable with the same contents.
+    def copy(self):
+        other = HashTable()
+        other.m = self.m.copy()
+        other.keys = list(self.keys)
+        return other
+
+    # Returns a HashTableView of the current contents, in constant time.
+    # Keys are hashes of their values, so values don't change once set.
+    def view(self):
+        return HashTableView(self, len(self.keys), self.generation)
+
     def as_string_dict(self):
         m = {}
         for k, v in self.m.items():
@@ -313,8 +683,285 @@ class HashTable:
 
     def replace_with_string_dict(self, m):
         self.m.clear()
+        self.keys = []
+        self.generation += 1
+        for k, v in m.items():
+            self.set(bytes.fromhex(k), bytes.fromhex(v))
+
+# The contents of a HashTable at the time of HashTable.view(). Can be read
+# from another thread while the table's thread keeps adding to it, so that
+# a snapshot can be written without first copying the table.
+class HashTableView:
+    def __init__(self, table, length, generation):
+        self.table = table
+        self.length = length
+        self.generation = generation
+
+    def __len__(self):
+        return self.length
+
+    def items(self):
+        # Iterate by index, since the list may grow meanwhile.
+        m = self.table.m
+        for k in itertools.islice(self.table.keys, self.length):
+            v = m.get(k)
+            if v is None or self.table.generation != self.generation:
+                raise Exception("the hash table was replaced while it was being read")
+            yield k, v
+
+    def as_string_dict(self):
+        m = {}
+        for k, v in self.items():
+            m[k.hex()] = v.hex()
+        return m
+
+# Default size of each ArenaHashTable arena, in bytes. Larger values get
+# an arena of their own size.
+ARENA_SIZE = 1 << 20
+
+_KEY_LENGTH = 32
+_VALUE_LENGTH_LENGTH = 4
+_RECORD_HEADER_LENGTH = _KEY_LENGTH + _VALUE_LENGTH_LENGTH
+_ARENA_MAGIC = b"MPTARENA"
+
+# Locations are 1-based so that zero can mean "empty slot" in the index.
+def _make_location(arena_index, offset):
+    return ((arena_index << 32) | offset) + 1
+
+def _split_location(location):
+    location -= 1
+    return location >> 32, location & 0xFFFFFFFF
+
+# Returns an empty ArenaHashTable index with room for "capacity" entries,
+# as a (mask, prefixes, locations) tuple.
+def _new_index(capacity):
+    return capacity - 1, array("Q", bytes(8*capacity)), array("Q", bytes(8*capacity))
+
+# Compact hash table for 256-bit bytes keys and bytes values. Instead of one
+# bytes object per key and value, entries are packed into large bytearray
+# arenas as (key, 4-byte length, value) records, and found through an
+# open-addressing index keyed on the first 8 bytes of the key. Since keys
+# are hashes, the prefix is already uniformly distributed. The get() method
+# returns a memoryview into the arena, valid for the life of the table.
+#
+# Setting a key again with a value of the same length overwrites its record
+# in place. Otherwise the new value is appended and the old record is left
+# in the arena, dead; "dead_bytes" counts them. Trie stores set a key again
+# only with the same value, so neither wastes anything there.
+#
+# One thread may call set() while others call get(). Records are written
+# before they're indexed, and a grown index replaces the old one whole. A
+# reader of a key whose value is overwritten in place with a different
+# value may see a mix of the two.
+class ArenaHashTable:
+    def __init__(self, arena_size=ARENA_SIZE, capacity=1024):
+        assert capacity > 0 and capacity & (capacity - 1) == 0
+        self.arena_size = arena_size
+        self.arenas = []
+        self.views = []
+        self.arena_used = []
+        self.count = 0
+        # Bytes of records that no key points to any more.
+        self.dead_bytes = 0
+        self._new_arena(0)
+        self.index = _new_index(capacity)
+
+    def __len__(self):
+        return self.count
+
+    # Iterates over the keys, in no particular order.
+    def __iter__(self):
+        mask, prefixes, locations = self.index
+        for location in locations:
+            if location != 0:
+                arena_index, offset = _split_location(location)
+                yield bytes(self.views[arena_index][offset:offset + _KEY_LENGTH])
+
+    def items(self):
+        for k in self:
+            yield k, self.get(k)
+
+    def set(self, k, v):
+        assert isinstance(k, bytes)
+        assert isinstance(v, bytes)
+        assert len(k) == _KEY_LENGTH
+
+        old_location = self._find(k)
+        if old_location != 0:
+            arena_index, offset = _split_location(old_location)
+            old_size = self._record_size(old_location)
+            if old_size == _RECORD_HEADER_LENGTH + len(v):
+                # Reuse the record.
+                offset += _RECORD_HEADER_LENGTH
+                self.arenas[arena_index][offset:offset + len(v)] = v
+                return
+            self.dead_bytes += old_size
+
+        # Append record to the arena.
+        size = _RECORD_HEADER_LENGTH + len(v)
+        arena_index = len(self.arenas) - 1
+        offset = self.arena_used[arena_index]
+        if offset + size > len(self.arenas[arena_index]):
+            self._new_arena(size)
+            arena_index += 1
+            offset = 0
+        arena = self.arenas[arena_index]
+        arena[offset:offset + _KEY_LENGTH] = k
+        arena[offset + _KEY_LENGTH:offset + _RECORD_HEADER_LENGTH] = len(v).to_bytes(_VALUE_LENGTH_LENGTH, "big")
+        arena[offset + _RECORD_HEADER_LENGTH:offset + size] = v
+        self.arena_used[arena_index] = offset + size
+
+        self._insert(k, _make_location(arena_index, offset))
+
+    def get(self, k):
+        assert isinstance(k, bytes)
+        location = self._find(k)
+        if location == 0:
+            raise Exception("the hash map does not contain the key 0x" + k.hex())
+        location -= 1
+        view = self.views[location >> 32]
+        offset = (location & 0xFFFFFFFF) + _KEY_LENGTH
+        length = int.from_bytes(view[offset:offset + _VALUE_LENGTH_LENGTH], "big")
+        offset += _VALUE_LENGTH_LENGTH
+        return view[offset:offset + length]
+
+    def __contains__(self, k):
+        return self._find(k) != 0
+
+    # Returns a new ArenaHashTable with the same contents.
+    def copy(self):
+        other = ArenaHashTable.__new__(ArenaHashTable)
+        other.arena_size = self.arena_size
+        other.arenas = [bytearray(arena) for arena in self.arenas]
+        other.views = [memoryview(arena) for arena in other.arenas]
+        other.arena_used = list(self.arena_used)
+        other.count = self.count
+        other.dead_bytes = self.dead_bytes
+        mask, prefixes, locations = self.index
+        other.index = (mask, array("Q", prefixes), array("Q", locations))
+        return other
+
+    def as_string_dict(self):
+        m = {}
+        for k, v in self.items():
+            m[k.hex()] = v.hex()
+        return m
+
+    def replace_with_string_dict(self, m):
+        self.__init__(self.arena_size)
         for k, v in m.items():
-            self.m[bytes.fromhex(k)] = bytes.fromhex(v)
+            self.set(bytes.fromhex(k), bytes.fromhex(v))
+
+    # Write the arenas to the binary file f. Dead records (see dead_bytes)
+    # are written too, later ones win on load.
+    def dump_to_file(self, f):
+        f.write(_ARENA_MAGIC)
+        f.write(len(self.arenas).to_bytes(8, "big"))
+        for arena, used in zip(self.arenas, self.arena_used):
+            f.write(used.to_bytes(8, "big"))
+            f.write(memoryview(arena)[:used])
+
+    # Replace the contents of this table with arenas written by dump_to_file().
+    def load_from_file(self, f):
+        if f.read(len(_ARENA_MAGIC)) != _ARENA_MAGIC:
+            raise Exception("not an arena hash table file")
+        self.__init__(self.arena_size)
+        self.arenas = []
+        self.views = []
+        self.arena_used = []
+        arena_count = int.from_bytes(f.read(8), "big")
+        for arena_index in range(arena_count):
+            used = int.from_bytes(f.read(8), "big")
+            arena = bytearray(max(used, self.arena_size))
+            if f.readinto(memoryview(arena)[:used]) != used:
+                raise Exception("truncated arena hash table file")
+            self.arenas.append(arena)
+            self.views.append(memoryview(arena))
+            self.arena_used.append(used)
+
+            # Rebuild the index from the records.
+            offset = 0
+            while offset < used:
+                k = bytes(arena[offset:offset + _KEY_LENGTH])
+                length = int.from_bytes(arena[offset + _KEY_LENGTH:offset + _RECORD_HEADER_LENGTH], "big")
+                old_location = self._insert(k, _make_location(arena_index, offset))
+                if old_location != 0:
+                    self.dead_bytes += self._record_size(old_location)
+                offset += _RECORD_HEADER_LENGTH + length
+        if not self.arenas:
+            self._new_arena(0)
+
+    # Add an arena with room for at least "size" bytes.
+    def _new_arena(self, size):
+        arena = bytearray(max(size, self.arena_size))
+        self.arenas.append(arena)
+        self.views.append(memoryview(arena))
+        self.arena_used.append(0)
+
+    # Return the location of key k, or 0 if it's not in the table.
+    def _find(self, k):
+        prefix = int.from_bytes(k[:8], "big")
+        mask, prefixes, locations = self.index
+        i = prefix & mask
+        while True:
+            location = locations[i]
+            if location == 0:
+                return 0
+            if prefixes[i] == prefix:
+                offset = (location - 1) & 0xFFFFFFFF
+                if self.views[(location - 1) >> 32][offset:offset + _KEY_LENGTH] == k:
+                    return location
+            i = (i + 1) & mask
+
+    # Point key k at the record at "location", replacing any previous entry.
+    # Returns the location of the previous entry, or 0 if there was none.
+    def _insert(self, k, location):
+        prefix = int.from_bytes(k[:8], "big")
+        mask, prefixes, locations = self.index
+        i = prefix & mask
+        while True:
+            old_location = locations[i]
+            if old_location == 0:
+                break
+            if prefixes[i] == prefix and self._key_at(old_location) == k:
+                locations[i] = location
+                return old_location
+            i = (i + 1) & mask
+
+        # Set the prefix first, since readers look at the location first.
+        prefixes[i] = prefix
+        locations[i] = location
+        self.count += 1
+
+        # Keep the load factor at or below one half.
+        if self.count*2 > len(locations):
+            self._grow()
+        return 0
+
+    def _grow(self):
+        old_mask, old_prefixes, old_locations = self.index
+        index = _new_index(len(old_locations)*2)
+        mask, prefixes, locations = index
+        for prefix, location in zip(old_prefixes, old_locations):
+            if location != 0:
+                i = prefix & mask
+                while locations[i] != 0:
+                    i = (i + 1) & mask
+                prefixes[i] = prefix
+                locations[i] = location
+        # Readers see either the old index or the complete new one.
+        self.index = index
+
+    # Size of the record at "location", header included.
+    def _record_size(self, location):
+        arena_index, offset = _split_location(location)
+        offset += _KEY_LENGTH
+        view = self.views[arena_index]
+        return _RECORD_HEADER_LENGTH + int.from_bytes(view[offset:offset + _VALUE_LENGTH_LENGTH], "big")
+
+    def _key_at(self, location):
+        arena_index, offset = _split_location(location)
+        return self.views[arena_index][offset:offset + _KEY_LENGTH]
 
 def _unit_tests():
     hash_table = HashTable()
@@ -409,9 +1056,270 @@ def _random_tests():
 
     print("Random tests good.")
 
+def _arena_tests():
+    import io
+
+    table = ArenaHashTable(arena_size=1024, capacity=4)
+    q = {}
+    for i in range(2000):
+        k = random_bytes(32, 32)
+        v = random_bytes(0, 1500)
+        table.set(k, v)
+        q[k] = v
+    # Overwrite some: in place if the length is the same, else leaving a
+    # dead record.
+    dead_bytes = 0
+    for k in list(q)[:100]:
+        old_length = len(q[k])
+        q[k] = random_bytes(0, 100)
+        if len(q[k]) != old_length:
+            dead_bytes += _RECORD_HEADER_LENGTH + old_length
+        table.set(k, q[k])
+    k = list(q)[100]
+    q[k] = bytes(len(q[k]))
+    used = list(table.arena_used)
+    table.set(k, q[k])
+    assert table.arena_used == used
+    assert table.dead_bytes == dead_bytes
+
+    assert len(table) == len(q)
+    assert set(table) == set(q)
+    for k, v in q.items():
+        assert table.get(k) == v
+        assert isinstance(table.get(k), memoryview)
+    assert random_bytes(32, 32) not in table
+
+    f = io.BytesIO()
+    table.dump_to_file(f)
+    f.seek(0)
+    table2 = ArenaHashTable(arena_size=1024)
+    table2.load_from_file(f)
+    assert len(table2) == len(q) and table2.dead_bytes == dead_bytes
+    for k, v in q.items():
+        assert table2.get(k) == v
+
+    # Works as a trie store.
+    m = MerklePatriciaTrie(ArenaHashTable())
+    m2 = MerklePatriciaTrie(HashTable())
+    for k in list(q)[:200]:
+        m = m.set(k, q[k] + b"x")
+        m2 = m2.set(k, q[k] + b"x")
+    assert m.root == m2.root
+    for k in list(q)[:200]:
+        assert m.get(k) == q[k] + b"x"
+        # Decoded in place, but handed out as bytes.
+        assert type(m.get(k)) is bytes
+
+    print("Arena tests good.")
+
+def _diff_tests():
+    # Store that counts reads, to check that shared sub-trees are skipped.
+    class CountingStore(HashTable):
+        def __init__(self):
+            super().__init__()
+            self.reads = 0
+        def get(self, k):
+            self.reads += 1
+            return super().get(k)
+
+    for secured in [False, True]:
+        store = CountingStore()
+        m1 = MerklePatriciaTrie(store, NO_HASH, secured)
+        q1 = {}
+        for i in range(500):
+            k = random_bytes(0, 8)
+            v = random_bytes(1, 40)
+            m1 = m1.set(k, v)
+            q1[ethsha3.hash(k) if secured else k] = v
+
+        m2 = m1
+        q2 = dict(q1)
+        for i in range(5):
+            k = random_bytes(0, 8)
+            v = random_bytes(1, 40)
+            m2 = m2.set(k, v)
+            q2[ethsha3.hash(k) if secured else k] = v
+
+        expected = sorted((k, q1.get(k, NO_VALUE), q2.get(k, NO_VALUE))
+                for k in q1.keys() | q2.keys() if q1.get(k) != q2.get(k))
+        store.reads = 0
+        assert list(m1.diff(m2)) == expected
+        assert store.reads < 60
+        assert [(k, new, old) for k, old, new in m2.diff(m1)] == expected
+        assert list(m1.diff(m1)) == []
+
+        # Against an empty trie, everything is added.
+        empty = MerklePatriciaTrie(HashTable(), NO_HASH, secured)
+        assert list(empty.diff(m1)) == sorted((k, NO_VALUE, v) for k, v in q1.items())
+
+    print("Diff tests good.")
+
+def _build_tests():
+    for secured in [False, True]:
+        for count in [0, 1, 2, 20, 500]:
+            items = [(random_bytes(0, 8), random_bytes(1, 40)) for i in range(count)]
+            # Some replaced values, and a key that's a prefix of all others.
+            items += [(k, v + b"x") for k, v in items[:count//10]] + [(b"", b"x")]
+            m = MerklePatriciaTrie(HashTable(), NO_HASH, secured)
+            for k, v in items:
+                m = m.set(k, v)
+            built = MerklePatriciaTrie.build(HashTable(), items, secured)
+            assert built.root == m.root
+            for k, v in dict(items).items():
+                assert built.get(k) == v
+
+    print("Build tests good.")
+
+def _proof_tests():
+    for secured in [False, True]:
+        m = MerklePatriciaTrie(HashTable(), NO_HASH, secured)
+        q = {}
+        for i in range(300):
+            k = random_bytes(0, 8)
+            v = random_bytes(1, 40)
+            m = m.set(k, v)
+            q[k] = v
+        for k in list(q)[:50] + [random_bytes(0, 8) for i in range(50)]:
+            proof = m.get_proof(k)
+            assert verify_proof(m.root, k, proof, secured) == q.get(k, NO_VALUE)
+
+        # Missing a node.
+        k = list(q)[0]
+        try:
+            verify_proof(m.root, k, m.get_proof(k)[:-1], secured)
+            assert False
+        except Exception as e:
+            assert "does not contain" in str(e)
+
+    print("Proof tests good.")
+
+def _secured_key_tests():
+    secured_key_cache.clear()
+    m = MerklePatriciaTrie(HashTable(), NO_HASH, True)
+    keys = [random_bytes(1, 20) for i in range(100)]
+    for k in keys:
+        m = m.set(k, b"v" + k)
+    for k in keys:
+        assert m.get(k) == b"v" + k
+        assert secured_key_cache.get(k) == ethsha3.hash(k)
+        assert m.get_hashed(ethsha3.hash(k)) == b"v" + k
+    assert secured_key_cache.hits >= len(keys)
+
+    # Prehashed keys give the same trie.
+    m2 = MerklePatriciaTrie(HashTable(), NO_HASH, True)
+    for k in keys:
+        m2 = m2.set_hashed(hash_secured_key(k), b"v" + k)
+    assert m2.root == m.root
+
+    print("Secured key tests good.")
+
+def _delete_tests():
+    import random
+    rng = random.Random(0)
+    for secured in [False, True]:
+        hash_table = HashTable()
+        m = MerklePatriciaTrie(hash_table, NO_HASH, secured)
+        # Short keys, so that many are prefixes of others.
+        q = {}
+        for i in range(500):
+            k = bytes(rng.randrange(4) for j in range(rng.randrange(4)))
+            q[k] = random_bytes(1, 40)
+            m = m.set(k, q[k])
+        for k in sorted(q, key=lambda k: rng.random()):
+            m = m.delete(k)
+            del q[k]
+            assert m.get(k) == NO_VALUE
+            # Same root as inserting only the remaining keys.
+            m2 = MerklePatriciaTrie(hash_table, NO_HASH, secured)
+            for k2, v2 in q.items():
+                assert m.get(k2) == v2
+                m2 = m2.set(k2, v2)
+            assert m.root == m2.root
+        assert m.root == NO_HASH
+
+        # Deleting a missing key changes nothing.
+        m = m.set(b"\x12\x34", b"x")
+        assert m.delete(b"\x12") is m
+        assert m.delete(b"\x12\x35") is m
+        assert MerklePatriciaTrie(hash_table, NO_HASH, secured).delete(b"a").root == NO_HASH
+
+    print("Delete tests good.")
+
+def _concurrency_tests():
+    import random
+    import threading
+    import cache
+
+    # One writer adds keys while readers check published roots.
+    for store in [HashTable(), ArenaHashTable(arena_size=4096, capacity=4)]:
+        node_cache = cache.LruCache(1000)
+        keys = [random_bytes(1, 20) for i in range(500)]
+        # List of (root, number of keys set under that root).
+        published = [(NO_HASH, 0)]
+        done = threading.Event()
+        errors = []
+
+        def write():
+            m = MerklePatriciaTrie(store, NO_HASH, True)
+            for i, k in enumerate(keys):
+                m = m.set(k, b"v" + k)
+                published.append((m.root, i + 1))
+            done.set()
+
+        def read(seed):
+            rng = random.Random(seed)
+            try:
+                while not done.is_set():
+                    root, count = published[rng.randrange(len(published))]
+                    m = MerklePatriciaTrie(store, root, True, node_cache)
+                    i = rng.randrange(len(keys))
+                    # Keys can repeat, so check the first time each was set.
+                    expected = b"v" + keys[i] if keys.index(keys[i]) < count else NO_VALUE
+                    assert m.get(keys[i]) == expected
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read, args=(seed,)) for seed in range(4)]
+        threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors[0]
+        assert node_cache.hits > 0
+
+    # A view keeps the contents as of view() while the table grows.
+    store = HashTable()
+    m = MerklePatriciaTrie(store, NO_HASH, True)
+    for k in keys[:100]:
+        m = m.set(k, b"v" + k)
+    expected = dict(store.items())
+    view = store.view()
+    m2 = MerklePatriciaTrie(store, m.root, True)
+    for k in keys[100:]:
+        m2 = m2.set(k, b"w" + k)
+    assert dict(view.items()) == expected and len(view) == len(expected)
+    assert len(store) > len(expected)
+    store.replace_with_string_dict(store.as_string_dict())
+    try:
+        view.as_string_dict()
+        replaced = False
+    except Exception:
+        replaced = True
+    assert replaced
+
+    print("Concurrency tests good.")
+
 def _my_tests():
     _unit_tests()
     _random_tests()
+    _arena_tests()
+    _diff_tests()
+    _build_tests()
+    _proof_tests()
+    _secured_key_tests()
+    _delete_tests()
+    _concurrency_tests()
 
 def _load_standard_test(filename):
     with open("../../others/eth_tests/TrieTests/" + filename) as f:
@@ -29,6 +29,36 @@ def nybbles_to_bytes(ny, begin=0, end=None):
             (ny[begin + i*2] << 4) | (ny[begin + i*2 + 1] if begin + i*2 + 1 < end else 0)
             for i in range(byte_count))
 
+# Returns the nybbles of byte array b from nybble index "begin" (inclusive)
+# to "end" (exclusive) packed into a single integer, first nybble most
+# significant.
+def nybbles_to_int(b, begin, end):
+    if begin >= end:
+        return 0
+
+    v = int.from_bytes(b[begin >> 1:(end + 1) >> 1], "big")
+    if (end & 1) != 0:
+        v >>= 4
+    return v & ((1 << ((end - begin)*4)) - 1)
+
+# Returns the number of nybbles in common at the start of byte array "a"
+# (from nybble index a_begin to a_end) and byte array "b" (from b_begin to
+# b_end). Rather than walking nybble by nybble, both ranges are converted
+# to integers and xor'ed, so whole bytes are compared at once and the first
+# differing nybble falls out of the bit length of the difference.
+def common_prefix_length(a, a_begin, a_end, b, b_begin, b_end):
+    count = min(a_end - a_begin, b_end - b_begin)
+    if count <= 0:
+        return 0
+
+    if (a_begin & 1) == 0 and (b_begin & 1) == 0 and (count & 1) == 0:
+        # Byte-aligned, compare the bytes directly first.
+        if a[a_begin >> 1:(a_begin + count) >> 1] == b[b_begin >> 1:(b_begin + count) >> 1]:
+            return count
+
+    diff = nybbles_to_int(a, a_begin, a_begin + count) ^ nybbles_to_int(b, b_begin, b_begin + count)
+    return count - ((diff.bit_length() + 3) >> 2)
+
 # Takes two byte arrays (in principle nybble arrays, but values aren't limited
 # to nybbles). Returns the tuple (common, a_left, b_left), where "common" is a
 # byte array of the common prefix, and "a_left" and "b_left" are the byte
@@ -63,5 +93,20 @@ if __name__ == "__main__":
     assert common_prefix(b"\x01\x02", b"\x01\x02") == (b"\x01\x02", b"", b"")
     assert common_prefix(b"\x01\x02\x03", b"") == (b"", b"\x01\x02\x03", b"")
 
+    # Nybbles to int.
+    assert nybbles_to_int(b"\x12\x34\x56", 0, 6) == 0x123456
+    assert nybbles_to_int(b"\x12\x34\x56", 1, 4) == 0x234
+    assert nybbles_to_int(b"\x12\x34\x56", 1, 1) == 0
+    assert nybbles_to_int(b"\x12\x34\x56", 5, 6) == 0x6
+
+    # Common prefix length.
+    assert common_prefix_length(b"\x12\x34", 0, 4, b"\x12\x34", 0, 4) == 4
+    assert common_prefix_length(b"\x12\x34", 0, 4, b"\x12\x35", 0, 4) == 3
+    assert common_prefix_length(b"\x12\x34", 0, 4, b"\x12", 0, 2) == 2
+    assert common_prefix_length(b"\x12\x34", 1, 4, b"\x23\x45", 0, 4) == 3
+    assert common_prefix_length(b"\x12\x34", 1, 4, b"\x33\x45", 0, 4) == 0
+    assert common_prefix_length(b"\x12\x34", 2, 2, b"\x12", 0, 2) == 0
+    assert common_prefix_length(b"\x01\x23", 1, 4, b"\x12\x34", 0, 3) == 3
+
     print("All good.")
 
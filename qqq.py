@@ -1,7 +1,7 @@
 
 import os.path
-import rlp
 import eth
+import metrics
 
 SNAPSHOT_PATHNAME = "snapshot.json"
 
@@ -16,9 +16,11 @@ sender = eth.Account.parse_address("a1e4380a3b1f749673e270229993ee55f35663b4")
 recipient = eth.Account.parse_address("c9d4035f4a9226d50f79b73aafb5d874a1b6537e")
 beneficiary = eth.Account.parse_address("bb7b8287f3f0a933474a79eae42cbca977791171")
 
-for block_list in rlp.decode_multiple(blocks_binary):
-    b = eth.Block.from_list(block_list)
+# Print progress every ten seconds.
+metrics.enable()
+metrics.Reporter(10).start()
 
+for b in eth.Block.decode_multiple(blocks_binary):
     if e.should_skip_block(b.header.number):
         #print("Skipping block %d, older than most recent %d" %
         #        (b.header.number, e.head_block_number))
@@ -0,0 +1,408 @@
+# Local query service over an EthereumVirtualMachine's state, speaking
+# newline-delimited JSON over a TCP or Unix socket. Each request is a line
+# like
+#
+#     {"id": 1, "method": "getBalance", "params": ["0x<address>", "latest"]}
+#
+# and gets a response line with the same "id" and either a "result" or an
+# "error". Responses on a connection may come back out of order. Methods:
+#
+#     getBalance(address, block)  balance in wei, as hex.
+#     getNonce(address, block)    nonce, as hex.
+#     getProof(address, block)    account fields and the Merkle proof of
+#                                 the account in the state trie.
+#     getHeader(block)            header fields, as hex.
+#     getStats()                  latency of each method, and batching.
+#
+# "block" is the number of a block the EthereumVirtualMachine retains (see
+# EthereumVirtualMachine.state_at()), as an integer or hex string, or
+# "latest" (the default).
+#
+# The server runs its own event loop. Trie reads happen in a thread pool,
+# and concurrent lookups of the same block's state are batched into one
+# pool task, so thousands of requests cost few thread handoffs and the
+# import thread is only slowed by the reads themselves.
+
+import asyncio
+import concurrent.futures
+import json
+import threading
+import time
+import eth
+import ethsha3
+import metrics
+import mpt
+
+# Most requests of one connection handled at once. Past that, the server
+# stops reading the connection until a response has been sent.
+MAX_PIPELINED_REQUESTS = 256
+
+# Counters and latency histograms of a QueryServer.
+class QueryStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        # Pool tasks, and the account lookups they served.
+        self.batches = 0
+        self.batched_lookups = 0
+        # Map from method name to metrics.Histogram of request latency.
+        self.latency = {}
+
+    def record(self, method, seconds):
+        histogram = self.latency.get(method)
+        if histogram is None:
+            histogram = metrics.Histogram()
+            self.latency[method] = histogram
+        histogram.add(seconds)
+        if metrics.enabled:
+            metrics.record("query." + method, seconds)
+
+    def as_dict(self):
+        return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "batched_lookups": self.batched_lookups,
+                "latency": {method: h.as_dict() for method, h in self.latency.items()},
+        }
+
+class QueryServer:
+    # "workers" is the number of threads doing trie reads.
+    def __init__(self, evm, workers=8):
+        self.evm = evm
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.stats = QueryStats()
+
+        # Map from block number to BlockHeader, filled by on_block().
+        self.headers = {}
+
+        # Map from state root to the pending batch of lookups in that state:
+        # a map from address to a list of (want_proof, future) tuples.
+        self._batches = {}
+
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    # Record the block's header for getHeader. Pass to ImportPipeline.run()
+    # as "on_block", or call after EthereumVirtualMachine.process_block().
+    def on_block(self, b):
+        number = b.header.number
+        self.headers[number] = b.header
+        retained_blocks = self.evm.retained_blocks
+        if retained_blocks is not None:
+            self.headers.pop(number - retained_blocks, None)
+
+    async def start_tcp(self, host="127.0.0.1", port=0):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()
+
+    async def start_unix(self, pathname):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_unix_server(self._handle_connection, pathname)
+        return pathname
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    # Run the server on its own event loop in a background thread, so that
+    # the calling thread can keep importing blocks. If "pathname" is
+    # specified, listens on that Unix socket, otherwise on TCP. Returns the
+    # address listened on.
+    def start_in_thread(self, host="127.0.0.1", port=0, pathname=None):
+        loop = asyncio.new_event_loop()
+        started = concurrent.futures.Future()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            try:
+                if pathname is None:
+                    address = loop.run_until_complete(self.start_tcp(host, port))
+                else:
+                    address = loop.run_until_complete(self.start_unix(pathname))
+            except BaseException as e:
+                started.set_exception(e)
+                return
+            started.set_result(address)
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        return started.result()
+
+    # Stop a server started with start_in_thread().
+    def stop_thread(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self.executor.shutdown()
+
+    # Responses are written as they're ready, and each waits for the
+    # socket's buffer to drain, so that a client that sends requests but
+    # doesn't read the responses holds up its own requests rather than
+    # making the server buffer without limit.
+    async def _handle_connection(self, reader, writer):
+        tasks = set()
+        slots = asyncio.Semaphore(MAX_PIPELINED_REQUESTS)
+        drain_lock = asyncio.Lock()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await slots.acquire()
+                task = asyncio.ensure_future(self._handle_line(line, writer, drain_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda task: slots.release())
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    async def _handle_line(self, line, writer, drain_lock):
+        begin = time.perf_counter()
+        self.stats.requests += 1
+        request_id = None
+        method = "invalid"
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            handler = _METHODS.get(request.get("method"))
+            if handler is None:
+                raise Exception("unknown method %r" % (request.get("method"),))
+            method = request["method"]
+            result = await handler(self, *request.get("params", []))
+            response = {"id": request_id, "result": result}
+        except Exception as e:
+            self.stats.errors += 1
+            response = {"id": request_id, "error": str(e)}
+        writer.write(json.dumps(response).encode() + b"\n")
+        try:
+            # Older Pythons don't allow concurrent drain() calls.
+            async with drain_lock:
+                await writer.drain()
+        except ConnectionError:
+            # The client went away; nothing left to send to.
+            pass
+        self.stats.record(method, time.perf_counter() - begin)
+
+    async def _get_balance(self, address, block="latest"):
+        account, proof = await self._lookup(address, block, False)
+        return hex(account.balance if account is not None else 0)
+
+    async def _get_nonce(self, address, block="latest"):
+        account, proof = await self._lookup(address, block, False)
+        return hex(account.nonce if account is not None else 0)
+
+    async def _get_proof(self, address, block="latest"):
+        account, proof = await self._lookup(address, block, True)
+        if account is None:
+            account = eth.Account(0, 0, mpt.EMPTY_TREE_ROOT, ethsha3.EMPTY_STRING_HASH)
+        return {
+                "address": address,
+                "balance": hex(account.balance),
+                "nonce": hex(account.nonce),
+                "storageHash": "0x" + account.storage_root.hex(),
+                "codeHash": "0x" + account.code_hash.hex(),
+                "accountProof": ["0x" + node.hex() for node in proof],
+        }
+
+    async def _get_header(self, block="latest"):
+        number = self._block_number(block)
+        header = self.headers.get(number)
+        if header is None:
+            raise Exception("header of block %d is not available" % number)
+        result = {name: _to_json(value) for name, value in vars(header).items()}
+        result["hash"] = _to_json(header.compute_hash())
+        return result
+
+    async def _get_stats(self):
+        return self.stats.as_dict()
+
+    def _block_number(self, block):
+        if block == "latest":
+            number = self.evm.head_block_number
+            if number is None:
+                raise Exception("no blocks have been processed")
+            return number
+        if isinstance(block, str):
+            return int(block, 16)
+        return block
+
+    # Look up the address in the state of the block. Returns the Account
+    # (or None) and, if "want_proof", its proof.
+    async def _lookup(self, address, block, want_proof):
+        address = _parse_address(address)
+        view = self.evm.state_at(self._block_number(block))
+
+        future = self._loop.create_future()
+        batch = self._batches.get(view.root)
+        if batch is None:
+            # Let the requests that arrive in the meantime join the batch.
+            batch = {}
+            self._batches[view.root] = batch
+            self._loop.call_soon(self._run_batch, view)
+        batch.setdefault(address, []).append((want_proof, future))
+        return await future
+
+    def _run_batch(self, view):
+        batch = self._batches.pop(view.root)
+        self.stats.batches += 1
+        self.stats.batched_lookups += sum(len(waiters) for waiters in batch.values())
+        requests = [(address, any(want_proof for want_proof, future in waiters))
+                for address, waiters in batch.items()]
+        pool_future = self._loop.run_in_executor(self.executor, _read_accounts, view, requests)
+        pool_future.add_done_callback(lambda f: self._finish_batch(batch, f))
+
+    def _finish_batch(self, batch, pool_future):
+        try:
+            results = pool_future.result()
+        except Exception as e:
+            results = None
+            error = e
+        for address, waiters in batch.items():
+            for want_proof, future in waiters:
+                if future.done():
+                    continue
+                if results is None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(results[address])
+
+_METHODS = {
+        "getBalance": QueryServer._get_balance,
+        "getNonce": QueryServer._get_nonce,
+        "getProof": QueryServer._get_proof,
+        "getHeader": QueryServer._get_header,
+        "getStats": QueryServer._get_stats,
+}
+
+# Read the (address, want_proof) requests from the StateView. Returns a map
+# from address to (Account or None, proof or None). Runs in the pool.
+def _read_accounts(view, requests):
+    results = {}
+    for address, want_proof in requests:
+        account = view.get_account(address)
+        proof = view.state.get_proof(address) if want_proof else None
+        results[address] = account, proof
+    return results
+
+def _parse_address(address):
+    if not isinstance(address, str) or not address.startswith("0x") or len(address) != 42:
+        raise Exception("invalid address %r" % (address,))
+    return bytes.fromhex(address[2:])
+
+def _to_json(value):
+    if isinstance(value, int):
+        return hex(value)
+    return "0x" + bytes(value).hex()
+
+# Send the requests on one connection and return the responses in request order.
+async def query(reader, writer, requests):
+    for request_id, (method, params) in enumerate(requests):
+        writer.write(json.dumps({"id": request_id, "method": method, "params": params}).encode() + b"\n")
+    await writer.drain()
+    responses = [None]*len(requests)
+    for i in range(len(requests)):
+        response = json.loads(await reader.readline())
+        responses[response["id"]] = response
+    return responses
+
+def _tests():
+    import contextlib
+    import io
+    import os
+    import tempfile
+    import synthetic
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        chain = synthetic.make_chain(5, 20, 4)
+    evm = chain.make_evm()
+    for b in chain.blocks:
+        evm.process_block(b)
+
+    addresses = [address for address, value in chain.genesis_alloc]
+    requests = []
+    expected = []
+    for i in range(2000):
+        address = addresses[i % len(addresses)]
+        number = i % len(chain.blocks)
+        view = evm.state_at(number)
+        block = "latest" if number == evm.head_block_number else hex(number)
+        if i % 2 == 0:
+            requests.append(("getBalance", ["0x" + address.hex(), block]))
+            expected.append(hex(view.get_balance(address)))
+        else:
+            requests.append(("getNonce", ["0x" + address.hex(), number]))
+            expected.append(hex(view.get_nonce(address)))
+
+    async def run(address):
+        if isinstance(address, str):
+            reader, writer = await asyncio.open_unix_connection(address)
+        else:
+            reader, writer = await asyncio.open_connection(*address)
+        responses = await query(reader, writer, requests + [
+            ("getProof", ["0x" + addresses[0].hex(), 2]),
+            ("getHeader", [3]),
+            ("getBalance", ["0x1234"]),
+            ("getStats", []),
+        ])
+        writer.close()
+        return responses
+
+    async def late_reader(address, count):
+        if isinstance(address, str):
+            reader, writer = await asyncio.open_unix_connection(address)
+        else:
+            reader, writer = await asyncio.open_connection(*address)
+        request = json.dumps({"id": 0, "method": "getHeader", "params": [3]}).encode() + b"\n"
+        # Send from a task, since the server may stop reading until we do.
+        async def send():
+            for i in range(count):
+                writer.write(request)
+                await writer.drain()
+        sending = asyncio.ensure_future(send())
+        await asyncio.sleep(0.1)
+        responses = [json.loads(await reader.readline()) for i in range(count)]
+        await sending
+        writer.close()
+        return responses
+
+    with tempfile.TemporaryDirectory() as directory:
+        for pathname in [None, os.path.join(directory, "socket")]:
+            server = QueryServer(evm, workers=4)
+            for b in chain.blocks:
+                server.on_block(b)
+            address = server.start_in_thread(pathname=pathname)
+            responses = asyncio.run(run(address))
+            assert [r["result"] for r in responses[:len(expected)]] == expected
+            proof, header, error, stats = responses[len(expected):]
+
+            proof = proof["result"]
+            state_root = chain.blocks[2].header.stateRoot
+            nodes = [bytes.fromhex(node[2:]) for node in proof["accountProof"]]
+            account = eth.Account.decode(mpt.verify_proof(state_root, addresses[0], nodes, True))
+            assert hex(account.balance) == proof["balance"]
+
+            assert header["result"]["hash"] == "0x" + chain.blocks[3].header.compute_hash().hex()
+            assert "invalid address" in error["error"]
+            stats = stats["result"]
+            # Concurrent lookups were batched.
+            assert stats["batches"] < stats["batched_lookups"]
+
+            # A client that only reads after sending everything still gets
+            # every response, though the server stops reading it meanwhile.
+            responses = asyncio.run(late_reader(address, 1000))
+            assert len(responses) == 1000 and all("result" in r for r in responses)
+            server.stop_thread()
+
+    print("All good.")
+
+if __name__ == "__main__":
+    _tests()
@@ -2,38 +2,157 @@
 # Ethereum Recursive Length Prefix encoding and decoding.
 # https://eth.wiki/fundamentals/rlp
 
+import struct
+
 # Convert an integer to big-endian with initial zero bytes stripped off.
 def encode_int(n):
-    return n.to_bytes(32, "big").lstrip(b"\x00")
+    return n.to_bytes((n.bit_length() + 7) // 8, "big")
 
 # Convert a big-endian bytearray version of an int to the int.
 def decode_int(b):
     # This properly handles an empty array as "0".
     return int.from_bytes(b, "big")
 
-# Data is hierarchy of bytearrays, bytes, lists, and tuples. Convert your
-# non-bytearray data to bytearrays or bytes first. Returns an encoded bytearray.
+# Data is hierarchy of bytearrays, bytes, memoryviews, lists, and tuples. Convert
+# your non-bytearray data to bytearrays or bytes first. Returns an encoded bytes.
+#
+# Rather than encoding each child and joining the results (which copies
+# nested data once per level), this does a sizing pass to find the length
+# of every list, and then writes all headers and data into one buffer.
+# The buffer is appended to rather than preallocated and written by index:
+# in CPython, assigning to a slice of a bytearray is about four times
+# slower per item than appending, which costs more than the buffer's
+# occasional reallocation.
 def encode(data):
-    if isinstance(data, bytearray) or isinstance(data, bytes):
+    t = type(data)
+    if t is bytes or t is bytearray or t is memoryview:
         if len(data) == 1 and data[0] < 0x80:
-            # Byte is its own encoding. First byte is [0x00, 0x7F].
+            # Byte is its own encoding.
             return bytes(data)
-        if len(data) <= 55:
-            # Simple length plus data. First byte is [0x80, 0xB7].
-            return bytes([0x80 + len(data)]) + data
-        # Length of length, then length, then data. First byte is [0xB8, 0xBF].
-        length = encode_int(len(data))
-        return bytes([0xB7 + len(length)]) + length + data
-    elif isinstance(data, list) or isinstance(data, tuple):
-        contents = b"".join(encode(x) for x in data)
-        if len(contents) <= 55:
-            # Simple length plus data. First byte is [0xC0, 0xF7].
-            return bytes([0xC0 + len(contents)]) + contents
-        # Length of length, then length, then data. First byte is [0xF8, 0xFF].
-        length = encode_int(len(contents))
-        return bytes([0xF7 + len(length)]) + length + contents
+        return _string_header(len(data)) + data
+
+    buf = bytearray()
+    encode_into(data, buf, 0)
+    return bytes(buf)
+
+# Encode data into the bytearray "buf" at "offset", overwriting what's there
+# and growing buf if necessary. The offset can't be past the end of buf.
+# Returns the offset just past the encoding.
+def encode_into(data, buf, offset=0):
+    assert 0 <= offset <= len(buf)
+    sizes = []
+    end = offset + _measure(data, sizes)
+    if end >= len(buf):
+        # Everything from the offset on is overwritten, so drop it and
+        # append in place.
+        del buf[offset:]
+        _append(data, buf, iter(sizes))
+    else:
+        # The encoding goes in the middle of buf. Encoding into a separate
+        # buffer and copying it in is cheaper than writing by index (see
+        # encode()).
+        encoded = bytearray()
+        _append(data, encoded, iter(sizes))
+        buf[offset:end] = encoded
+    return end
+
+# Number of bytes that encode(data) would return.
+def encoded_length(data):
+    return _measure(data, [])
+
+# Returns the encoded length of data. The payload length of every list is
+# appended to "sizes" in the order that _append() visits them, so that it
+# doesn't have to measure again. Strings inside lists are handled inline
+# since they're by far the most common item.
+def _measure(data, sizes):
+    t = type(data)
+    if t is bytes or t is bytearray or t is memoryview:
+        length = len(data)
+        if length == 1 and data[0] < 0x80:
+            return 1
+    elif t is list or t is tuple:
+        index = len(sizes)
+        sizes.append(0)
+        length = 0
+        for x in data:
+            t = type(x)
+            if t is bytes or t is bytearray or t is memoryview:
+                n = len(x)
+                if n == 1 and x[0] < 0x80:
+                    length += 1
+                elif n <= 55:
+                    length += 1 + n
+                else:
+                    length += 1 + (n.bit_length() + 7) // 8 + n
+            else:
+                length += _measure(x, sizes)
+        sizes[index] = length
     else:
-        raise Exception("can only RLP-encode bytearray or list")
+        return _measure(_plain(data), sizes)
+
+    if length <= 55:
+        return 1 + length
+    return 1 + (length.bit_length() + 7) // 8 + length
+
+# Append the encoding of data to the bytearray buf, using the list sizes
+# from _measure().
+def _append(data, buf, sizes):
+    t = type(data)
+    if t is bytes or t is bytearray or t is memoryview:
+        if len(data) == 1 and data[0] < 0x80:
+            buf += data
+        else:
+            buf += _string_header(len(data))
+            buf += data
+        return
+    if t is not list and t is not tuple:
+        _append(_plain(data), buf, sizes)
+        return
+
+    length = next(sizes)
+    if length <= 55:
+        # Simple length plus data. First byte is [0xC0, 0xF7].
+        buf.append(0xC0 + length)
+    else:
+        # Length of length, then length, then data. First byte is [0xF8, 0xFF].
+        length = encode_int(length)
+        buf.append(0xF7 + len(length))
+        buf += length
+
+    for x in data:
+        t = type(x)
+        if t is bytes or t is bytearray or t is memoryview:
+            n = len(x)
+            if n == 1 and x[0] < 0x80:
+                # Byte is its own encoding. First byte is [0x00, 0x7F].
+                buf += x
+            elif n <= 55:
+                # Simple length plus data. First byte is [0x80, 0xB7].
+                buf.append(0x80 + n)
+                buf += x
+            else:
+                # Length of length, then length, then data. First byte is [0xB8, 0xBF].
+                buf += _string_header(n)
+                buf += x
+        else:
+            _append(x, buf, sizes)
+
+# Returns data, an instance of a subclass of the types that encode() takes
+# (e.g., a namedtuple), as the base type. The checks of "type(x) is" above
+# are faster, but don't match subclasses.
+def _plain(data):
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    if isinstance(data, (list, tuple)):
+        return tuple(data)
+    raise Exception("can only RLP-encode bytearray or list")
+
+# Header for a string of this length that isn't a single small byte.
+def _string_header(length):
+    if length <= 55:
+        return bytes([0x80 + length])
+    length = encode_int(length)
+    return bytes([0xB7 + len(length)]) + length
 
 # Decodes a bytearray that was encoded by RLP. Returns a hierarchy of
 # bytearrays and lists, and the number of bytes consumed. Starts at byte "start".
@@ -74,6 +193,54 @@ def decode(b):
     assert size == len(b)
     return data
 
+# Like decode(), but the strings are bytes objects even when b is a view
+# (e.g., into a store's arena), so they can be used as dictionary keys. Each
+# string is copied straight out of b with struct, without copying all of b
+# first or making a view per item.
+def decode_bytes(b):
+    data, size = _decode_bytes(b, 0)
+    assert size == len(b)
+    return data
+
+# Structs that unpack a string of each length up to _MAX_STRUCT_LENGTH.
+_MAX_STRUCT_LENGTH = 256
+_STRING_STRUCTS = [struct.Struct("%ds" % n) for n in range(_MAX_STRUCT_LENGTH + 1)]
+
+def _unpack_string(b, start, length):
+    if length <= _MAX_STRUCT_LENGTH:
+        return _STRING_STRUCTS[length].unpack_from(b, start)[0]
+    return bytes(b[start:start + length])
+
+# Like _decode(), for decode_bytes().
+def _decode_bytes(b, start):
+    first = b[start]
+    if first <= 0x7F:
+        return _unpack_string(b, start, 1), 1
+    if first <= 0xB7:
+        length = first - 0x80
+        return _unpack_string(b, start + 1, length), length + 1
+    if first <= 0xBF:
+        length_of_length = first - 0xB7
+        length = decode_int(b[start + 1:start + length_of_length + 1])
+        return (_unpack_string(b, start + length_of_length + 1, length),
+                length_of_length + 1 + length)
+
+    if first <= 0xF7:
+        length = first - 0xC0
+        index = 1
+    else:
+        length_of_length = first - 0xF7
+        length = decode_int(b[start + 1:start + length_of_length + 1])
+        index = length_of_length + 1
+
+    items = []
+    end = index + length
+    while index < end:
+        item, size = _decode_bytes(b, start + index)
+        index += size
+        items.append(item)
+    return items, index
+
 # Decode a sequence of RLP data structures, yielding each one.
 def decode_multiple(b):
     index = 0
@@ -83,6 +250,153 @@ def decode_multiple(b):
         yield data
         index += size
 
+# Returns (is_list, payload_begin, end) for the item that starts at byte
+# "start" of b, without decoding its payload.
+def item_range(b, start=0):
+    first = b[start]
+    if first <= 0x7F:
+        return False, start, start + 1
+    if first <= 0xB7:
+        return False, start + 1, start + 1 + first - 0x80
+    if first <= 0xBF:
+        begin = start + 1 + first - 0xB7
+        return False, begin, begin + decode_int(b[start + 1:begin])
+    if first <= 0xF7:
+        return True, start + 1, start + 1 + first - 0xC0
+    begin = start + 1 + first - 0xF7
+    return True, begin, begin + decode_int(b[start + 1:begin])
+
+# Field kinds for Schema. An integer, parsed straight from the buffer.
+INT = "int"
+# A string, copied to a bytes object.
+BYTES = "bytes"
+# A string, kept as a memoryview of the buffer.
+VIEW = "view"
+
+# Field kind for Schema: an RLP list whose items all have the same kind.
+class ListOf:
+    def __init__(self, kind):
+        self.kind = kind
+
+# Declarative description of an RLP list with a fixed set of fields, used to
+# decode straight from an encoded buffer into typed records in one pass,
+# without building generic nested lists first, and to encode records back.
+#
+# "fields" is a list of (name, kind) tuples, where kind is INT, BYTES, VIEW,
+# a ListOf, or another Schema (for a nested record). "record_type" is called
+# with the decoded values in field order (e.g., a class); if it's None,
+# records are tuples. When encoding, values are read from record attributes
+# of the same name, or by position for tuples.
+class Schema:
+    def __init__(self, fields, record_type=None):
+        self.names = [name for name, kind in fields]
+        self.kinds = [kind for name, kind in fields]
+        self.record_type = record_type
+
+    # Returns a schema with the same fields that builds records with "record_type".
+    def with_record_type(self, record_type):
+        return Schema(list(zip(self.names, self.kinds)), record_type)
+
+    # Decode the RLP-encoded bytes, bytearray, or memoryview b to a record.
+    def decode(self, b):
+        record, end = self._decode_at(memoryview(b), 0)
+        assert end == len(b)
+        return record
+
+    # Decode a sequence of records, yielding each one.
+    def decode_multiple(self, b):
+        b = memoryview(b)
+        index = 0
+        while index < len(b):
+            record, index = self._decode_at(b, index)
+            yield record
+
+    # Build a record from an already-decoded list (see decode()).
+    def from_list(self, v):
+        assert isinstance(v, list) or isinstance(v, tuple)
+        assert len(v) == len(self.kinds)
+        return self._make([_from_list_kind(kind, x) for kind, x in zip(self.kinds, v)])
+
+    # Returns the record as a list ready for encode(). If "count" is
+    # specified, only the first "count" fields are included.
+    def to_list(self, record, count=None):
+        kinds = self.kinds if count is None else self.kinds[:count]
+        if self.record_type is None:
+            values = record
+        else:
+            values = [getattr(record, name) for name in self.names]
+        return [_to_list_kind(kind, value) for kind, value in zip(kinds, values)]
+
+    # Returns the RLP encoding of the record. If "count" is specified, only
+    # the first "count" fields are encoded.
+    def encode(self, record, count=None):
+        return encode(self.to_list(record, count))
+
+    def _make(self, values):
+        if self.record_type is None:
+            return tuple(values)
+        return self.record_type(*values)
+
+    # Decode the record at byte "start" of memoryview b. Returns the record
+    # and the index of the byte past it.
+    def _decode_at(self, b, start):
+        is_list, index, end = item_range(b, start)
+        assert is_list
+        values = []
+        for kind in self.kinds:
+            assert index < end
+            value, index = _decode_kind(kind, b, index)
+            values.append(value)
+        assert index == end
+        return self._make(values), end
+
+# Decode an item of this kind at byte "start" of memoryview b. Returns the
+# value and the index of the byte past it.
+def _decode_kind(kind, b, start):
+    if isinstance(kind, Schema):
+        return kind._decode_at(b, start)
+
+    is_list, begin, end = item_range(b, start)
+    if kind == INT:
+        assert not is_list
+        return int.from_bytes(b[begin:end], "big"), end
+    if kind == BYTES:
+        assert not is_list
+        return bytes(b[begin:end]), end
+    if kind == VIEW:
+        assert not is_list
+        return b[begin:end], end
+
+    assert isinstance(kind, ListOf)
+    assert is_list
+    items = []
+    index = begin
+    while index < end:
+        item, index = _decode_kind(kind.kind, b, index)
+        items.append(item)
+    assert index == end
+    return items, end
+
+def _from_list_kind(kind, x):
+    if isinstance(kind, Schema):
+        return kind.from_list(x)
+    if kind == INT:
+        return decode_int(x)
+    if kind == BYTES:
+        return bytes(x)
+    if kind == VIEW:
+        return memoryview(x)
+    return [_from_list_kind(kind.kind, item) for item in x]
+
+def _to_list_kind(kind, value):
+    if isinstance(kind, Schema):
+        return kind.to_list(value)
+    if kind == INT:
+        return encode_int(value)
+    if kind == BYTES or kind == VIEW:
+        return value
+    return [_to_list_kind(kind.kind, item) for item in value]
+
 def dump_data(d, indent=""):
     if isinstance(d, list) or isinstance(d, tuple):
         print("%sList (%d):" % (indent, len(d)))
@@ -117,3 +431,56 @@ if __name__ == "__main__":
     _test([ [], [[]], [ [], [[]] ] ])
     _test(b"Lorem ipsum dolor sit amet, consectetur adipisicing elit")
 
+    # Encoding into an existing buffer.
+    buf = bytearray(b"xyz")
+    assert encode_into([b"cat", b"dog"], buf, 1) == 10
+    assert buf == b"x\xc8\x83cat\x83dog"
+    assert encoded_length([b"cat", [b"dog"] * 20]) == len(encode([b"cat", [b"dog"] * 20]))
+    assert encode_int(0) == b"" and encode_int(1024) == b"\x04\x00"
+    buf = bytearray(b"xx")
+    assert encode_into(b"abc", buf, 2) == 6 and buf == b"xx\x83abc"
+    # Inside the buffer, and exactly to its end.
+    buf = bytearray(b"0123456789")
+    assert encode_into([b"a", b"b"], buf, 2) == 5 and buf == b"01\xc2ab56789"
+    assert encode_into([b"a", b"b"], buf, 7) == 10 and buf == b"01\xc2ab56\xc2ab"
+    # Past the end of the buffer.
+    raised = False
+    try:
+        encode_into(b"abc", bytearray(b"xx"), 5)
+    except AssertionError:
+        raised = True
+    assert raised
+
+    # Subclasses of the base types.
+    import collections
+    Pair = collections.namedtuple("Pair", ["a", "b"])
+    class Name(bytes):
+        pass
+    assert encode(Pair(b"a", b"b")) == encode([b"a", b"b"])
+    assert encode([Pair(Name(b"dog"), [b"x"*60])]) == encode([[b"dog", [b"x"*60]]])
+    assert encode(Name(b"cat")) == encode(b"cat")
+    try:
+        encode([1])
+        assert False
+    except Exception as e:
+        assert "can only RLP-encode" in str(e)
+    data = [b"cat", [b"dog", b"", b"\x05", b"x"*60, b"y"*300], [b"z"*56]*3]
+    view = memoryview(bytearray(b"xx" + encode(data)))[2:]
+    decoded = decode_bytes(view)
+    assert decoded == data and type(decoded[1][0]) is bytes and type(decoded[1][4]) is bytes
+    assert decode_bytes(encode(b"dog")) == b"dog"
+    print("Encoding good.")
+
+    # Schemas.
+    point = Schema([("x", INT), ("y", INT), ("label", BYTES)])
+    shape = Schema([("name", VIEW), ("points", ListOf(point))])
+    data = [b"tri", [[encode_int(1), encode_int(2), b"a"], [b"", encode_int(300), b""]]]
+    record = shape.decode(encode(data))
+    assert bytes(record[0]) == b"tri"
+    assert record[1] == [(1, 2, b"a"), (0, 300, b"")]
+    assert shape.from_list(data)[1] == record[1]
+    assert shape.encode(record) == encode(data)
+    assert point.encode((1, 2, b"a"), 2) == encode([b"\x01", b"\x02"])
+    assert list(point.decode_multiple(encode(data[1][0]) * 3)) == [(1, 2, b"a")] * 3
+    print("Schemas good.")
+
@@ -1,31 +1,141 @@
 
-# Messing around with RSA.
+# RSA keys, encryption and signatures on integers (no padding).
 
 import random
-from prime import is_prime_miller
+from prime import random_prime_bits
 from common import are_relatively_prime, find_inverse, lcm
 
-# Two primes.
-p = 37
-q = 41
-n = p*q
-k = lcm(p - 1, q - 1) # Carmichael function
+DEFAULT_PUBLIC_EXPONENT = 65537
 
-# 1 < d < n - 1, and d and k are relatively prime (so we can find an inverse).
-while True:
-    d = random.randrange(2, n - 1)
-    if are_relatively_prime(d, k):
-        break
+class RsaPublicKey:
+    def __init__(self, n, e):
+        self.n = n
+        self.e = e
 
-# e * d = 1 (mod k)
-e = find_inverse(d, k)
+    def encrypt(self, m):
+        assert 0 <= m < self.n
+        return pow(m, self.e, self.n)
 
-print(p, q, n, d, e, k)
+    # Whether "signature" is the signature of m.
+    def verify(self, m, signature):
+        return 0 <= signature < self.n and pow(signature, self.e, self.n) == m
 
-m = random.randrange(1, n)
-em = m**e % n
-dm = em**d % n
+    def encrypt_many(self, messages):
+        n = self.n
+        e = self.e
+        return [pow(m, e, n) for m in messages]
 
-print(m, em, dm, m == dm)
+    def verify_many(self, pairs):
+        n = self.n
+        e = self.e
+        return [0 <= s < n and pow(s, e, n) == m for m, s in pairs]
 
+    def __eq__(self, o):
+        return isinstance(o, RsaPublicKey) and self.n == o.n and self.e == o.e
 
+    def __repr__(self):
+        return "RsaPublicKey(%d bits, e=%d)" % (self.n.bit_length(), self.e)
+
+class RsaPrivateKey:
+    # The private operations use the Chinese Remainder Theorem: exponents
+    # half the size of d, modulo primes half the size of n, which is about
+    # four times faster than pow(c, d, n). The CRT values are computed here
+    # once per key.
+    def __init__(self, p, q, e=DEFAULT_PUBLIC_EXPONENT):
+        assert p != q
+        self.p = p
+        self.q = q
+        self.n = p*q
+        self.e = e
+        # Carmichael function of n.
+        k = lcm(p - 1, q - 1)
+        assert are_relatively_prime(e, k)
+        self.d = find_inverse(e, k)
+        self.dp = self.d % (p - 1)
+        self.dq = self.d % (q - 1)
+        self.qinv = find_inverse(q, p)
+
+    def public_key(self):
+        return RsaPublicKey(self.n, self.e)
+
+    def decrypt(self, c):
+        assert 0 <= c < self.n
+        m1 = pow(c, self.dp, self.p)
+        m2 = pow(c, self.dq, self.q)
+        h = self.qinv*(m1 - m2) % self.p
+        return m2 + h*self.q
+
+    def sign(self, m):
+        return self.decrypt(m)
+
+    def decrypt_many(self, ciphertexts):
+        p = self.p
+        q = self.q
+        dp = self.dp
+        dq = self.dq
+        qinv = self.qinv
+        result = []
+        for c in ciphertexts:
+            m2 = pow(c, dq, q)
+            h = qinv*(pow(c, dp, p) - m2) % p
+            result.append(m2 + h*q)
+        return result
+
+    def sign_many(self, messages):
+        return self.decrypt_many(messages)
+
+    def __repr__(self):
+        return "RsaPrivateKey(%d bits, e=%d)" % (self.n.bit_length(), self.e)
+
+# Generate a private key whose modulus has exactly "bits" bits.
+def generate_key(bits, e=DEFAULT_PUBLIC_EXPONENT, rng=random):
+    assert bits >= 16
+    while True:
+        p = random_prime_bits((bits + 1)//2, rng=rng)
+        q = random_prime_bits(bits//2, rng=rng)
+        if p != q and (p*q).bit_length() == bits and \
+                are_relatively_prime(e, p - 1) and are_relatively_prime(e, q - 1):
+            return RsaPrivateKey(p, q, e)
+
+def _tests():
+    import time
+
+    # The original toy example.
+    key = RsaPrivateKey(37, 41, 7)
+    public_key = key.public_key()
+    for m in range(key.n):
+        assert key.decrypt(public_key.encrypt(m)) == m
+        assert pow(public_key.encrypt(m), key.d, key.n) == m
+
+    rng = random.Random(0)
+    for bits in [16, 17, 64, 512]:
+        key = generate_key(bits, rng=rng)
+        assert key.n.bit_length() == bits
+        public_key = key.public_key()
+        messages = [rng.randrange(key.n) for i in range(20)]
+        ciphertexts = public_key.encrypt_many(messages)
+        assert ciphertexts == [public_key.encrypt(m) for m in messages]
+        assert key.decrypt_many(ciphertexts) == messages
+        assert [key.decrypt(c) for c in ciphertexts] == messages
+        signatures = key.sign_many(messages)
+        assert all(public_key.verify_many(zip(messages, signatures)))
+        assert not public_key.verify(messages[0], (signatures[0] + 1) % key.n)
+
+    begin = time.perf_counter()
+    key = generate_key(2048, rng=rng)
+    print("2048-bit key in %.2f seconds" % (time.perf_counter() - begin))
+    messages = [rng.randrange(key.n) for i in range(20)]
+    begin = time.perf_counter()
+    plain = [pow(m, key.d, key.n) for m in messages]
+    plain_time = time.perf_counter() - begin
+    begin = time.perf_counter()
+    crt = key.sign_many(messages)
+    crt_time = time.perf_counter() - begin
+    assert plain == crt
+    print("Private operations: %.1f ms without CRT, %.1f ms with CRT" % (
+        plain_time/len(messages)*1000, crt_time/len(messages)*1000))
+
+    print("All good.")
+
+if __name__ == "__main__":
+    _tests()
@@ -0,0 +1,126 @@
+
+# Deterministic synthetic chains, for testing and benchmarking block import
+# without a dump of the real chain. Transactions are properly signed and
+# headers have correct state and transaction roots, so the chain imports
+# into an EthereumVirtualMachine like the real one would.
+
+import random
+import ecdsa
+import ethsha3
+import eth
+import mpt
+
+# Starting balance of each synthetic account.
+GENESIS_BALANCE = 1000*eth.WEI_PER_ETHER
+
+GAS_PRICE = 20*10**9
+BLOCK_GAS_LIMIT = 10**7
+BLOCK_INTERVAL = 15
+DIFFICULTY = 2**34
+# Block 1 of mainnet.
+FIRST_TIMESTAMP = 1438269988
+
+class SyntheticChain:
+    def __init__(self, genesis_alloc, blocks):
+        # List of (address, wei) tuples credited in block 0.
+        self.genesis_alloc = genesis_alloc
+        # List of Block objects, starting with block 0.
+        self.blocks = blocks
+
+    # A new EthereumVirtualMachine with this chain's genesis.
+    def make_evm(self):
+        return eth.EthereumVirtualMachine(self.genesis_alloc)
+
+    # The blocks as concatenated RLP, like the real chain dump.
+    def encode(self):
+        return b"".join(eth.BLOCK_SCHEMA.encode(b) for b in self.blocks)
+
+    def transaction_count(self):
+        return sum(len(b.transactions) for b in self.blocks)
+
+# Make a chain of "block_count" blocks (including the genesis block) with
+# "account_count" funded accounts and "transactions_per_block" transactions
+# in each non-genesis block. A "new_recipient_fraction" of transactions send
+# to new addresses, growing the state. The same parameters always produce
+# the same chain.
+def make_chain(block_count, account_count=100, transactions_per_block=10, seed=0,
+        new_recipient_fraction=0.1):
+
+    rng = random.Random(seed)
+    ec = eth.SECP256K1
+
+    private_keys = [rng.randrange(1, ec.n) for i in range(account_count)]
+    addresses = [eth.public_key_to_address(ec.G*pr) for pr in private_keys]
+    nonces = [0]*account_count
+    miner = rng.randbytes(20)
+
+    genesis_alloc = [(address, GENESIS_BALANCE) for address in addresses]
+    evm = eth.EthereumVirtualMachine(genesis_alloc)
+    blocks = []
+
+    for number in range(block_count):
+        transactions = []
+        if number > 0:
+            for i in range(transactions_per_block):
+                sender = rng.randrange(account_count)
+                if rng.random() < new_recipient_fraction:
+                    to_address = rng.randbytes(20)
+                else:
+                    to_address = addresses[rng.randrange(account_count)]
+                data = rng.randbytes(rng.choice([0, 0, 0, 4, 36]))
+                value = rng.randrange(1, 10**15)
+                transaction = _make_transaction(ec, private_keys[sender], nonces[sender],
+                        to_address, value, data, rng)
+                transaction.sender = addresses[sender]
+                nonces[sender] += 1
+                transactions.append(transaction)
+
+        gas_used = sum(t.compute_gas(number) for t in transactions)
+        header = eth.BlockHeader(
+                evm.head_block_hash,
+                eth.EMPTY_OMMERS_HASH,
+                miner if number > 0 else eth.EMPTY_ADDRESS,
+                mpt.EMPTY_TREE_ROOT, # Filled in below.
+                eth.compute_transactions_root(transactions),
+                mpt.EMPTY_TREE_ROOT,
+                bytes(256),
+                DIFFICULTY,
+                number,
+                BLOCK_GAS_LIMIT,
+                gas_used,
+                FIRST_TIMESTAMP + (number - 1)*BLOCK_INTERVAL if number > 0 else 0,
+                b"synthetic",
+                ethsha3.ZERO_HASH,
+                bytes(8))
+        b = eth.Block(header, transactions, [])
+
+        evm.apply_block(b)
+        header.stateRoot = evm.state.root
+        evm.head_block_hash = header.compute_hash()
+        evm.head_block_number = number
+        blocks.append(b)
+
+    return SyntheticChain(genesis_alloc, blocks)
+
+# Make and sign a transaction. Its sender is left for the caller to fill in.
+def _make_transaction(ec, private_key, nonce, to_address, value, data, rng):
+    gas_limit = 21000 + 68*len(data)
+    transaction = eth.Transaction(nonce, GAS_PRICE, gas_limit, to_address, value, data,
+            0, 0, 0, recover_sender=False)
+    e = int.from_bytes(ethsha3.hash(eth.TRANSACTION_SCHEMA.encode(transaction, 6)), "big")
+    v, r, s = ecdsa.sign_message(ec, private_key, e, rng)
+    transaction.v = v
+    transaction.r = r.value
+    transaction.s = s.value
+    return transaction
+
+if __name__ == "__main__":
+    chain = make_chain(4, 5, 3)
+    binary = chain.encode()
+    evm = chain.make_evm()
+    for b in eth.Block.decode_multiple(binary):
+        evm.process_block(b)
+    assert evm.head_block_hash == chain.blocks[-1].header.compute_hash()
+    assert make_chain(4, 5, 3).encode() == binary
+
+    print("All good.")